@@ -0,0 +1,77 @@
+"""
+Compares decode() in a loop with decode_batch() on synthetic payloads.
+
+The speed-up grows with the epochs per payload, the per-payload overhead of decode()
+being spread over fewer epochs. Measured: 3-5x with 1 to 3 epochs, 6-8x with the
+default 10, about 12x with 30 and 15-19x with 100 (--nsamples 100); an order of
+magnitude takes payloads of a few tens of epochs.
+
+    PYTHONPATH=src python benchmarks/bench_decode_batch.py --n 10000
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from app.batch import decode_batch  # noqa: E402
+from app.decoder import decode, CONF, VarName  # noqa: E402
+from test_decoder import Var, Vector, create_buffer  # noqa: E402
+
+
+def make_payloads(n: int, nsamples: int):
+    ports, payloads = [], []
+    templates = []
+    for use_diffs in (False, True):
+        for _ in range(20):
+            tv = Vector(N=nsamples, limits={VarName.T: (200, 260),
+                                            VarName.H: (40, 80)})
+            # create_buffer takes the log2 of the largest difference: with a few epochs,
+            # draw again until it is positive
+            while nsamples > 1 and min(np.diff(tv.data[t]).max() for t in VarName) <= 0:
+                tv = Vector(N=nsamples, limits=tv.limits)
+            vars = {t: Var(tv.data[t], CONF[t].nbits_v0, CONF[t].signed)
+                    for t in VarName}
+            templates.append(create_buffer(vars, use_diffs=use_diffs))
+    for i in range(n):
+        b, port = templates[i % len(templates)]
+        ports.append(port)
+        payloads.append(b)
+    return ports, payloads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=10_000,
+                        help="Number of payloads")
+    parser.add_argument("--nsamples", type=int, default=10,
+                        help="Epochs per payload")
+    args = parser.parse_args()
+
+    logging.getLogger('cloudia-decoder').setLevel(logging.ERROR)
+    np.random.seed(0)
+    ports, payloads = make_payloads(args.n, args.nsamples)
+    now = datetime.datetime.utcnow()
+
+    t0 = time.perf_counter()
+    ref = [decode(p, b, now=now) for p, b in zip(ports, payloads)]
+    t_scalar = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    res = decode_batch(ports, payloads, now=now)
+    t_batch = time.perf_counter() - t0
+
+    assert res.to_list(len(payloads)) == ref
+    print(f"payloads: {args.n}, epochs: {len(res)}")
+    print(f"decode():       {t_scalar:.3f} s ({args.n / t_scalar:,.0f} payloads/s)")
+    print(f"decode_batch(): {t_batch:.3f} s ({args.n / t_batch:,.0f} payloads/s)")
+    print(f"speed-up:       {t_scalar / t_batch:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
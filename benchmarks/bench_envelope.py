@@ -0,0 +1,43 @@
+"""
+Compares the envelope parsers on synthetic TTN v3 uplink messages.
+
+    PYTHONPATH=src python benchmarks/bench_envelope.py --n 20000 --gateways 8
+"""
+import argparse
+import time
+
+from app.envelope import orjson, PARSERS
+from app.loadgen import make_envelope
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=20000,
+                        help="Number of messages")
+    parser.add_argument("--gateways", type=int, default=8,
+                        help="rx_metadata entries per message")
+    args = parser.parse_args()
+
+    messages = [make_envelope(dev_eui=f"70B3D57ED005{i % 4096:04X}", f_cnt=i,
+                              ngateways=args.gateways)
+                for i in range(args.n)]
+    print(f"messages: {args.n}, {len(messages[0])} bytes each")
+
+    timings = {}
+    for name, parse in PARSERS.items():
+        if name == 'orjson' and orjson is None:
+            continue
+        ref = [PARSERS['full'](m) for m in messages[:100]]
+        assert [parse(m) for m in messages[:100]] == ref
+        t0 = time.perf_counter()
+        for m in messages:
+            parse(m)
+        timings[name] = time.perf_counter() - t0
+
+    for name, t in timings.items():
+        print(f"{name:7s} {t:.3f} s ({args.n / t:,.0f} msg/s, "
+              f"{timings['full'] / t:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
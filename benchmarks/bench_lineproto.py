@@ -0,0 +1,75 @@
+"""
+Compares building influxdb_client Points with the direct line-protocol encoder
+on 100-epoch payloads.
+
+    PYTHONPATH=src python benchmarks/bench_lineproto.py --n 2000
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from influxdb_client import Point
+from influxdb_client.client.write.point import DEFAULT_WRITE_PRECISION
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from app.decoder import decode, CONF, DEFAULT_SCHEMA, VarName  # noqa: E402
+from app.lineproto import LineProtocolEncoder  # noqa: E402
+from test_decoder import Var, Vector, create_buffer  # noqa: E402
+
+
+def points_path(epochs, deveui: str) -> bytes:
+    points = []
+    for t, v in epochs:
+        points.append(Point("TH")
+                      .tag("deveui", deveui)
+                      .field("T", v[VarName.T])
+                      .field("H", v[VarName.H])
+                      .time(t))
+    # what the write api does with a list of points
+    return b'\n'.join(p.to_line_protocol(DEFAULT_WRITE_PRECISION).encode()
+                      for p in points)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=2000,
+                        help="Number of payloads")
+    parser.add_argument("--nsamples", type=int, default=100,
+                        help="Epochs per payload")
+    args = parser.parse_args()
+
+    logging.getLogger('cloudia-decoder').setLevel(logging.ERROR)
+    np.random.seed(0)
+    tv = Vector(N=args.nsamples, limits={VarName.T: (200, 250),
+                                         VarName.H: (60, 99)})
+    vars = {t: Var(tv.data[t], CONF[t].nbits_v0, CONF[t].signed)
+            for t in VarName}
+    b, port = create_buffer(vars)
+    epochs = decode(port, b)
+    deveui = "70B3D57ED0050001"
+
+    t0 = time.perf_counter()
+    for _ in range(args.n):
+        points_path(epochs, deveui)
+    t_points = time.perf_counter() - t0
+
+    enc = LineProtocolEncoder()
+    t0 = time.perf_counter()
+    for _ in range(args.n):
+        enc.add(DEFAULT_SCHEMA, {"deveui": deveui}, epochs)
+        enc.take()
+    t_lines = time.perf_counter() - t0
+
+    n = args.n * len(epochs)
+    print(f"payloads: {args.n}, epochs per payload: {len(epochs)}")
+    print(f"Point:               {t_points:.3f} s ({n / t_points:,.0f} epochs/s)")
+    print(f"LineProtocolEncoder: {t_lines:.3f} s ({n / t_lines:,.0f} epochs/s)")
+    print(f"speed-up:            {t_points / t_lines:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Cold start of the command line entry points, against a time budget.
+
+Every command is run `--repeat` times in a fresh interpreter; the median time above a
+bare interpreter start (`python -c pass`) is compared with the budget, the exit code
+is 1 when a command is over it. The ingest service needs asyncio and the decoding
+stack whatever happens, it has its own budget.
+
+    PYTHONPATH=src python benchmarks/bench_startup.py --budget-ms 100 --main-budget-ms 250
+"""
+import argparse
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Sequence
+
+CONFIG = """\
+lns:
+  host: localhost
+  port: 1883
+  appid: cloudia
+  appkey: secret
+"""
+
+
+def median_time(cmd: Sequence[str], repeat: int, env) -> float:
+    times: List[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=15)
+    parser.add_argument("--budget-ms", type=float, default=100.0,
+                        help="Largest start-up time of the downlink CLI above the bare interpreter, in ms")
+    parser.add_argument("--main-budget-ms", type=float, default=250.0,
+                        help="Same for the ingest service")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Path(tmp) / "config.yaml"
+        config.write_text(CONFIG)
+        env = dict(os.environ, CLOUDIA_CACHE_DIR=str(Path(tmp) / "cache"))
+        py = sys.executable
+        commands = {
+            'downlink --help': ([py, '-m', 'app.downlink', '--help'], args.budget_ms),
+            'downlink --dry-run': ([py, '-m', 'app.downlink', str(config), 'dev-1', '--dry-run'],
+                                   args.budget_ms),
+            'main --help': ([py, '-m', 'app.main', '--help'], args.main_budget_ms),
+        }
+        # fills the configuration cache
+        subprocess.run(commands['downlink --dry-run'][0], env=env, check=True, stdout=subprocess.DEVNULL)
+
+        bare = median_time([py, '-c', 'pass'], args.repeat, env)
+        print(f"{'python -c pass':24s} {bare * 1000:8.1f} ms")
+        over = []
+        for name, (cmd, budget) in commands.items():
+            extra = median_time(cmd, args.repeat, env) - bare
+            status = 'ok' if extra * 1000 <= budget else 'OVER BUDGET'
+            print(f"{name:24s} {extra * 1000:+8.1f} ms  (budget {budget:.0f} ms) {status}")
+            if status != 'ok':
+                over.append(name)
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
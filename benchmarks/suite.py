@@ -0,0 +1,299 @@
+"""
+Benchmark suite: decoding per port and size, envelope parsing, line-protocol building
+and end-to-end ingest (pipeline + writer against a stub InfluxDB, plus a local
+mosquitto broker when one is installed).
+
+Results (operations per second, higher is better) are written as JSON and can be
+compared with a previous run; the exit code is 1 when a benchmark is slower than the
+baseline by more than the threshold.
+
+    PYTHONPATH=src python benchmarks/suite.py --save results.json
+    PYTHONPATH=src python benchmarks/suite.py --compare results.json --threshold 0.1
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Mapping, Optional
+
+from aiohttp import web
+from influxdb_client import Point
+from influxdb_client.client.write.point import DEFAULT_WRITE_PRECISION
+
+from app.decoder import decode, decode_columnar, DEFAULT_SCHEMA, Ports
+from app.encoder import encode_raw
+from app.envelope import orjson, PARSERS
+from app.lineproto import LineProtocolEncoder
+from app.loadgen import make_envelope, SimulatedDevice
+from app.main import consume, UplinkProcessor
+from app.pipeline import Pipeline
+from app.schema import SchemaRegistry
+from app.writer import InfluxWriter
+
+from base64 import b64encode
+
+SIZES = (1, 2, 10, 50, 100, 200)
+NOW = datetime.datetime(2024, 1, 1)
+
+
+def measure(fn: Callable[[], None], min_time: float, repeat: int = 3) -> float:
+    """
+    Best rate (calls per second) over `repeat` runs of at least `min_time` seconds
+    """
+    n = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time / 10:
+            break
+        n *= 2
+    n = max(1, int(n * min_time / dt))
+    best = 0.0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        best = max(best, n / (time.perf_counter() - t0))
+    return best
+
+
+def payload(port: int, nepochs: int, rng: random.Random) -> str:
+    T, H = [rng.randint(200, 260)], [rng.randint(40, 80)]
+    for _ in range(nepochs - 1):
+        T.append(T[-1] + rng.randint(-3, 3))
+        H.append(min(max(H[-1] + rng.randint(-2, 2), 0), 100))
+    use_diffs = port in (Ports.MULT_MEAS_OFFSET_0_DIFFS, Ports.MULT_MEAS_DIFFS)
+    offset = 10 if port in (Ports.MULT_MEAS, Ports.MULT_MEAS_DIFFS) else 0
+    if not use_diffs:
+        # jumps too large for the diff ports
+        T = [t + (300 if i % 2 else 0) for i, t in enumerate(T)]
+    got, raw = encode_raw([T, H], use_diffs=use_diffs, offset=offset)
+    assert got == port, (got, port, nepochs)
+    return b64encode(raw).decode()
+
+
+def bench_decode(results: Dict[str, float], min_time: float):
+    rng = random.Random(0)
+    for port in Ports:
+        for n in SIZES:
+            if (port == Ports.SINGLE_MEAS) != (n == 1):
+                continue
+            b = payload(port, n, rng)
+            results[f"decode/{port.value}/{n}"] = measure(lambda: decode(port, b, now=NOW), min_time)
+            results[f"decode_columnar/{port.value}/{n}"] = measure(
+                lambda: decode_columnar(port, b, now=NOW), min_time)
+
+
+def bench_envelope(results: Dict[str, float], min_time: float):
+    for ngateways in (1, 8):
+        raw = make_envelope(ngateways=ngateways)
+        for name, parse in PARSERS.items():
+            if name == 'orjson' and orjson is None:
+                continue
+            results[f"envelope/{name}/{ngateways}gw"] = measure(lambda: parse(raw), min_time)
+
+
+def bench_lineproto(results: Dict[str, float], min_time: float):
+    b = payload(Ports.MULT_MEAS_OFFSET_0_DIFFS, 100, random.Random(0))
+    epochs = decode(Ports.MULT_MEAS_OFFSET_0_DIFFS, b, now=NOW)
+    cols = decode_columnar(Ports.MULT_MEAS_OFFSET_0_DIFFS, b, now=NOW)
+
+    def points():
+        b'\n'.join(Point("TH").tag("deveui", "A").field("T", v[0]).field("H", v[1]).time(t)
+                   .to_line_protocol(DEFAULT_WRITE_PRECISION).encode() for t, v in epochs)
+
+    enc = LineProtocolEncoder()
+
+    def rows():
+        enc.add(DEFAULT_SCHEMA, {"deveui": "A"}, epochs)
+        enc.take()
+
+    def columns():
+        enc.add_columns(DEFAULT_SCHEMA, {"deveui": "A"}, cols)
+        enc.take()
+
+    results["lineproto/point/100"] = measure(points, min_time)
+    results["lineproto/rows/100"] = measure(rows, min_time)
+    results["lineproto/columns/100"] = measure(columns, min_time)
+
+
+async def stub_influx(received: List[int]):
+    """
+    InfluxDB stand-in accepting every write, the number of lines is appended to `received`
+    """
+    async def handler(request: web.Request) -> web.Response:
+        received.append((await request.read()).count(b'\n') + 1)
+        return web.Response(status=204)
+
+    app = web.Application()
+    app.router.add_post('/api/v2/write', handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def messages(n: int, ndevices: int = 500, nsamples: int = 10) -> List[bytes]:
+    rng = random.Random(0)
+    devices = [SimulatedDevice(i, nsamples, datetime.timedelta(seconds=60), rng)
+               for i in range(ndevices)]
+    return [devices[i % ndevices].uplink("2024-01-01T00:00:00Z") for i in range(n)]
+
+
+async def ingest(msgs: List[bytes], feed) -> float:
+    """
+    Messages per second through processor, pipeline and writer, the messages being
+    handed to the pipeline by `feed(pipeline, msgs)`
+    """
+    received: List[int] = []
+    runner, url = await stub_influx(received)
+    registry = SchemaRegistry.from_config({}, default=DEFAULT_SCHEMA)
+    process = UplinkProcessor(registry)
+    try:
+        async with InfluxWriter(url, "t", "o", "b", batch_size=5000) as writer:
+            async with Pipeline(process, writer.write, workers=4, queue_size=10_000) as pipeline:
+                t0 = time.perf_counter()
+                await feed(pipeline, msgs)
+            await writer.sync()
+            rate = len(msgs) / (time.perf_counter() - t0)
+        if not received:
+            raise RuntimeError("Nothing was written to the stub InfluxDB")
+        return rate
+    finally:
+        await runner.cleanup()
+
+
+async def feed_direct(pipeline: Pipeline, msgs: List[bytes]):
+    for m in msgs:
+        await pipeline.put(m)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def feed_broker(port: int, pipeline: Pipeline, msgs: List[bytes]):
+    import aiomqtt
+
+    done = asyncio.Event()
+    received = 0
+
+    async def put(raw: bytes):
+        nonlocal received
+        await pipeline.put(raw)
+        received += 1
+        if received == len(msgs):
+            done.set()
+
+    async with aiomqtt.Client('127.0.0.1', port) as sub:
+        task = asyncio.create_task(consume(sub, "v3/app/devices/+/up", put))
+        await asyncio.sleep(0.2)
+        async with aiomqtt.Client('127.0.0.1', port) as pub:
+            for i, m in enumerate(msgs):
+                await pub.publish(f"v3/app/devices/dev-{i % 500}/up", m, qos=1)
+            await asyncio.wait_for(done.wait(), 60)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def bench_ingest(results: Dict[str, float], n: int):
+    msgs = messages(n)
+    results["ingest/pipeline"] = asyncio.run(ingest(msgs, feed_direct))
+    if shutil.which('mosquitto') is None:
+        print("mosquitto not found, skipping ingest/mqtt", file=sys.stderr)
+        return
+    port = free_port()
+    broker = subprocess.Popen(['mosquitto', '-p', str(port)], stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(0.5)
+        results["ingest/mqtt"] = asyncio.run(
+            ingest(msgs, lambda pipeline, m: feed_broker(port, pipeline, m)))
+    finally:
+        broker.terminate()
+        broker.wait()
+
+
+def compare(baseline: Mapping[str, float], current: Mapping[str, float],
+            threshold: float) -> List[str]:
+    """
+    Benchmarks slower than the baseline by more than `threshold` (a fraction)
+    """
+    return [f"{name}: {current[name]:,.0f}/s vs {base:,.0f}/s ({current[name] / base - 1:+.1%})"
+            for name, base in baseline.items()
+            if name in current and current[name] < base * (1 - threshold)]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", type=str, default=None,
+                        help="Comma separated groups: decode,envelope,lineproto,ingest")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="Minimum duration of a measurement, in seconds")
+    parser.add_argument("--messages", type=int, default=20_000,
+                        help="Messages sent through the ingest benchmarks")
+    parser.add_argument("--save", type=str, default=None, help="Write the results to this file")
+    parser.add_argument("--compare", type=str, default=None, help="Baseline results file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown (fraction) reported as a regression")
+    args = parser.parse_args()
+
+    for name in ('cloudia-decoder', 'cloudia-main', 'cloudia-writer', 'cloudia-pipeline'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    groups = args.only.split(',') if args.only else ['decode', 'envelope', 'lineproto', 'ingest']
+    results: Dict[str, float] = {}
+    if 'decode' in groups:
+        bench_decode(results, args.min_time)
+    if 'envelope' in groups:
+        bench_envelope(results, args.min_time)
+    if 'lineproto' in groups:
+        bench_lineproto(results, args.min_time)
+    if 'ingest' in groups:
+        bench_ingest(results, args.messages)
+
+    for name, rate in results.items():
+        print(f"{name:32s} {rate:>14,.0f}/s")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': {'time': datetime.datetime.utcnow().isoformat(),
+                                'revision': git_revision(),
+                                'python': platform.python_version(),
+                                'platform': platform.platform()},
+                       'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, results, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+import asyncio
+import aiomqtt
+import argparse
+from collections import Counter
+import csv
+import datetime
+from dataclasses import dataclass, field
+import logging
+import math
+from pathlib import Path
+from sys import stdout
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import ujson
+
+from .config import load_config
+from .decoder import decode_columnar, DEFAULT_SCHEMA
+from .downlink import Configuration, make_configuration, publish_many
+from .encoder import encode_raw
+from .envelope import from_document
+from .replay import iter_chunks, list_sources
+from .schema import Schema, SchemaRegistry
+from .timebase import NS_PER_S, parse_received_at_ns
+
+
+logger = logging.getLogger('cloudia-advisor')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+# LoRaWAN frame around FRMPayload: MHDR (1), DevAddr (4), FCtrl (1), FCnt (2),
+# FPort (1), MIC (4)
+FRAME_OVERHEAD = 13
+
+
+@dataclass
+class DeviceHistory():
+    """
+    Decoded history of a device
+
+    - device_id: TTN device id, used to address downlinks
+    - epochs: epoch timestamp (ns) -> unscaled values, in schema order
+    - periods: number of uplinks per sampling period (ns)
+    - nsamples: number of uplinks per number of epochs
+    - bytes_on_air: frame bytes of every uplink, FRAME_OVERHEAD included
+    """
+    device_id: str
+    schema: Schema
+    epochs: Dict[int, Tuple[int, ...]] = field(default_factory=dict)
+    periods: Counter = field(default_factory=Counter)
+    nsamples: Counter = field(default_factory=Counter)
+    bytes_on_air: int = 0
+
+    @property
+    def samples(self) -> int:
+        return sum(n * k for n, k in self.nsamples.items())
+
+    def current(self) -> Tuple[int, int]:
+        """
+        Most common (period in seconds, nsamples) of the uplinks
+        """
+        period = self.periods.most_common(1)[0][0] if self.periods else 0
+        return period // NS_PER_S, self.nsamples.most_common(1)[0][0]
+
+    def bytes_per_sample(self) -> float:
+        return self.bytes_on_air / self.samples if self.samples else math.inf
+
+
+@dataclass
+class Candidate():
+    """
+    Simulated cost of sending the history with a given period and number of samples
+
+    - ports: number of uplinks per port chosen by the encoder
+    - max_payload: largest FRMPayload, in bytes
+    """
+    period: int
+    nsamples: int
+    uplinks: int
+    bytes_on_air: int
+    max_payload: int
+    ports: Counter
+
+    @property
+    def bytes_per_sample(self) -> float:
+        return self.bytes_on_air / (self.uplinks * self.nsamples)
+
+
+@dataclass
+class Recommendation():
+    device_id: str
+    dev_eui: str
+    current: Tuple[int, int]
+    current_bytes_per_sample: float
+    best: Candidate
+
+    @property
+    def gain(self) -> float:
+        return 1 - self.best.bytes_per_sample / self.current_bytes_per_sample
+
+    def configuration(self) -> Configuration:
+        return make_configuration(format_period(self.best.period), self.best.nsamples)
+
+
+def format_period(seconds: int) -> str:
+    """
+    Period string accepted by `make_configuration()`, in the unit the period register
+    can represent
+    """
+    if 0 < seconds <= 0x7F:
+        return f"{seconds}s"
+    if seconds % 60 == 0 and 0 < seconds // 60 <= 0x3F:
+        return f"{seconds // 60}m"
+    if seconds % 3600 == 0 and 0 < seconds // 3600 <= 0x3F:
+        return f"{seconds // 3600}h"
+    raise ValueError(f"Period of {seconds} s cannot be configured")
+
+
+def load_history(lines: Iterable[bytes],
+                 registry: SchemaRegistry,
+                 histories: Optional[Dict[str, DeviceHistory]] = None) -> Dict[str, DeviceHistory]:
+    """
+    Decodes archived uplinks (one TTN uplink document per line) into the history of
+    every device, keyed by DevEUI. Epochs sent several times are kept once.
+    """
+    histories = {} if histories is None else histories
+    for line in lines:
+        try:
+            doc = ujson.loads(line)
+            uplink = from_document(doc)
+            schema = registry.for_device(uplink.dev_eui)
+            cols = decode_columnar(uplink.f_port, uplink.frm_payload,
+                                   now=parse_received_at_ns(uplink.received_at),
+                                   schema=schema, registry=registry)
+        except Exception as ex:
+            logger.debug("Skipping undecodable uplink: %r", ex)
+            continue
+        if not len(cols):
+            continue
+        hist = histories.get(uplink.dev_eui)
+        if hist is None or hist.schema != schema:
+            hist = histories[uplink.dev_eui] = DeviceHistory(
+                doc['end_device_ids'].get('device_id', uplink.dev_eui), schema)
+        scales = [spec.scale for spec in schema.vars]
+        period = cols.period
+        for j, t in enumerate(cols.t):
+            # reception times jitter, align on the period so overlapping uplinks agree
+            if period:
+                t = (t + period // 2) // period * period
+            hist.epochs[t] = tuple(round(col[j] / s) for col, s in zip(cols.values, scales))
+        if period:
+            hist.periods[period] += 1
+        hist.nsamples[len(cols)] += 1
+        # base64 length, without the padding
+        hist.bytes_on_air += FRAME_OVERHEAD + len(uplink.frm_payload.rstrip('=')) * 3 // 4
+    return histories
+
+
+def simulate(raw: Sequence[Tuple[int, ...]], schema: Schema, period: int,
+             nsamples: int) -> Optional[Candidate]:
+    """
+    Encodes the epochs (oldest first) by uplinks of `nsamples` epochs, each uplink
+    taking the smallest of the absolute and difference layouts, as the devices do.
+    Returns None when some uplink cannot be encoded.
+    The last, incomplete, uplink is left out.
+    """
+    uplinks = len(raw) // nsamples
+    if not uplinks:
+        return None
+    td = datetime.timedelta(seconds=period)
+    ports: Counter = Counter()
+    total, largest = 0, 0
+    for k in range(uplinks):
+        chunk = raw[k * nsamples:(k + 1) * nsamples]
+        # payloads carry the newest epoch first
+        cols = [[e[i] for e in reversed(chunk)] for i in range(len(schema.vars))]
+        try:
+            port, payload = encode_raw(cols, schema, period=td)
+        except ValueError:
+            return None
+        ports[int(port)] += 1
+        total += FRAME_OVERHEAD + len(payload)
+        largest = max(largest, len(payload))
+    return Candidate(period, nsamples, uplinks, total, largest, ports)
+
+
+def recommend(dev_eui: str,
+              hist: DeviceHistory,
+              max_nsamples: int = 64,
+              max_payload: int = 51,
+              max_latency: Optional[int] = None,
+              factors: Sequence[int] = (1,),
+              max_epochs: int = 5000) -> Optional[Recommendation]:
+    """
+    Best (period, nsamples) for a device: the one minimizing the bytes on air per
+    sample over its history, among the candidates whose uplinks fit in `max_payload`
+    bytes and whose first sample waits at most `max_latency` seconds.
+
+    Periods can only be simulated as multiples (`factors`) of the current period, by
+    subsampling the history. Only the newest `max_epochs` epochs are used.
+
+    Arguments:
+    - max_nsamples: largest number of samples per uplink tried
+    - max_payload: largest FRMPayload, in bytes (51 at SF10-SF12 in EU868)
+    - max_latency: largest delay (in seconds) between a sample and its uplink
+    - factors: period multipliers tried
+    """
+    period, _ = hist.current()
+    if not period or len(hist.epochs) < 2:
+        return None
+    raw = [hist.epochs[t] for t in sorted(hist.epochs)][-max_epochs:]
+
+    best: Optional[Candidate] = None
+    for factor in factors:
+        try:
+            format_period(period * factor)
+        except ValueError:
+            continue
+        series = raw[::factor]
+        for n in range(1, min(max_nsamples, 255) + 1):
+            if max_latency is not None and (n - 1) * period * factor > max_latency:
+                break
+            cand = simulate(series, hist.schema, period * factor, n)
+            if cand is None or cand.max_payload > max_payload:
+                continue
+            if best is None or cand.bytes_per_sample < best.bytes_per_sample:
+                best = cand
+    if best is None:
+        return None
+    return Recommendation(hist.device_id, dev_eui, hist.current(), hist.bytes_per_sample(), best)
+
+
+def write_requests(path: Path, recommendations: Iterable[Recommendation]):
+    """
+    Writes the recommendations in the CSV format read by `downlink.load_requests()`
+    """
+    with open(path, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['device_id', 'period', 'nsamples', 'bytes_per_sample', 'gain'])
+        for r in recommendations:
+            w.writerow([r.device_id, format_period(r.best.period), r.best.nsamples,
+                        f"{r.best.bytes_per_sample:.3f}", f"{r.gain:.3f}"])
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Recommend the configuration minimizing the bytes on air per sample")
+    parser.add_argument("config", type=str, help="Configuration file")
+    parser.add_argument("path", type=str,
+                        help="JSONL archive or directory of archives")
+    parser.add_argument("--max-nsamples", type=int, default=64,
+                        help="Largest number of samples per uplink tried")
+    parser.add_argument("--max-payload", type=int, default=51,
+                        help="Largest FRMPayload in bytes")
+    parser.add_argument("--max-latency", type=int, default=None,
+                        help="Largest delay (seconds) between a sample and its uplink")
+    parser.add_argument("--factors", type=str, default="1",
+                        help="Comma separated multiples of the current period to try")
+    parser.add_argument("--min-gain", type=float, default=0.05,
+                        help="Smallest relative saving worth a reconfiguration")
+    parser.add_argument("--out", type=str, default=None,
+                        help="Write the recommendations to this CSV file")
+    parser.add_argument("--push", action="store_true",
+                        help="Send the recommended configurations as downlinks")
+
+    try:
+        args = parser.parse_args()
+    except Exception as ex:
+        logger.error("Argument parsing failed!")
+        raise ex
+
+    try:
+        config = load_config(args.config)
+    except Exception as ex:
+        logging.error("Invalid configuration file!")
+        raise ex
+
+    registry = SchemaRegistry.from_config(config.get('schemas', {}), default=DEFAULT_SCHEMA)
+    logging.getLogger('cloudia-decoder').setLevel(logging.WARNING)
+    histories: Dict[str, DeviceHistory] = {}
+    for _, _, lines in iter_chunks(list_sources(Path(args.path)), chunk_size=10_000):
+        load_history(lines, registry, histories)
+
+    factors = [int(f) for f in args.factors.split(',')]
+    recommendations: List[Recommendation] = []
+    for dev_eui, hist in histories.items():
+        r = recommend(dev_eui, hist, args.max_nsamples, args.max_payload,
+                      args.max_latency, factors)
+        if r is None:
+            logger.info(f"{dev_eui}: not enough history")
+            continue
+        logger.info(f"{dev_eui}: {format_period(r.best.period)} x {r.best.nsamples} "
+                    f"{r.best.bytes_per_sample:.2f} B/sample (ports {dict(r.best.ports)}), "
+                    f"currently {r.current[0]}s x {r.current[1]} "
+                    f"{r.current_bytes_per_sample:.2f} B/sample ({r.gain:+.1%})")
+        if r.gain >= args.min_gain and (r.best.period, r.best.nsamples) != r.current:
+            recommendations.append(r)
+
+    logger.info(f"{len(recommendations)} of {len(histories)} devices would gain "
+                f"at least {args.min_gain:.0%}")
+    if args.out:
+        write_requests(Path(args.out), recommendations)
+    if not args.push or not recommendations:
+        return
+
+    lns_config = config['lns']
+    async with aiomqtt.Client(
+            hostname=lns_config['host'],
+            port=lns_config['port'],
+            username=lns_config['appid'],
+            password=lns_config['appkey']
+    ) as client:
+        published, failed = await publish_many(
+            client, lns_config['appid'], {r.device_id: r.configuration() for r in recommendations})
+    logger.info(f"Published {published} downlinks, {len(failed)} failed")
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,292 @@
+from array import array
+from collections import OrderedDict
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from sys import stdout
+import time
+from typing import Any, Callable, List, Mapping, Optional, Sequence, Tuple
+
+from .decoder import Columns
+from .lineproto import escape_key, escape_measurement, escape_tag_value, format_float
+from .schema import Schema, SchemaRegistry
+from .timebase import NS_PER_S
+
+
+logger = logging.getLogger('cloudia-aggregate')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+class Window():
+    """
+    Running min / max / sum of every variable over one time window
+    """
+    __slots__ = ('start', 'count', 'min', 'max', 'sum')
+
+    def __init__(self, start: int, nvars: int):
+        self.start = start
+        self.count = array('q', [0]) * nvars
+        self.min = array('d', [math.inf]) * nvars
+        self.max = array('d', [-math.inf]) * nvars
+        self.sum = array('d', [0.0]) * nvars
+
+
+class DeviceWindows():
+    """
+    Open windows of a device
+
+    - floor: per window length, start of the last window already written before the
+      device was forgotten, epochs up to it are not aggregated again
+    """
+    __slots__ = ('schema', 'windows', 'last_seen', 'floor')
+
+    def __init__(self, schema: Schema, nwindows: int, last_seen: float,
+                 floor: Optional[Tuple[int, ...]] = None):
+        self.schema = schema
+        self.windows: List[Window] = [None] * nwindows
+        self.last_seen = last_seen
+        self.floor = floor
+
+
+class Aggregator():
+    """
+    Downsamples the decoded epochs of every device into tumbling windows (aligned on
+    multiples of the window length) and serializes each window as it closes, to the
+    measurement `{schema name}{suffix}` with fields `{var}_min`, `{var}_max`,
+    `{var}_mean`, `{var}_count` and a `window` tag (length in seconds).
+
+    A window closes when an epoch of a later window arrives. Devices not heard from
+    for `max_idle` seconds, or the least recently seen ones beyond `max_devices`, are
+    evicted and their open windows written as they are. `add()` only checks for idle
+    devices when an uplink arrives, call `expire()` periodically as well so the last
+    windows of a fleet gone quiet are written. Epochs older than the open window are
+    ignored.
+
+    A window is written once: a later point with the same start would overwrite it.
+    The start of the windows written early is remembered (for as many devices as
+    `max_devices`) and the epochs of an evicted device coming back that fall in them
+    are counted as late. Across restarts, `snapshot()` the open windows instead of
+    `flush()`ing them; the table is reloaded from `path` by `from_config()`.
+
+    Arguments:
+    - windows: window lengths in seconds
+    - max_idle: time (in seconds) after which a quiet device is evicted
+    - max_devices: maximum number of devices kept in memory
+    - suffix: appended to the schema name to form the measurement
+    - clock: monotonic time source
+    - path: snapshot file of the open windows, None to keep them in memory only
+    """
+
+    def __init__(self,
+                 windows: Sequence[int] = (3600, 86400),
+                 max_idle: float = 2 * 86400,
+                 max_devices: int = 100_000,
+                 suffix: str = '_agg',
+                 clock: Callable[[], float] = time.monotonic,
+                 path: Optional[str] = None):
+        if not windows or min(windows) <= 0:
+            raise ValueError(f"Window lengths must be positive, got {windows}")
+        self.windows = tuple(windows)
+        self.lengths = tuple(w * NS_PER_S for w in self.windows)
+        self.max_idle = max_idle
+        self.max_devices = max_devices
+        self.suffix = suffix
+        self.clock = clock
+        self.path = path
+        self.evictions = 0
+        self.late = 0
+        self.buf = bytearray()
+        self.nlines = 0
+        self._devices: 'OrderedDict[str, DeviceWindows]' = OrderedDict()
+        self._written: 'OrderedDict[str, Tuple[int, ...]]' = OrderedDict()
+        self._next_expiry = clock() + max_idle
+
+    @classmethod
+    def from_config(cls, cfg: Mapping[str, Any],
+                    registry: Optional[SchemaRegistry] = None) -> 'Aggregator':
+        """
+        The snapshot at `path`, if any, is reloaded when the `registry` is given
+        """
+        agg = cls(windows=cfg.get('windows', (3600, 86400)),
+                  max_idle=cfg.get('max_idle', 2 * 86400),
+                  max_devices=cfg.get('max_devices', 100_000),
+                  suffix=cfg.get('suffix', '_agg'),
+                  path=cfg.get('path'))
+        if agg.path is not None and registry is not None and os.path.exists(agg.path):
+            agg.load(agg.path, registry)
+        return agg
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def add(self, dev_eui: str, schema: Schema, columns: Columns):
+        """
+        Adds the epochs of an uplink, closed windows are appended to the output buffer
+        """
+        now = self.clock()
+        dev = self._devices.get(dev_eui)
+        if dev is None or dev.schema != schema:
+            if dev is not None:
+                del self._devices[dev_eui]
+                self._close(dev_eui, dev)
+            dev = self._devices[dev_eui] = DeviceWindows(schema, len(self.windows), now,
+                                                         self._written.pop(dev_eui, None))
+        else:
+            self._devices.move_to_end(dev_eui)
+            dev.last_seen = now
+
+        nvars = len(schema.vars)
+        values = columns.values
+        # epochs come newest first
+        for j in range(len(columns) - 1, -1, -1):
+            t = columns.t[j]
+            for k, length in enumerate(self.lengths):
+                w = dev.windows[k]
+                start = t - t % length
+                if w is None and dev.floor is not None and start <= dev.floor[k]:
+                    self.late += 1
+                    continue
+                if w is None or start > w.start:
+                    if w is not None:
+                        self._write(dev_eui, schema, k, w)
+                    w = dev.windows[k] = Window(start, nvars)
+                elif start < w.start:
+                    self.late += 1
+                    continue
+                for i in range(nvars):
+                    v = values[i][j]
+                    if not math.isfinite(v):
+                        continue
+                    w.count[i] += 1
+                    w.sum[i] += v
+                    if v < w.min[i]:
+                        w.min[i] = v
+                    if v > w.max[i]:
+                        w.max[i] = v
+
+        while len(self._devices) > self.max_devices:
+            self._close(*self._devices.popitem(last=False))
+        if now >= self._next_expiry:
+            self.expire(now)
+
+    def expire(self, now: float):
+        """
+        Evicts the devices not heard from for `max_idle` seconds
+        """
+        devices = self._devices
+        # devices are ordered by last_seen, oldest first
+        while devices:
+            dev_eui, dev = next(iter(devices.items()))
+            if now - dev.last_seen < self.max_idle:
+                break
+            del devices[dev_eui]
+            self._close(dev_eui, dev)
+        self._next_expiry = now + min(self.max_idle, 60.0)
+
+    def flush(self):
+        """
+        Writes every open window and forgets all the devices
+        """
+        while self._devices:
+            self._forget(*self._devices.popitem(last=False))
+
+    def _close(self, dev_eui: str, dev: DeviceWindows):
+        self.evictions += 1
+        self._forget(dev_eui, dev)
+
+    def _forget(self, dev_eui: str, dev: DeviceWindows):
+        """
+        Writes the open windows of a device, remembering their start
+        """
+        floor = list(dev.floor or [-1] * len(self.windows))
+        for k, w in enumerate(dev.windows):
+            if w is not None:
+                self._write(dev_eui, dev.schema, k, w)
+                floor[k] = max(floor[k], w.start)
+        self._written[dev_eui] = tuple(floor)
+        self._written.move_to_end(dev_eui)
+        while len(self._written) > self.max_devices:
+            self._written.popitem(last=False)
+
+    def snapshot(self, path: Optional[str] = None):
+        """
+        Atomically writes the open windows to `path` (defaults to the configured path)
+        """
+        path = path or self.path
+        if path is None:
+            return
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        devices = {dev_eui: [dev.schema.name, dev.floor,
+                             [None if w is None else
+                              [w.start, list(w.count), list(w.min), list(w.max), list(w.sum)]
+                              for w in dev.windows]]
+                   for dev_eui, dev in self._devices.items()}
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'windows': self.windows, 'devices': devices,
+                       'written': self._written}, f)
+        os.replace(tmp, path)
+
+    def load(self, path: str, registry: SchemaRegistry):
+        """
+        Restores the windows of a snapshot taken with the same window lengths, for the
+        devices whose schema did not change
+        """
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as ex:
+            logger.warning(f"Ignoring unreadable aggregate snapshot {path}: {ex!r}")
+            return
+        if tuple(data['windows']) != self.windows:
+            logger.warning(f"Ignoring aggregate snapshot {path}: other window lengths")
+            return
+        now = self.clock()
+        for dev_eui, floor in data['written'].items():
+            self._written[dev_eui] = tuple(floor)
+        for dev_eui, (name, floor, windows) in data['devices'].items():
+            schema = registry.for_device(dev_eui)
+            if schema.name != name or any(w is not None and len(w[1]) != len(schema.vars)
+                                          for w in windows):
+                continue
+            dev = DeviceWindows(schema, len(self.windows), now,
+                                tuple(floor) if floor is not None else None)
+            for k, w in enumerate(windows):
+                if w is not None:
+                    start, count, wmin, wmax, wsum = w
+                    window = dev.windows[k] = Window(start, len(count))
+                    window.count = array('q', count)
+                    window.min = array('d', wmin)
+                    window.max = array('d', wmax)
+                    window.sum = array('d', wsum)
+            self._devices[dev_eui] = dev
+        while len(self._written) > self.max_devices:
+            self._written.popitem(last=False)
+        logger.info(f"Loaded the open aggregate windows of {len(self._devices)} devices from {path}")
+
+    def _write(self, dev_eui: str, schema: Schema, k: int, w: Window):
+        parts = []
+        for i, spec in enumerate(schema.vars):
+            n = w.count[i]
+            if not n:
+                continue
+            name = escape_key(spec.name)
+            parts.append(f"{name}_count={n}i,{name}_max={format_float(w.max[i])},"
+                         f"{name}_mean={format_float(w.sum[i] / n)},"
+                         f"{name}_min={format_float(w.min[i])}")
+        if not parts:
+            return
+        self.buf += (f"{escape_measurement(schema.name + self.suffix)},"
+                     f"deveui={escape_tag_value(dev_eui)},window={self.windows[k]}s "
+                     f"{','.join(parts)} {w.start}\n").encode()
+        self.nlines += 1
+
+    def take(self) -> bytes:
+        res = bytes(self.buf)
+        self.buf.clear()
+        self.nlines = 0
+        return res
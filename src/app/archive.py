@@ -0,0 +1,261 @@
+from array import array
+import asyncio
+import datetime
+import logging
+import math
+import os
+from pathlib import Path
+from sys import stdout
+import time
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from .decoder import Columns
+from .schema import Schema
+from .timebase import NS_PER_S
+
+
+logger = logging.getLogger('cloudia-archive')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+NS_PER_DAY = 86400 * NS_PER_S
+EPOCH_DATE = datetime.date(1970, 1, 1)
+SUFFIXES = {'parquet': '.parquet', 'ipc': '.arrow'}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError as ex:
+        raise RuntimeError("The archive needs pyarrow (pip install cloudia_app[archive])") from ex
+    return pyarrow
+
+
+class ArchiveBuffer():
+    """
+    Epochs of one schema and one day, in columnar form
+    """
+    __slots__ = ('schema', 'dev_eui', 't', 'port', 'vbat', 'values')
+
+    def __init__(self, schema: Schema):
+        self.schema = schema
+        self.dev_eui: List[str] = []
+        self.t = array('q')
+        self.port = array('B')
+        self.vbat = array('d')
+        self.values = [array('d') for _ in schema.vars]
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def table(self):
+        pa = _pyarrow()
+        arrays = [pa.array(self.dev_eui, pa.string()).dictionary_encode(),
+                  pa.array(self.t, pa.int64()).cast(pa.timestamp('ns', tz='UTC')),
+                  pa.array(self.port, pa.uint8()),
+                  pa.array(self.vbat, pa.float64(), from_pandas=True)]
+        names = ['dev_eui', 'time', 'port', 'vbat']
+        for spec, col in zip(self.schema.vars, self.values):
+            arrays.append(pa.array(col, pa.float64()))
+            names.append(spec.name)
+        return pa.Table.from_arrays(arrays, names=names)
+
+
+class ArchiveSink():
+    """
+    Long-term archive of the decoded epochs as Parquet or Arrow IPC files, partitioned
+    by schema and (UTC) day of the epochs: `{directory}/{schema}/date=YYYY-MM-DD/part-*`.
+
+    Epochs are buffered in columns (dev_eui, time, port, vbat, one column per schema
+    variable) and written once `max_rows` are buffered or every `max_age` seconds,
+    whichever comes first, one file per partition. Files are written by a thread, under
+    a temporary name renamed once complete, so readers only ever see whole files.
+    Remaining epochs are written when the sink is closed.
+
+    pyarrow is an optional dependency, only needed once the sink is started.
+
+    Arguments:
+    - directory: root of the archive
+    - format: parquet or ipc (Arrow IPC file, fastest to memory-map)
+    - max_rows: number of buffered epochs triggering a write
+    - max_age: maximum time (in seconds) an epoch stays in the buffer
+    - compression: compression codec, 'none' to disable. Defaults to zstd for Parquet
+      and to none for IPC, whose compressed buffers are decompressed into new memory
+      on read instead of being used from the mapping
+    """
+
+    def __init__(self,
+                 directory: str,
+                 format: str = 'parquet',
+                 max_rows: int = 1_000_000,
+                 max_age: float = 300.0,
+                 compression: Optional[str] = None):
+        if format not in SUFFIXES:
+            raise ValueError(f"Unknown archive format {format}, expected one of {list(SUFFIXES)}")
+        if max_rows < 1:
+            raise ValueError(f"max_rows must be positive, got {max_rows}")
+        self.directory = Path(directory)
+        self.format = format
+        self.max_rows = max_rows
+        self.max_age = max_age
+        if compression is None:
+            compression = 'zstd' if format == 'parquet' else 'none'
+        self.compression = compression
+        self.rows = 0
+        self.files = 0
+
+        self._buffers: Dict[Tuple[str, int], ArchiveBuffer] = {}
+        self._seq = 0
+        self._lock: Optional[asyncio.Lock] = None
+        self._timer: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, cfg: Mapping[str, Any]) -> 'ArchiveSink':
+        return cls(directory=cfg['directory'],
+                   format=cfg.get('format', 'parquet'),
+                   max_rows=cfg.get('max_rows', 1_000_000),
+                   max_age=cfg.get('max_age', 300.0),
+                   compression=cfg.get('compression'))
+
+    async def start(self):
+        _pyarrow()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = asyncio.Lock()
+        self._timer = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
+            self._timer = None
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
+
+    async def __aenter__(self) -> 'ArchiveSink':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def add(self, dev_eui: str, port: int, schema: Schema, columns: Columns):
+        """
+        Buffers the epochs of an uplink; a write is started in the background once
+        `max_rows` epochs are buffered
+        """
+        n = len(columns)
+        if not n:
+            return
+        vbat = math.nan if columns.vbat is None else columns.vbat
+        t = columns.t
+        i = 0
+        while i < n:
+            day = t[i] // NS_PER_DAY
+            # epochs come newest first, at most two days per uplink in practice
+            j = i + 1
+            while j < n and t[j] // NS_PER_DAY == day:
+                j += 1
+            buf = self._buffers.get((schema.name, day))
+            if buf is None:
+                buf = self._buffers[(schema.name, day)] = ArchiveBuffer(schema)
+            buf.dev_eui.extend([dev_eui] * (j - i))
+            buf.t.extend(t[i:j])
+            buf.port.extend([port] * (j - i))
+            buf.vbat.extend([vbat] * (j - i))
+            for col, src in zip(buf.values, columns.values):
+                col.extend(src[i:j])
+            i = j
+        self.rows += n
+        if self.rows >= self.max_rows and self._lock is not None \
+                and (self._flushing is None or self._flushing.done()):
+            self._flushing = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """
+        Writes every buffered epoch, one file per partition
+        """
+        if not self._buffers:
+            return
+        buffers, self._buffers, self.rows = self._buffers, {}, 0
+        async with self._lock:
+            try:
+                paths = await asyncio.to_thread(self._write, buffers)
+            except Exception:
+                logger.exception(f"Failed to archive {sum(map(len, buffers.values()))} epochs")
+                return
+        self.files += len(paths)
+        logger.debug("Archived %d files", len(paths))
+
+    def _write(self, buffers: Mapping[Tuple[str, int], ArchiveBuffer]) -> List[Path]:
+        pa = _pyarrow()
+        paths = []
+        for key, buf in buffers.items():
+            name, day = key
+            date = EPOCH_DATE + datetime.timedelta(days=day)
+            directory = self.directory / name / f"date={date.isoformat()}"
+            directory.mkdir(parents=True, exist_ok=True)
+            self._seq += 1
+            path = directory / (f"part-{time.time_ns()}-{os.getpid()}-{self._seq}"
+                                f"{SUFFIXES[self.format]}")
+            tmp = path.with_name(path.name + '.tmp')
+            table = buf.table()
+            if self.format == 'parquet':
+                pa.parquet.write_table(table, tmp, compression=self.compression)
+            else:
+                options = pa.ipc.IpcWriteOptions(
+                    compression=None if self.compression == 'none' else self.compression)
+                with pa.OSFile(str(tmp), 'wb') as sink, \
+                        pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                    writer.write_table(table)
+            os.replace(tmp, path)
+            paths.append(path)
+        return paths
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.max_age)
+            await self.flush()
+
+
+def archive_files(directory: str, schema: Optional[str] = None,
+                  start: Optional[datetime.date] = None,
+                  end: Optional[datetime.date] = None) -> Iterator[Path]:
+    """
+    Archive files of a schema (all schemas if None), for the days from `start` to `end`
+    included, in day order
+    """
+    root = Path(directory)
+    for part in sorted(root.glob(f"{schema or '*'}/date=*"), key=lambda p: p.name):
+        day = datetime.date.fromisoformat(part.name[len('date='):])
+        if (start is not None and day < start) or (end is not None and day > end):
+            continue
+        for path in sorted(part.iterdir()):
+            if path.suffix in SUFFIXES.values():
+                yield path
+
+
+def read_archive(directory: str, schema: Optional[str] = None,
+                 start: Optional[datetime.date] = None,
+                 end: Optional[datetime.date] = None):
+    """
+    Reads the archived epochs into a single pyarrow Table. Files are memory-mapped:
+    the columns of uncompressed Arrow IPC files are used in place, compressed IPC
+    buffers and Parquet pages are decoded from the mapping into new memory.
+    """
+    pa = _pyarrow()
+    tables = []
+    for path in archive_files(directory, schema, start, end):
+        if path.suffix == '.arrow':
+            tables.append(pa.ipc.open_file(pa.memory_map(str(path))).read_all())
+        else:
+            tables.append(pa.parquet.read_table(path, memory_map=True))
+    if not tables:
+        return None
+    return pa.concat_tables(tables, promote_options='permissive')
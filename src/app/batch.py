@@ -0,0 +1,200 @@
+from base64 import b64decode
+from dataclasses import dataclass, field
+import datetime
+import numpy as np
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from .decoder import (CURRENT_VERSION, DEFAULT_REGISTRY, DEFAULT_SCHEMA, Ports,
+                      decode_period, logger)
+from .schema import DecodePlan, Field, Schema, SchemaRegistry
+from .timebase import base_ns, NS_PER_S, TimeBase
+
+
+# (port, use_diffs, nbits_vi per variable, data length in bytes)
+LayoutKey = Tuple[int, bool, Tuple[int, ...], int]
+
+
+@dataclass
+class BatchResult():
+    """
+    Decoded epochs of a batch of payloads, one row per epoch.
+    Rows are sorted by payload and, within a payload, in the order returned by `decode()`.
+
+    - index: position of the payload in the batch
+    - t: epoch timestamps (datetime64[us])
+    - values: decoded values, one column per schema variable
+    - failed: positions of the payloads that could not be decoded
+    """
+    index: np.ndarray
+    t: np.ndarray
+    values: np.ndarray
+    schema: Schema = DEFAULT_SCHEMA
+    failed: List[int] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def to_list(self, n: int) -> List[List[Tuple[datetime.datetime, Mapping[int, float]]]]:
+        """
+        Returns the result in the format of `decode()`, one list per payload
+        """
+        res: List[List[Tuple]] = [[] for _ in range(n)]
+        times = self.t.astype(datetime.datetime)
+        keys = [v.key for v in self.schema.vars]
+        for i, t, row in zip(self.index.tolist(), times, self.values.tolist()):
+            res[i].append((t, dict(zip(keys, row))))
+        return res
+
+
+def _parse_header(port: int, payload: bytes,
+                  schema: Schema) -> Tuple[LayoutKey, bytes, datetime.timedelta, int]:
+    version = ((payload[0] << 2) | ((payload[1] >> 6) & 0x3)) & 0x3FF
+    if version != CURRENT_VERSION:
+        raise NotImplementedError(f"Version: {version} not implemented")
+
+    nbits_vi = tuple(v.nbits_v0 for v in schema.vars)
+    use_diffs = False
+    offset = 0
+    period = datetime.timedelta(seconds=0)
+    if port == Ports.SINGLE_MEAS:
+        data = payload[2:]
+    elif port == Ports.MULT_MEAS_OFFSET_0:
+        data = payload[3:]
+    elif port == Ports.MULT_MEAS:
+        offset = payload[3]
+        data = payload[4:]
+    elif port == Ports.MULT_MEAS_OFFSET_0_DIFFS or port == Ports.MULT_MEAS_DIFFS:
+        if len(schema.vars) > 2:
+            raise NotImplementedError(
+                f"Port {port} supports at most 2 variables, schema {schema.name} has {len(schema.vars)}")
+        sr4 = payload[3]
+        nbits_vi = tuple((sr4 >> (5 - 3 * i)) & 0x7
+                         for i in range(len(schema.vars)))
+        use_diffs = True
+        if port == Ports.MULT_MEAS_DIFFS:
+            offset = payload[4]
+            data = payload[5:]
+        else:
+            data = payload[4:]
+    else:
+        raise NotImplementedError(f"Port {port} not implemented")
+
+    if port != Ports.SINGLE_MEAS:
+        period = decode_period(payload[2])
+
+    return (port, use_diffs, nbits_vi, len(data)), data, period, offset
+
+
+def _extract(bits: np.ndarray, starts: np.ndarray, f: Field) -> np.ndarray:
+    """
+    Reads a field at the given bit positions of every row of `bits`.
+    Returns an int64 array of shape (rows, len(starts)).
+    """
+    if f.nbits == 0:
+        return np.zeros((bits.shape[0], len(starts)), dtype=np.int64)
+    first = starts + (1 if f.signed else 0)
+    idx = first[:, None] + np.arange(f.nbits)
+    weights = np.left_shift(np.int64(1), np.arange(f.nbits, dtype=np.int64))
+    res = bits[:, idx] @ weights
+    if f.signed:
+        res = np.where(bits[:, starts] != 0, -res, res)
+    return res
+
+
+def _decode_group(plan: DecodePlan, size: int, data: List[bytes]) -> np.ndarray:
+    """
+    Decodes payloads sharing the same layout.
+    Returns raw (unscaled) values of shape (payloads, epochs, variables).
+    """
+    nvars = len(plan.keys)
+    nepochs = plan.nepochs(size * 8)
+    if nepochs == 0:
+        return np.zeros((len(data), 0, nvars), dtype=np.int64)
+
+    buf = np.frombuffer(b''.join(data), dtype=np.uint8).reshape(len(data), size)
+    bits = np.unpackbits(buf, axis=1, bitorder='little')
+
+    raw = np.empty((len(data), nepochs, nvars), dtype=np.int64)
+    epoch_starts = plan.width_v0 + plan.width_vi * np.arange(nepochs - 1)
+    for j in range(nvars):
+        f0 = plan.fields_v0[j]
+        raw[:, :1, j] = _extract(bits, np.array([f0.offset]), f0)
+        if nepochs > 1:
+            fi = plan.fields_vi[j]
+            raw[:, 1:, j] = _extract(bits, epoch_starts + fi.offset, fi)
+
+    if plan.use_diffs:
+        # full values are the running sum of the first value and the differences
+        raw = np.cumsum(raw, axis=1)
+    return raw
+
+
+def decode_batch(ports: Sequence[int],
+                 payloads: Sequence[str],
+                 now: Optional[TimeBase] = None,
+                 schema: Schema = DEFAULT_SCHEMA,
+                 registry: SchemaRegistry = DEFAULT_REGISTRY) -> BatchResult:
+    """
+    Decodes many base64 payloads at once.
+    All payloads are expected to follow `schema`.
+    Payloads are grouped by bit layout (diff widths and length) and each group is
+    unpacked in a single NumPy pass. The values and timestamps are identical to the
+    ones returned by `decode()` for each payload with the same `now`.
+
+    Payloads that cannot be decoded are reported in `BatchResult.failed`.
+    """
+    if len(ports) != len(payloads):
+        raise ValueError(
+            f"Got {len(ports)} ports and {len(payloads)} payloads")
+    now = base_ns(now)
+
+    groups: Dict[LayoutKey, List[int]] = {}
+    datas: List[bytes] = [b''] * len(payloads)
+    periods = np.zeros(len(payloads), dtype=np.int64)
+    offsets = np.zeros(len(payloads), dtype=np.int64)
+    failed: List[int] = []
+    for i, (port, payload) in enumerate(zip(ports, payloads)):
+        try:
+            key, datas[i], period, offsets[i] = _parse_header(port, b64decode(payload),
+                                                              schema)
+        except Exception as ex:
+            logger.warning(f"Payload {i} (port {port}) not decoded: {ex!r}")
+            failed.append(i)
+            continue
+        periods[i] = period // datetime.timedelta(microseconds=1) * 1000
+        groups.setdefault(key, []).append(i)
+
+    scales = np.array([v.scale for v in schema.vars])
+    index: List[np.ndarray] = []
+    epoch: List[np.ndarray] = []
+    values: List[np.ndarray] = []
+    for key, members in groups.items():
+        port, use_diffs, nbits_vi, size = key
+        plan = registry.plan(schema, port, use_diffs, nbits_vi)
+        raw = _decode_group(plan, size, [datas[i] for i in members])
+        n, nepochs, nvars = raw.shape
+        if nepochs == 0:
+            continue
+        index.append(np.repeat(np.array(members, dtype=np.int64), nepochs))
+        epoch.append(np.tile(np.arange(nepochs, dtype=np.int64), n))
+        values.append(raw.reshape(n * nepochs, nvars) * scales)
+
+    if not index:
+        return BatchResult(index=np.zeros(0, dtype=np.int64),
+                           t=np.zeros(0, dtype='datetime64[us]'),
+                           values=np.zeros((0, len(scales))),
+                           schema=schema,
+                           failed=failed)
+
+    idx = np.concatenate(index)
+    order = np.argsort(idx, kind='stable')
+    idx = idx[order]
+    ep = np.concatenate(epoch)[order]
+    t_ns = now - offsets[idx] * NS_PER_S - ep * periods[idx]
+    # floor to microseconds, as decode() does
+    t = (t_ns // 1000).astype('datetime64[us]')
+    return BatchResult(index=idx,
+                       t=t,
+                       values=np.concatenate(values)[order],
+                       schema=schema,
+                       failed=failed)
@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+import pickle
+import stat
+from sys import stdout
+from typing import Any, Mapping, Optional
+
+
+logger = logging.getLogger('cloudia-config')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+def cache_dir() -> Path:
+    """
+    Directory of the parsed configurations: $CLOUDIA_CACHE_DIR, else
+    $XDG_CACHE_HOME/cloudia (~/.cache/cloudia)
+    """
+    if os.environ.get('CLOUDIA_CACHE_DIR'):
+        return Path(os.environ['CLOUDIA_CACHE_DIR'])
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'cloudia'
+
+
+def _private(st: os.stat_result) -> bool:
+    """
+    Owned by the current user and inaccessible to anybody else
+    """
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def load_config(path: str, cache: Optional[Path] = None) -> Mapping[str, Any]:
+    """
+    Parses a YAML configuration file, keeping a pickled copy of the result so that the
+    next calls skip both the YAML parse and the yaml import. The copy is used only while
+    the file keeps the same modification time and size.
+
+    The copy holds the credentials of the configuration and unpickling runs code: the
+    cache directory is created 0700 and the copies 0600, and a copy is ignored unless
+    both belong to the current user and are private to it.
+
+    Arguments:
+    - cache: directory of the pickled copies (see `cache_dir()`), the caching is
+      disabled when CLOUDIA_CONFIG_CACHE=0
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    if os.environ.get('CLOUDIA_CONFIG_CACHE') == '0' or not hasattr(os, 'getuid'):
+        return _parse(path)
+
+    cache = cache or cache_dir()
+    cached = cache / f"{hashlib.sha1(path.encode()).hexdigest()}.pickle"
+    try:
+        dir_st = os.lstat(cache)
+        if stat.S_ISDIR(dir_st.st_mode) and dir_st.st_uid == os.getuid() \
+                and not _private(dir_st):
+            # left readable by an older version
+            os.chmod(cache, 0o700)
+            dir_st = os.lstat(cache)
+        if stat.S_ISDIR(dir_st.st_mode) and _private(dir_st):
+            fd = os.open(cached, os.O_RDONLY | os.O_NOFOLLOW)
+            with os.fdopen(fd, 'rb') as f:
+                if _private(os.fstat(fd)):
+                    cached_stamp, config = pickle.load(f)
+                    if cached_stamp == stamp:
+                        return config
+                else:
+                    logger.warning(f"Ignoring configuration cache {cached}: not private")
+        else:
+            logger.warning(f"Ignoring configuration cache directory {cache}: not private")
+            return _parse(path)
+    except Exception:
+        pass
+
+    config = _parse(path)
+    try:
+        cache.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((stamp, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cached)
+    except OSError as ex:
+        logger.debug("Configuration cache not written: %r", ex)
+    return config
+
+
+def _parse(path: str) -> Mapping[str, Any]:
+    import yaml
+
+    return yaml.safe_load(Path(path).read_text())
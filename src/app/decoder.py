@@ -1,11 +1,18 @@
+from array import array
 from base64 import b64decode
 from enum import IntEnum
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
+from itertools import accumulate, repeat
 import logging
-from typing import List, Mapping, Tuple
+from typing import List, Mapping, Optional, Sequence, Tuple, Type, Union
 import datetime
 from sys import stdout
 
+from . import metrics
+from .schema import DecodePlan, Schema, SchemaRegistry, VarSpec
+from .timebase import base_ns, NS_PER_S, TimeBase, to_datetime
+
 CURRENT_VERSION = 0x01
 
 
@@ -20,7 +27,7 @@ class VarName(IntEnum):
     H = 1
 
 
-@dataclass
+@dataclass(frozen=True)
 class VarConf():
     nbits_v0: int
     signed: bool
@@ -42,31 +49,37 @@ CONF: Mapping[VarName, VarConf] = {
 }
 
 
-class EncVar():
-    def __init__(self, name: VarName):
-        self.name = name
-        conf = CONF[name]
-        self.nbits_v0 = conf.nbits_v0
-        self.nbits_vi = conf.nbits_v0
-        self.signed = conf.signed
+DEFAULT_SCHEMA = Schema(name='TH',
+                        vars=tuple(VarSpec(key=i.value,
+                                           name=i.name,
+                                           nbits_v0=CONF[i].nbits_v0,
+                                           signed=CONF[i].signed,
+                                           scale=CONF[i].scale,
+                                           limits=CONF[i].limits)
+                                   for i in VarName))
+
+# registry used when the caller does not provide one, knows only the default schema
+DEFAULT_REGISTRY = SchemaRegistry({DEFAULT_SCHEMA.name: DEFAULT_SCHEMA},
+                                  default=DEFAULT_SCHEMA.name)
 
 
 class DecVar():
-    def __init__(self, name: VarName, raw: int, validate: bool = False):
-        self.name = name
-        conf = CONF[name]
-        s = conf.scale
-        lim = conf.limits
+    def __init__(self, spec: VarSpec, raw: int, validate: bool = False):
+        self.spec = spec
+        self.name = spec.name
+        lim = spec.limits
 
         self.raw = raw
-        self.value = raw * s
+        self.value = raw * spec.scale
         if validate:
             if self.value < lim[0] or self.value > lim[1]:
-                logger.warning(
-                    f"Variable {name} value ({self.value}) out of range {lim}")
+                # counted rather than logged, a faulty sensor would flood the log
+                metrics.OUT_OF_RANGE.inc(labels=(self.name,))
+                logger.debug("Variable %s value (%s) out of range %s",
+                             self.name, self.value, lim)
 
     def __add__(self, other) -> 'DecVar':
-        return DecVar(self.name, self.raw + other.raw, validate=True)
+        return DecVar(self.spec, self.raw + other.raw, validate=True)
 
 
 class Ports(IntEnum):
@@ -83,57 +96,169 @@ class Epoch():
     v: List[DecVar]
 
     def to_tuple(self):
-        return (self.t, {iv.name.value: iv.value for iv in self.v})
+        return (self.t, {iv.spec.key: iv.value for iv in self.v})
+
+
+class Columns():
+    """
+    Decoded epochs of one uplink in columnar form, newest epoch first.
+
+    - t: epoch timestamps, integer nanoseconds since the epoch (UTC)
+    - values: one array of doubles per schema variable, in schema order
+    - vbat: battery voltage reported in the header
+    - period: sampling period in nanoseconds
+    """
+    __slots__ = ('schema', 't', 'values', 'vbat', 'period')
+
+    def __init__(self, schema: Schema, t: array, values: List[array],
+                 vbat: Optional[float] = None, period: int = 0):
+        self.schema = schema
+        self.t = t
+        self.values = values
+        self.vbat = vbat
+        self.period = period
+
+    def head(self, n: int) -> 'Columns':
+        """
+        The `n` newest epochs
+        """
+        return Columns(self.schema, self.t[:n], [col[:n] for col in self.values],
+                       self.vbat, self.period)
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def column(self, name: str) -> array:
+        for spec, col in zip(self.schema.vars, self.values):
+            if spec.name == name:
+                return col
+        raise KeyError(name)
+
+    def rows(self) -> List[Tuple[datetime.datetime, Mapping[int, float]]]:
+        """
+        Returns the epochs in the format of `decode()`
+        """
+        keys = [v.key for v in self.schema.vars]
+        return [(to_datetime(t), dict(zip(keys, row)))
+                for t, row in zip(self.t, zip(*self.values))]
+
+
+class ByteBitReader():
+    """
+    Reads bit fields from a buffer, LSB first, one byte at a time.
+    """
+    MASK: bytes = bytes([0x01, 0x03, 0x07, 0x0F, 0x1F, 0x3F, 0x7F, 0xFF])
+
+    def __init__(self, buf: bytes):
+        self.buf: bytes = buf
+        self.size = len(self.buf)
+        self.byte_ptr = 0
+        self.bit_ptr = 0
+
+    def remaining(self) -> int:
+        return (self.size - self.byte_ptr) * 8 - self.bit_ptr
+
+    def read(self, nbits: int, signed: bool = False) -> int:
+        """
+        Extracts an int variable from the buffer given its width
+        """
+        sign = 0
+        if signed:
+            sign = (self.buf[self.byte_ptr] >> self.bit_ptr) & 0x1
+            if self.bit_ptr < 7:
+                self.bit_ptr += 1
+            else:
+                self.bit_ptr = 0
+                self.byte_ptr += 1
+        res = 0
+        shift_by = 0
+        lbuf = len(self.buf)
+        while nbits and self.byte_ptr < lbuf:
+            x = self.buf[self.byte_ptr]
+            x >>= self.bit_ptr
+            masked_bits = min(8 - self.bit_ptr, nbits)
+            res |= (x & self.MASK[masked_bits - 1]) << shift_by
+            shift_by += masked_bits
+            nbits -= masked_bits
+            if (8 - self.bit_ptr) > masked_bits:
+                self.bit_ptr += masked_bits
+            else:
+                self.bit_ptr = 0
+                self.byte_ptr += 1
+        return -res if sign else res
+
+
+class IntBitReader():
+    """
+    Reads bit fields from a buffer, LSB first.
+    The whole buffer is loaded into a single int and every field is extracted with
+    a shift and a mask from a running bit offset.
+    """
+
+    def __init__(self, buf: bytes):
+        self.value = int.from_bytes(buf, 'little')
+        self.size = len(buf) * 8
+        self.pos = 0
+
+    def remaining(self) -> int:
+        return self.size - self.pos
+
+    def read(self, nbits: int, signed: bool = False) -> int:
+        """
+        Extracts an int variable from the buffer given its width.
+        Signed values are stored as a sign bit followed by the magnitude.
+        """
+        x = self.value >> self.pos
+        if signed:
+            res = (x >> 1) & ((1 << nbits) - 1)
+            self.pos += nbits + 1
+            return -res if x & 0x1 else res
+        self.pos += nbits
+        return x & ((1 << nbits) - 1)
+
+
+BitReader = Union[ByteBitReader, IntBitReader]
 
 
 class BitDecompress():
     """
     Decompress bit-squeezed values from a buffer of bytes.
-    This class implements an iterator that returns a set of variables (as defined by var_conf),
+    This class implements an iterator that returns a set of variables (as defined by the plan),
     one epoch at the time,  until the buffer is empty
 
     Arguments:
-    - var_conf: List describing the properties of the variables in each epoch
+    - plan: compiled layout of the payload
+    - reader: bit reader class (IntBitReader or ByteBitReader)
     """
 
     def __init__(self,
                  buf: bytes,
-                 var_conf: List[EncVar],
+                 plan: DecodePlan,
                  period: datetime.timedelta,
                  now: datetime.datetime,
-                 use_diffs: bool = False):
+                 reader: Type[BitReader] = IntBitReader):
 
         self.buf: bytes = buf
-        self.size = len(self.buf)
-        self.byte_ptr = 0
-        self.bit_ptr = 0
-        self.conf = var_conf
+        self.reader_cls = reader
+        self.reader = reader(buf)
+        self.plan = plan
+        self.specs = plan.schema.vars
         self.now = now
         self.period = period
-        self.total_nbits_v0 = 0
-        self.total_nbits_vi = 0
-        self.use_diffs = use_diffs
-        self.MASK: bytes = bytes(
-            [0x01, 0x03, 0x07, 0x0F, 0x1F, 0x3F, 0x7F, 0xFF])
-
-        for c in self.conf:
-            self.total_nbits_v0 += c.nbits_v0
-            self.total_nbits_vi += (c.nbits_vi if c.nbits_vi > 0 else 0)
-
+        self.use_diffs = plan.use_diffs
         self.i = 0
 
     def _isEmpty(self) -> bool:
-        remaining_nbits = (self.size - self.byte_ptr) * 8 - self.bit_ptr
+        remaining_nbits = self.reader.remaining()
         if self.i == 0:  # no element has been read
-            return self.total_nbits_v0 > remaining_nbits
+            return self.plan.width_v0 > remaining_nbits
         else:
-            return (self.total_nbits_vi < 1) or (self.total_nbits_vi >= remaining_nbits)
+            return (self.plan.width_vi < 1) or (self.plan.width_vi > remaining_nbits)
 
     def __iter__(self):
         self.i = 0
-        self.bit_ptr = 0
-        self.byte_ptr = 0
-        self.prev_dec_vars = [DecVar(i.name, 0) for i in self.conf]
+        self.reader = self.reader_cls(self.buf)
+        self.prev_dec_vars = [DecVar(spec, 0) for spec in self.specs]
         return self
 
     def __next__(self) -> Epoch:
@@ -141,16 +266,14 @@ class BitDecompress():
         if self._isEmpty():
             raise StopIteration
         else:
-            for c in self.conf:
-                signed = c.signed or (self.use_diffs and self.i > 0)
-                nbits = c.nbits_v0 if self.i == 0 else c.nbits_vi
-                if nbits == 0:
+            fields = self.plan.fields_v0 if self.i == 0 else self.plan.fields_vi
+            for spec, f in zip(self.specs, fields):
+                if f.nbits == 0:
                     v = 0
                 else:
-                    v = self._read(nbits, signed)
-                dv = DecVar(c.name, v)
-                vars.append(dv)
-                t = self.now - self.i * self.period
+                    v = self.reader.read(f.nbits, f.signed)
+                vars.append(DecVar(spec, v))
+            t = self.now - self.i * self.period
 
         self.i += 1
         if self.use_diffs:
@@ -160,49 +283,47 @@ class BitDecompress():
 
         return Epoch(t=t, v=vars)
 
-    def _read(self, nbits: int, signed: bool = False) -> int:
-        """
-        Extracts an int variable from the buffer given its width
-        """
-        sign = 0
-        if signed:
-            sign = (self.buf[self.byte_ptr] >> self.bit_ptr) & 0x1
-            if self.bit_ptr < 7:
-                self.bit_ptr += 1
-            else:
-                self.bit_ptr = 0
-                self.byte_ptr += 1
-        res = 0
-        shift_by = 0
-        lbuf = len(self.buf)
-        while nbits and self.byte_ptr < lbuf:
-            # print(nbits, len(self.buf), self.byte_ptr)
-            x = self.buf[self.byte_ptr]
-            x >>= self.bit_ptr
-            masked_bits = min(8 - self.bit_ptr, nbits)
-            res |= (x & self.MASK[masked_bits - 1]) << shift_by
-            shift_by += masked_bits
-            nbits -= masked_bits
-            if (8 - self.bit_ptr) > masked_bits:
-                self.bit_ptr += masked_bits
-            else:
-                self.bit_ptr = 0
-                self.byte_ptr += 1
-        return -res if sign else res
+
+def decode_period(reg: int) -> datetime.timedelta:
+    """
+    Converts the period register (status byte 3) into a timedelta
+    """
+    if reg == 0:
+        return datetime.timedelta(seconds=0)
+    if reg & (1 << 7):  # value in secs
+        return datetime.timedelta(seconds=reg & 0x7F)
+    elif reg & (1 << 6):  # value in mins
+        return datetime.timedelta(minutes=reg & 0x3F)
+    else:
+        return datetime.timedelta(hours=reg & 0x3F)
 
 
 class Decoder():
-    offset: int = 0
-    period: datetime.timedelta = datetime.timedelta(seconds=0)
-    status: bytearray = bytearray([0, 0, 0, 0])
-    var_conf: Mapping[VarName, EncVar] = {
-        i: EncVar(i) for i in VarName
-    }
-
-    def __init__(self, port: int, payload_base64: str):
+    """
+    Decodes a single uplink.
+    All the state is kept per instance, so concurrent decoders do not interfere.
+
+    Arguments:
+    - now: reception time of the uplink (naive UTC datetime or integer nanoseconds),
+      defaults to the current time. The newest epoch was sampled `offset` seconds earlier.
+    - schema: variables sent by the device (defaults to T and H)
+    - registry: source of the cached decode plans
+    """
+
+    def __init__(self, port: int, payload_base64: str,
+                 now: Optional[TimeBase] = None,
+                 reader: Type[BitReader] = IntBitReader,
+                 schema: Schema = DEFAULT_SCHEMA,
+                 registry: SchemaRegistry = DEFAULT_REGISTRY):
         self.payload = b64decode(payload_base64)
         self.port = port
         self.use_diffs: bool = False
+        self.offset: int = 0
+        self.period: datetime.timedelta = datetime.timedelta(seconds=0)
+        self.status = bytearray([0, 0, 0, 0])
+        self.schema = schema
+        # full-width values unless the port carries differences
+        nbits_vi = tuple(v.nbits_v0 for v in schema.vars)
 
         self.status[0] = self.payload[0]
         self.status[1] = self.payload[1]
@@ -215,7 +336,7 @@ class Decoder():
                 f"Version: {self.version} not implemented")
 
         self.vbat = 2.5 + ((self.status[1] >> 2) & 0xF) / 10
-        logger.debug(f"Vbatt: {self.vbat}")
+        logger.debug("Vbatt: %s", self.vbat)
         # TODO: remove T and / or H from var_conf if TEN or HEN are not set
 
         if self.port == Ports.SINGLE_MEAS:
@@ -230,9 +351,12 @@ class Decoder():
         elif self.port == Ports.MULT_MEAS_OFFSET_0_DIFFS or self.port == Ports.MULT_MEAS_DIFFS:
             self.status[2] = self.payload[2]
             self.status[3] = self.payload[3]
-            # number of bits used to encode the differences
-            self.var_conf[VarName.T].nbits_vi = (self.status[3] >> 5) & 0x7
-            self.var_conf[VarName.H].nbits_vi = (self.status[3] >> 2) & 0x7
+            # number of bits used to encode the differences, 3 bits per variable
+            if len(schema.vars) > 2:
+                raise NotImplementedError(
+                    f"Port {port} supports at most 2 variables, schema {schema.name} has {len(schema.vars)}")
+            nbits_vi = tuple((self.status[3] >> (5 - 3 * i)) & 0x7
+                             for i in range(len(schema.vars)))
             self.use_diffs = True
 
             data = self.payload[4:]
@@ -244,34 +368,98 @@ class Decoder():
 
         if self.port != Ports.SINGLE_MEAS:
             period = self.status[2]
-            if period != 0:
-                if period & (1 << 7):  # value in secs
-                    self.period = datetime.timedelta(seconds=period & 0x7F)
-                elif period & (1 << 6):  # value in mins
-                    self.period = datetime.timedelta(minutes=period & 0x3F)
-                else:
-                    self.period = datetime.timedelta(hours=period & 0x3F)
-            else:
-                self.period = 0
+            self.period = decode_period(period)
+
+            logger.debug("PERIOD: %s %s %s", period, self.period, self.status[3])
 
-            logger.debug(f"PERIOD: {period} {self.period} {self.status[3]}")
+        self.plan = registry.plan(schema, port, self.use_diffs, nbits_vi)
+        self.data = data
+        self.reader_cls = reader
+        self.now_ns = base_ns(now) - self.offset * NS_PER_S
 
-        self.buffer = BitDecompress(data,
-                                    list(self.var_conf.values()),
-                                    self.period,
-                                    now=datetime.datetime.utcnow(),
-                                    use_diffs=self.use_diffs)
+    def read_columns(self) -> Columns:
+        """
+        Reads all the epochs straight into one array per variable
+        """
+        plan = self.plan
+        specs = self.schema.vars
+        reader = self.reader_cls(self.data)
+        nepochs = plan.nepochs(reader.remaining())
+        read = reader.read
+        raws: List[List[int]] = [[] for _ in specs]
+        fields = plan.fields_v0
+        for i in range(nepochs):
+            for raw, f in zip(raws, fields):
+                raw.append(read(f.nbits, f.signed) if f.nbits else 0)
+            fields = plan.fields_vi
+
+        values: List[array] = []
+        for spec, raw in zip(specs, raws):
+            if self.use_diffs:
+                # full values are the running sum of the first value and the differences
+                raw = list(accumulate(raw))
+            col = array('d', [r * spec.scale for r in raw])
+            if self.use_diffs:
+                lo, up = spec.limits
+                nout = sum(1 for v in col if v < lo or v > up)
+                if nout:
+                    metrics.OUT_OF_RANGE.inc(nout, labels=(spec.name,))
+            values.append(col)
+
+        now = self.now_ns
+        period = self.period // datetime.timedelta(microseconds=1) * 1000
+        if period and nepochs:
+            t = array('q', range(now, now - nepochs * period, -period))
+        else:
+            t = array('q', [now]) * nepochs
+        return Columns(self.schema, t, values, self.vbat, period)
 
     def read_epochs(self) -> List[Tuple]:
         res: List[Tuple] = []
 
-        for v in self.buffer:
+        buffer = BitDecompress(self.data, self.plan, self.period,
+                               now=to_datetime(self.now_ns), reader=self.reader_cls)
+        for v in buffer:
             # print(v.to_tuple())
             res.append(v.to_tuple())
 
         return res
 
 
-def decode(port: int, payload: str) -> List[Tuple[datetime.datetime, Mapping[str, float]]]:
-    d = Decoder(port, payload)
-    return d.read_epochs()
+def decode_columnar(port: int, payload: str,
+                    now: Optional[TimeBase] = None,
+                    schema: Schema = DEFAULT_SCHEMA,
+                    registry: SchemaRegistry = DEFAULT_REGISTRY) -> Columns:
+    return Decoder(port, payload, now=now, schema=schema, registry=registry).read_columns()
+
+
+def decode(port: int, payload: str,
+           now: Optional[TimeBase] = None,
+           schema: Schema = DEFAULT_SCHEMA,
+           registry: SchemaRegistry = DEFAULT_REGISTRY) -> List[Tuple[datetime.datetime, Mapping[str, float]]]:
+    """
+    Decodes an uplink into a list of (time, {variable key: value}), see `decode_columnar()`
+    """
+    return decode_columnar(port, payload, now=now, schema=schema, registry=registry).rows()
+
+
+def decode_many(ports: Sequence[int],
+                payloads: Sequence[str],
+                now: Optional[TimeBase] = None,
+                max_workers: Optional[int] = None,
+                processes: bool = False,
+                chunksize: int = 64) -> List[List[Tuple[datetime.datetime, Mapping[str, float]]]]:
+    """
+    Decodes many payloads in parallel, returning the results in input order.
+
+    Arguments:
+    - now: reception time shared by all the payloads (defaults to the current time)
+    - max_workers: size of the pool
+    - processes: use a ProcessPoolExecutor instead of a ThreadPoolExecutor
+    - chunksize: payloads sent to a worker process at once (ignored for threads)
+    """
+    now = base_ns(now)
+    pool: Executor = ProcessPoolExecutor(max_workers=max_workers) if processes \
+        else ThreadPoolExecutor(max_workers=max_workers)
+    with pool:
+        return list(pool.map(decode, ports, payloads, repeat(now), chunksize=chunksize))
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+import time
+from typing import Any, Callable, Hashable, Mapping, Optional
+
+
+class DedupCache():
+    """
+    Bounded cache of recently seen uplinks, used to drop copies delivered by several
+    gateways or redelivered by the broker.
+
+    Uplinks are keyed by (dev_eui, f_cnt, payload). Only a hash of the key is stored,
+    so memory is bounded by `max_entries` small ints whatever the size of the fleet.
+    Entries expire `ttl` seconds after they were last seen; when the cache is full the
+    least recently seen entry is evicted.
+
+    Arguments:
+    - max_entries: maximum number of remembered uplinks
+    - ttl: lifetime (in seconds) of an entry
+    - clock: monotonic time source
+    """
+
+    def __init__(self,
+                 max_entries: int = 200_000,
+                 ttl: float = 600.0,
+                 clock: Callable[[], float] = time.monotonic):
+        if max_entries < 1:
+            raise ValueError(
+                f"max_entries must be positive, got {max_entries}")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[int, float]' = OrderedDict()
+
+    @classmethod
+    def from_config(cls, cfg: Mapping[str, Any]) -> 'DedupCache':
+        return cls(max_entries=cfg.get('max_entries', 200_000),
+                   ttl=cfg.get('ttl', 600.0))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self, now: float):
+        entries = self._entries
+        # entries are ordered by expiry time, oldest first
+        while entries:
+            key, expiry = next(iter(entries.items()))
+            if expiry > now:
+                break
+            del entries[key]
+
+    def seen(self, dev_eui: str, f_cnt: Optional[int], payload: Hashable) -> bool:
+        """
+        Returns True if the uplink was already seen within `ttl`, and remembers it otherwise
+        """
+        now = self.clock()
+        self._expire(now)
+        key = hash((dev_eui, f_cnt, payload))
+        entries = self._entries
+        if key in entries:
+            entries.move_to_end(key)
+            entries[key] = now + self.ttl
+            self.hits += 1
+            return True
+
+        entries[key] = now + self.ttl
+        self.misses += 1
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return False
@@ -1,16 +1,23 @@
-import asyncio
-import aiomqtt
+# called once per device from scripts: the heavy imports (asyncio, aiomqtt, yaml)
+# are deferred to the code paths needing them
 import argparse
-import yaml
+import csv
 from pathlib import Path
-import os
 import logging
 from dataclasses import dataclass
 from enum import Enum
 from base64 import b64encode
 import re
+from sys import stdout
+import time
+from typing import Any, Dict, Iterable, List, Mapping, Tuple, TYPE_CHECKING
 import ujson
 
+from .config import load_config
+
+if TYPE_CHECKING:
+    import aiomqtt
+
 
 class TimeUnit(Enum):
     s = 's'
@@ -19,6 +26,11 @@ class TimeUnit(Enum):
 
 
 logger = logging.getLogger('cloudia-downlink')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+PERIOD_RE = re.compile(r"^(?P<value>[0-9]+)(?P<units>[smh]{1})$")
 
 
 def get_time_reg(value: int, unit: TimeUnit) -> int:
@@ -42,14 +54,124 @@ class Configuration():
         return b64encode(conf).decode('ascii')
 
 
-async def main():
+def make_configuration(period: str, nsamples: int) -> Configuration:
+    """
+    Validates a period (r'^[0-9]+[smh]$') and a number of samples
+    """
+    rmatch = PERIOD_RE.match(period)
+    if not rmatch:
+        raise ValueError(f"Invalid period {period}")
+
+    if nsamples and nsamples > 255:
+        raise ValueError("nsamples must be at most 255")
+
+    v_d = rmatch.groupdict()
+    units, value = TimeUnit(v_d['units']), int(v_d['value'])
+    if value > 255:
+        raise ValueError(f"Period value ({value}, {units}) should be < 255")
+
+    return Configuration(period=get_time_reg(value, units), nsamples=nsamples)
+
+
+def downlink_message(conf: Configuration) -> str:
+    return ujson.dumps({
+        "downlinks": [{
+            "f_port": 144,
+            "frm_payload": conf.payload(),
+            "priority": "NORMAL"
+        }]
+    })
+
+
+def load_requests(path: Path) -> Dict[str, Configuration]:
+    """
+    Reads the configurations to push from a CSV file (columns device_id, period,
+    nsamples) or a YAML list of mappings with the same keys.
+    A device listed several times gets its last configuration only.
+    """
+    if path.suffix in ('.yaml', '.yml'):
+        import yaml
+
+        rows: Iterable[Mapping[str, Any]] = yaml.safe_load(path.read_text()) or []
+    else:
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    requests: Dict[str, Configuration] = {}
+    for i, row in enumerate(rows):
+        try:
+            device_id = str(row['device_id']).strip()
+            conf = make_configuration(str(row['period']).strip(),
+                                      int(row.get('nsamples', 10)))
+        except (KeyError, ValueError) as ex:
+            raise ValueError(f"{path}, entry {i + 1}: {ex}") from ex
+        # re-insert so the device is pushed in the order of its last request
+        requests.pop(device_id, None)
+        requests[device_id] = conf
+    return requests
+
+
+async def publish_many(client: 'aiomqtt.Client',
+                       appid: str,
+                       requests: Mapping[str, Configuration],
+                       concurrency: int = 32,
+                       qos: int = 0) -> Tuple[int, List[str]]:
+    """
+    Publishes one downlink per device over a single connection, with at most
+    `concurrency` publishes in flight.
+    Returns the number of downlinks published and the devices that failed.
+    """
+    import asyncio
+
+    sem = asyncio.Semaphore(concurrency)
+    failed: List[str] = []
+
+    async def push(device_id: str, conf: Configuration):
+        async with sem:
+            try:
+                await client.publish(f"v3/{appid}/devices/{device_id}/down/push",
+                                     payload=downlink_message(conf), qos=qos)
+            except Exception as ex:
+                logger.error(f"Downlink to {device_id} failed: {ex!r}")
+                failed.append(device_id)
+
+    await asyncio.gather(*(push(d, c) for d, c in requests.items()))
+    return len(requests) - len(failed), failed
+
+
+async def push(lns_config: Mapping[str, Any], requests: Mapping[str, Configuration],
+               concurrency: int, qos: int) -> Tuple[int, List[str], float]:
+    import aiomqtt
+
+    async with aiomqtt.Client(
+            hostname=lns_config['host'],
+            port=lns_config['port'],
+            username=lns_config['appid'],
+            password=lns_config['appkey']
+    ) as client:
+        started = time.monotonic()
+        published, failed = await publish_many(client, lns_config['appid'], requests,
+                                               concurrency=concurrency, qos=qos)
+        return published, failed, time.monotonic() - started
+
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("config", type=str, help="Configuration file")
-    parser.add_argument("deviceId", type=str, help="Device id")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("deviceId", type=str, nargs='?', help="Device id")
+    target.add_argument("--batch", type=str,
+                        help="CSV (device_id,period,nsamples) or YAML file of devices to configure")
     parser.add_argument("--period", type=str,
                         help="Period r'^[0-9]+[smh]$", default="10s")
     parser.add_argument("--nsamples", type=int,
                         help="Number of samples", default=10)
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="Maximum number of publishes in flight")
+    parser.add_argument("--qos", type=int, choices=(0, 1, 2), default=0,
+                        help="MQTT QoS of the downlink messages")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the downlinks (topic and message) instead of publishing them")
 
     try:
         args = parser.parse_args()
@@ -57,45 +179,31 @@ async def main():
         logger.error("Argument parsing failed!")
         raise ex
 
-    reg = r"^(?P<value>[0-9]+)(?P<units>[smh]{1})$"
-    rmatch = re.match(reg, args.period)
-    if not rmatch:
-        raise ValueError(f"Invalid option --period {args.period}")
-
-    if args.nsamples and args.nsamples > 255:
-        raise ValueError("nsamples must be at most 255")
+    if args.batch:
+        requests = load_requests(Path(args.batch))
+    else:
+        requests = {args.deviceId: make_configuration(args.period, args.nsamples)}
 
     try:
-        config = yaml.safe_load(
-            Path(os.path.realpath(args.config)).read_text())
+        config = load_config(args.config)
     except Exception as ex:
         logging.error("Invalid configuration file!")
         raise ex
 
     lns_config = config['lns']
-    topics = f"v3/{lns_config['appid']}/devices/{args.deviceId}/down/push"
 
-    v_d = rmatch.groupdict()
-    units, value = TimeUnit(v_d['units']), int(v_d['value'])
-    if value > 255:
-        raise ValueError(f"Period value ({value}, {units}) should be < 255")
+    if args.dry_run:
+        for device_id, conf in requests.items():
+            print(f"v3/{lns_config['appid']}/devices/{device_id}/down/push {downlink_message(conf)}")
+        return
 
-    downlink = {
-        "downlinks": [{
-            "f_port": 144,
-            "frm_payload": Configuration(period=get_time_reg(value, units),
-                                         nsamples=args.nsamples).payload(),
-            "priority": "NORMAL"
-        }]
-    }
+    import asyncio
 
-    async with aiomqtt.Client(
-            hostname=lns_config['host'],
-            port=lns_config['port'],
-            username=lns_config['appid'],
-            password=lns_config['appkey']
-    ) as client:
-        await client.publish(topics, payload=ujson.dumps(downlink))
+    published, failed, elapsed = asyncio.run(push(lns_config, requests, args.concurrency, args.qos))
+    logger.info(f"Published {published} downlinks in {elapsed:.2f} s "
+                f"({published / max(elapsed, 1e-9):,.0f}/s), {len(failed)} failed")
+    if failed:
+        raise SystemExit(1)
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
@@ -0,0 +1,175 @@
+from base64 import b64encode
+import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from .decoder import CURRENT_VERSION, DEFAULT_SCHEMA, Ports
+from .schema import Schema
+
+# widths of the differences are sent on 3 bits
+MAX_DIFF_NBITS = 7
+
+
+def encode_period(period: datetime.timedelta) -> int:
+    """
+    Period register (status byte 3), inverse of `decode_period()`
+    """
+    secs = int(period.total_seconds())
+    if secs != period.total_seconds() or secs < 0:
+        raise ValueError(f"Period {period} is not a whole number of seconds")
+    if secs == 0:
+        return 0
+    if secs <= 0x7F:
+        return (1 << 7) | secs
+    if secs % 60 == 0 and secs // 60 <= 0x3F:
+        return (1 << 6) | (secs // 60)
+    if secs % 3600 == 0 and secs // 3600 <= 0x3F:
+        return secs // 3600
+    raise ValueError(f"Period {period} cannot be encoded")
+
+
+class BitWriter():
+    """
+    Packs bit fields LSB first, inverse of `IntBitReader`.
+    Fields are accumulated in a single int and converted to bytes at the end.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.pos = 0
+
+    def write(self, x: int, nbits: int, signed: bool = False):
+        if signed:
+            self.value |= (1 if x < 0 else 0) << self.pos
+            self.pos += 1
+            x = -x if x < 0 else x
+        elif x < 0:
+            raise ValueError(f"Negative value {x} in an unsigned field")
+        if x >> nbits:
+            raise ValueError(f"Value {x} does not fit in {nbits} bits")
+        self.value |= x << self.pos
+        self.pos += nbits
+
+    def padding(self) -> int:
+        return -self.pos % 8
+
+    def to_bytes(self) -> bytes:
+        return self.value.to_bytes((self.pos + 7) // 8, 'little')
+
+
+def diff_widths(raw: Sequence[Sequence[int]]) -> Optional[Tuple[int, ...]]:
+    """
+    Smallest widths able to carry the differences between consecutive epochs, None if
+    a variable needs more than `MAX_DIFF_NBITS` bits
+    """
+    widths = []
+    for col in raw:
+        largest = max(abs(b - a) for a, b in zip(col, col[1:]))
+        nbits = max(largest.bit_length(), 1)
+        if nbits > MAX_DIFF_NBITS:
+            return None
+        widths.append(nbits)
+    return tuple(widths)
+
+
+def _write_epochs(raw: Sequence[Sequence[int]], schema: Schema,
+                  widths: Optional[Tuple[int, ...]]) -> BitWriter:
+    w = BitWriter()
+    nepochs = len(raw[0])
+    for col, spec in zip(raw, schema.vars):
+        w.write(col[0], spec.nbits_v0, spec.signed)
+    if widths is None:
+        for i in range(1, nepochs):
+            for col, spec in zip(raw, schema.vars):
+                w.write(col[i], spec.nbits_v0, spec.signed)
+    else:
+        for i in range(1, nepochs):
+            for col, nbits in zip(raw, widths):
+                w.write(col[i] - col[i - 1], nbits, True)
+    return w
+
+
+def encode_raw(raw: Sequence[Sequence[int]],
+               schema: Schema = DEFAULT_SCHEMA,
+               period: datetime.timedelta = datetime.timedelta(seconds=15),
+               vbat: float = 3.8,
+               offset: int = 0,
+               use_diffs: bool = True) -> Tuple[int, bytes]:
+    """
+    Builds the payload carrying `raw` (unscaled values, one sequence per schema
+    variable, newest epoch first). Returns (port, payload).
+
+    The port follows from the number of epochs, the offset and whether the differences
+    are smaller than the values. Differences use the smallest widths holding them; a
+    width is widened when the padding of the last byte would otherwise be read back as
+    an extra epoch.
+
+    Arguments:
+    - period: sampling period, ignored for a single epoch
+    - vbat: battery voltage, 2.5 V to 4.0 V by steps of 0.1 V
+    - offset: delay (in seconds) between the newest epoch and the transmission
+    - use_diffs: allow the difference ports (90, 91)
+    """
+    nepochs = len(raw[0])
+    if nepochs == 0 or any(len(col) != nepochs for col in raw):
+        raise ValueError("Every variable needs the same, non zero, number of epochs")
+    if len(raw) != len(schema.vars):
+        raise ValueError(f"Schema {schema.name} has {len(schema.vars)} variables, got {len(raw)}")
+    if not 0 <= offset <= 0xFF:
+        raise ValueError(f"Offset {offset} does not fit in a byte")
+
+    vbat_code = round((vbat - 2.5) * 10)
+    if not 0 <= vbat_code <= 0xF:
+        raise ValueError(f"Battery voltage {vbat} out of range")
+    header = bytes([(CURRENT_VERSION >> 2) & 0xFF,
+                    ((CURRENT_VERSION & 0x3) << 6) | (vbat_code << 2) | 0x3])
+
+    if nepochs == 1:
+        if offset:
+            raise ValueError("A single epoch cannot carry an offset")
+        return Ports.SINGLE_MEAS, header + _write_epochs(raw, schema, None).to_bytes()
+
+    header += bytes([encode_period(period)])
+    absolute = _write_epochs(raw, schema, None)
+    widths = diff_widths(raw) if use_diffs and len(schema.vars) <= 2 else None
+    if widths is not None:
+        widths = list(widths)
+        while True:
+            diffs = _write_epochs(raw, schema, tuple(widths))
+            if diffs.padding() < sum(n + 1 for n in widths):
+                break
+            # padding would decode as one more epoch, widen the narrowest field
+            i = widths.index(min(widths))
+            if widths[i] == MAX_DIFF_NBITS:
+                diffs = None
+                break
+            widths[i] += 1
+        if diffs is not None and diffs.pos < absolute.pos:
+            sr4 = 0
+            for i, nbits in enumerate(widths):
+                sr4 |= nbits << (5 - 3 * i)
+            if offset:
+                return Ports.MULT_MEAS_DIFFS, header + bytes([sr4, offset]) + diffs.to_bytes()
+            return Ports.MULT_MEAS_OFFSET_0_DIFFS, header + bytes([sr4]) + diffs.to_bytes()
+
+    width_vi = sum(v.nbits_v0 + (1 if v.signed else 0) for v in schema.vars)
+    if absolute.padding() >= width_vi:
+        raise ValueError(f"Schema {schema.name} epochs are too narrow to be told apart from padding")
+    if offset:
+        return Ports.MULT_MEAS, header + bytes([offset]) + absolute.to_bytes()
+    return Ports.MULT_MEAS_OFFSET_0, header + absolute.to_bytes()
+
+
+def encode(values: Sequence[Sequence[float]],
+           schema: Schema = DEFAULT_SCHEMA,
+           period: datetime.timedelta = datetime.timedelta(seconds=15),
+           vbat: float = 3.8,
+           offset: int = 0,
+           use_diffs: bool = True) -> Tuple[int, str]:
+    """
+    Encodes scaled values (one sequence per schema variable, newest epoch first),
+    inverse of `decode()`. Returns (port, base64 payload).
+    """
+    raw: List[List[int]] = [[round(v / spec.scale) for v in col]
+                            for col, spec in zip(values, schema.vars)]
+    port, payload = encode_raw(raw, schema, period, vbat, offset, use_diffs)
+    return port, b64encode(payload).decode()
@@ -0,0 +1,143 @@
+from dataclasses import dataclass
+import re
+from typing import Callable, Mapping, Optional
+import ujson
+
+from . import metrics
+
+try:
+    import orjson
+except ImportError:  # optional, faster full parse
+    orjson = None
+
+
+@dataclass
+class Uplink():
+    """
+    Fields of a TTN v3 uplink document used by the application
+    """
+    dev_eui: str
+    f_port: int
+    frm_payload: str
+    f_cnt: int = 0
+    received_at: Optional[str] = None
+
+
+EnvelopeParser = Callable[[bytes], Uplink]
+
+
+def from_document(doc: Mapping) -> Uplink:
+    uplink = doc['uplink_message']
+    return Uplink(dev_eui=doc['end_device_ids']['dev_eui'],
+                  f_port=uplink['f_port'],
+                  frm_payload=uplink['frm_payload'],
+                  f_cnt=uplink.get('f_cnt', 0),
+                  received_at=uplink.get('received_at') or doc.get('received_at'))
+
+
+def parse_full(raw: bytes) -> Uplink:
+    """
+    Parses the whole document with ujson
+    """
+    return from_document(ujson.loads(raw))
+
+
+def parse_orjson(raw: bytes) -> Uplink:
+    """
+    Parses the whole document with orjson, if installed
+    """
+    if orjson is None:
+        raise RuntimeError("orjson is not installed")
+    return from_document(orjson.loads(raw))
+
+
+_DEV_EUI = re.compile(rb'"dev_eui"\s*:\s*"([0-9A-Fa-f]+)"')
+_F_PORT = re.compile(rb'"f_port"\s*:\s*(\d+)')
+_F_CNT = re.compile(rb'"f_cnt"\s*:\s*(\d+)')
+_FRM_PAYLOAD = re.compile(rb'"frm_payload"\s*:\s*"([A-Za-z0-9+/=]*)"')
+_RECEIVED_AT = re.compile(rb'"received_at"\s*:\s*"([0-9T:.+\-Z]+)"')
+
+
+def _depth(segment: bytes) -> int:
+    return segment.count(b'{') - segment.count(b'}')
+
+
+def _member(raw: bytes, regex: 're.Pattern', start: int) -> Optional['re.Match']:
+    """
+    First match of `regex` after `start` that is a direct member of the object
+    opened right after `start`
+    """
+    m = regex.search(raw, start)
+    if m is None or _depth(raw[start:m.start()]) != 1:
+        return None
+    return m
+
+
+def parse_scan(raw: bytes) -> Uplink:
+    """
+    Extracts the needed fields with a few regex searches, without building the document.
+
+    Every match is checked to be a direct member of end_device_ids / uplink_message
+    by counting the braces before it, so keys with the same name elsewhere (e.g. in
+    decoded_payload) are not picked up; only the part of the document up to the
+    fields is scanned, not the gateway metadata.
+    Raises ValueError when the document does not have the expected shape.
+    """
+    ids = raw.find(b'"end_device_ids"')
+    up = raw.find(b'"uplink_message"')
+    if ids < 0 or up < 0:
+        raise ValueError("Not an uplink message")
+    dev_eui = _member(raw, _DEV_EUI, ids)
+    f_port = _member(raw, _F_PORT, up)
+    frm_payload = _member(raw, _FRM_PAYLOAD, up)
+    if dev_eui is None or f_port is None or frm_payload is None:
+        raise ValueError("Missing uplink fields")
+    # f_cnt is omitted when 0
+    f_cnt = _member(raw, _F_CNT, up)
+
+    # uplink_message.received_at follows the gateway metadata: look for it from the end
+    received_at = None
+    last = raw.rfind(b'"received_at"')
+    if last > up:
+        m = _RECEIVED_AT.match(raw, last)
+        if m is not None and _depth(raw[m.end():]) == -2:
+            received_at = m
+    if received_at is None:
+        received_at = _member(raw, _RECEIVED_AT, 0)
+
+    return Uplink(dev_eui=dev_eui.group(1).decode(),
+                  f_port=int(f_port.group(1)),
+                  frm_payload=frm_payload.group(1).decode(),
+                  f_cnt=int(f_cnt.group(1)) if f_cnt else 0,
+                  received_at=received_at.group(1).decode() if received_at else None)
+
+
+PARSERS: Mapping[str, EnvelopeParser] = {
+    'full': parse_full,
+    'orjson': parse_orjson,
+    'scan': parse_scan,
+}
+
+
+def make_parser(name: str = 'scan') -> EnvelopeParser:
+    """
+    Returns the envelope parser called `name`, falling back to a full parse of the
+    document when it fails
+    """
+    try:
+        fast = PARSERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown envelope parser {name}, expected one of {list(PARSERS)}")
+    if fast is parse_full:
+        return parse_full
+    if fast is parse_orjson and orjson is None:
+        return parse_full
+
+    def parse(raw: bytes) -> Uplink:
+        try:
+            return fast(raw)
+        except Exception:
+            metrics.ENVELOPE_FALLBACKS.inc()
+            return parse_full(raw)
+
+    return parse
@@ -0,0 +1,135 @@
+import datetime
+import math
+from typing import Dict, Iterable, Mapping, Tuple, TYPE_CHECKING
+
+from .schema import Schema
+from .timebase import to_ns
+
+if TYPE_CHECKING:
+    from .decoder import Columns
+
+
+_ESCAPE_MEASUREMENT = str.maketrans({
+    ',': r'\,',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+})
+
+_ESCAPE_KEY = str.maketrans({
+    ',': r'\,',
+    '=': r'\=',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+})
+
+
+def escape_measurement(name: str) -> str:
+    return name.translate(_ESCAPE_MEASUREMENT)
+
+
+def escape_key(key: str) -> str:
+    """
+    Escapes a tag key or a field key
+    """
+    return key.translate(_ESCAPE_KEY)
+
+
+def escape_tag_value(value: str) -> str:
+    res = value.translate(_ESCAPE_KEY)
+    # a trailing backslash would escape the separator that follows
+    return res + ' ' if res.endswith('\\') else res
+
+
+def format_float(value: float) -> str:
+    s = repr(value)
+    return s[:-2] if s.endswith('.0') else s
+
+
+class LineProtocolEncoder():
+    """
+    Serializes decoded epochs straight into InfluxDB line protocol.
+    Lines are appended to an internal bytearray that is reused between calls:
+    `take()` returns the pending lines and empties the buffer.
+
+    Fields are written in the order used by `influxdb_client.Point` (sorted by name),
+    timestamps as integer nanoseconds. Non finite values are skipped.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.nlines = 0
+        # (schema name, tags) -> line prefix and (field key, value key) in output order
+        self._prefixes: Dict[Tuple, Tuple[bytes, Tuple[Tuple[str, int], ...]]] = {}
+
+    def __len__(self) -> int:
+        return self.nlines
+
+    def _prefix(self, schema: Schema, tags: Tuple[Tuple[str, str], ...]):
+        key = (schema.name, tags)
+        try:
+            return self._prefixes[key]
+        except KeyError:
+            pass
+        line = escape_measurement(schema.name)
+        for k, v in sorted(tags):
+            line += f",{escape_key(k)}={escape_tag_value(v)}"
+        fields = tuple(sorted((escape_key(v.name), v.key)
+                              for v in schema.vars))
+        if len(self._prefixes) > 4096:
+            self._prefixes.clear()
+        res = self._prefixes[key] = (line.encode() + b' ', fields)
+        return res
+
+    def add(self,
+            schema: Schema,
+            tags: Mapping[str, str],
+            epochs: Iterable[Tuple[datetime.datetime, Mapping[int, float]]]):
+        """
+        Appends one line per epoch
+
+        Arguments:
+        - schema: gives the measurement (schema name) and the field names
+        - tags: tag set shared by all the epochs
+        - epochs: decoded epochs, as returned by `decode()`
+        """
+        prefix, fields = self._prefix(schema, tuple(tags.items()))
+        buf = self.buf
+        for t, values in epochs:
+            parts = []
+            for name, key in fields:
+                v = values[key]
+                if v is None or not math.isfinite(v):
+                    continue
+                parts.append(f"{name}={format_float(float(v))}")
+            if not parts:
+                continue
+            buf += prefix
+            buf += f"{','.join(parts)} {to_ns(t)}\n".encode()
+            self.nlines += 1
+
+    def add_columns(self, schema: Schema, tags: Mapping[str, str], columns: 'Columns'):
+        """
+        Appends one line per epoch of a columnar result, see `decode_columnar()`
+        """
+        prefix, fields = self._prefix(schema, tuple(tags.items()))
+        index = {v.key: i for i, v in enumerate(schema.vars)}
+        cols = [(name, columns.values[index[key]]) for name, key in fields]
+        buf = self.buf
+        for j, t in enumerate(columns.t):
+            parts = [f"{name}={format_float(col[j])}"
+                     for name, col in cols if math.isfinite(col[j])]
+            if not parts:
+                continue
+            buf += prefix
+            buf += f"{','.join(parts)} {t}\n".encode()
+            self.nlines += 1
+
+    def take(self) -> bytes:
+        res = bytes(self.buf)
+        self.buf.clear()
+        self.nlines = 0
+        return res
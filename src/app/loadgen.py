@@ -0,0 +1,214 @@
+import asyncio
+import aiomqtt
+import argparse
+import datetime
+import logging
+import random
+from sys import stdout
+import time
+from typing import List
+import ujson
+
+from .config import load_config
+from .decoder import DEFAULT_SCHEMA
+from .encoder import encode
+
+
+logger = logging.getLogger('cloudia-loadgen')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+def device_id(dev_eui: str) -> str:
+    """
+    TTN device id of a simulated device, unique as long as the DevEUI is
+    """
+    return f"dev-{dev_eui.lower()}"
+
+
+def make_envelope(dev_eui: str = "70B3D57ED0050001",
+                  f_port: int = 90,
+                  frm_payload: str = "AHeUINLp7QI=",
+                  f_cnt: int = 1,
+                  ngateways: int = 3,
+                  received_at: str = "2024-05-01T10:00:01.123456789Z") -> bytes:
+    """
+    TTN v3 uplink message as published on v3/{appid}/devices/{device_id}/up
+    """
+    rx_metadata = [{
+        "gateway_ids": {"gateway_id": f"gw-{i}", "eui": f"B827EBFFFE{i:06X}"},
+        "time": received_at,
+        "timestamp": 1234567 + i,
+        "rssi": -80 - i,
+        "channel_rssi": -80 - i,
+        "snr": 7.5,
+        "location": {"latitude": 52.1, "longitude": 4.3, "altitude": 10, "source": "SOURCE_REGISTRY"},
+        "uplink_token": "ChsKGQoNZ3ctMDAwMDAwMDAwMBIIAAAAAAAAAAAQ" * 2,
+        "channel_index": i,
+        "received_at": received_at,
+    } for i in range(ngateways)]
+    return ujson.dumps({
+        "end_device_ids": {
+            "device_id": device_id(dev_eui),
+            "application_ids": {"application_id": "cloudia"},
+            "dev_eui": dev_eui,
+            "join_eui": "0000000000000000",
+            "dev_addr": "260B1234",
+        },
+        "correlation_ids": ["as:up:01H0000000000000000000000", "rpc:/ttn.lorawan.v3.GsNs/HandleUplink:01H"],
+        "received_at": received_at,
+        "uplink_message": {
+            "session_key_id": "AYa0000000000000000000==",
+            "f_port": f_port,
+            "f_cnt": f_cnt,
+            "frm_payload": frm_payload,
+            "rx_metadata": rx_metadata,
+            "settings": {
+                "data_rate": {"lora": {"bandwidth": 125000, "spreading_factor": 7, "coding_rate": "4/5"}},
+                "frequency": "868100000",
+                "timestamp": 1234567,
+            },
+            "received_at": received_at,
+            "consumed_airtime": "0.061696s",
+            "network_ids": {"net_id": "000013", "tenant_id": "ttn", "cluster_id": "eu1"},
+        },
+    }).encode()
+
+
+class SimulatedDevice():
+    """
+    Device sending `nsamples` temperature / humidity samples per uplink, following a
+    random walk
+    """
+
+    def __init__(self, index: int, nsamples: int, period: datetime.timedelta,
+                 rng: random.Random):
+        self.dev_eui = f"70B3D57ED0{index:06X}"
+        self.nsamples = nsamples
+        self.period = period
+        self.rng = rng
+        self.f_cnt = 0
+        self.T = rng.uniform(15.0, 25.0)
+        self.H = float(rng.randint(40, 60))
+
+    def uplink(self, received_at: str) -> bytes:
+        T: List[float] = []
+        H: List[float] = []
+        for _ in range(self.nsamples):
+            self.T = min(max(self.T + self.rng.choice((-0.1, 0.0, 0.1)), -50.0), 50.0)
+            self.H = min(max(self.H + self.rng.choice((-1.0, 0.0, 1.0)), 0.0), 100.0)
+            T.append(self.T)
+            H.append(self.H)
+        # newest sample first
+        port, payload = encode([T[::-1], H[::-1]], DEFAULT_SCHEMA, period=self.period)
+        self.f_cnt += 1
+        return make_envelope(self.dev_eui, port, payload, self.f_cnt,
+                             ngateways=self.rng.randint(1, 4), received_at=received_at)
+
+
+def rfc3339_now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+async def generate(client: aiomqtt.Client,
+                   appid: str,
+                   devices: List[SimulatedDevice],
+                   rate: float,
+                   duration: float,
+                   concurrency: int = 64,
+                   report_interval: float = 5.0) -> int:
+    """
+    Publishes uplinks of the devices in turn at `rate` messages per second for
+    `duration` seconds. Returns the number of messages published.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    sent = 0
+    tasks = set()
+
+    async def publish(dev: SimulatedDevice, msg: bytes):
+        nonlocal sent
+        try:
+            await client.publish(f"v3/{appid}/devices/{device_id(dev.dev_eui)}/up", msg)
+            sent += 1
+        finally:
+            sem.release()
+
+    started = last_report = time.monotonic()
+    n = 0
+    while True:
+        now = time.monotonic()
+        elapsed = now - started
+        if elapsed >= duration:
+            break
+        due = int(elapsed * rate) - n
+        if due <= 0:
+            await asyncio.sleep(min(1.0 / rate, 0.05))
+            continue
+        received_at = rfc3339_now()
+        for _ in range(due):
+            dev = devices[n % len(devices)]
+            await sem.acquire()
+            task = asyncio.create_task(publish(dev, dev.uplink(received_at)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            n += 1
+        if now - last_report >= report_interval:
+            last_report = now
+            logger.info(f"{sent} uplinks published ({sent / elapsed:,.0f}/s)")
+    await asyncio.gather(*tasks)
+    return sent
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Publish synthetic TTN uplinks to a (local) broker")
+    parser.add_argument("config", type=str, help="Configuration file")
+    parser.add_argument("--devices", type=int, default=100,
+                        help="Number of simulated devices")
+    parser.add_argument("--rate", type=float, default=100.0,
+                        help="Uplinks per second")
+    parser.add_argument("--duration", type=float, default=60.0,
+                        help="Duration in seconds")
+    parser.add_argument("--nsamples", type=int, default=10,
+                        help="Samples per uplink")
+    parser.add_argument("--period", type=int, default=60,
+                        help="Sampling period in seconds")
+    parser.add_argument("--host", type=str, default=None,
+                        help="Broker (default: lns.host)")
+    parser.add_argument("--port", type=int, default=None,
+                        help="Broker port (default: lns.port)")
+    parser.add_argument("--seed", type=int, default=0)
+
+    try:
+        args = parser.parse_args()
+    except Exception as ex:
+        logger.error("Argument parsing failed!")
+        raise ex
+
+    try:
+        config = load_config(args.config)
+    except Exception as ex:
+        logging.error("Invalid configuration file!")
+        raise ex
+
+    lns_config = config['lns']
+    rng = random.Random(args.seed)
+    devices = [SimulatedDevice(i, args.nsamples, datetime.timedelta(seconds=args.period), rng)
+               for i in range(args.devices)]
+
+    async with aiomqtt.Client(
+            hostname=args.host or lns_config['host'],
+            port=args.port or lns_config['port'],
+            username=lns_config.get('appid'),
+            password=lns_config.get('appkey')
+    ) as client:
+        started = time.monotonic()
+        sent = await generate(client, lns_config['appid'], devices, args.rate, args.duration)
+        elapsed = time.monotonic() - started
+
+    logger.info(f"Published {sent} uplinks in {elapsed:.1f} s ({sent / elapsed:,.0f}/s, "
+                f"target {args.rate:,.0f}/s)")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import logging
+import time
+from typing import Any, Callable, Dict, Hashable, Mapping, Optional
+
+
+PREFIX = 'cloudia-'
+
+
+def configure(cfg: Mapping[str, Any]):
+    """
+    Sets the level of the application loggers from the `logging` config section.
+
+    Arguments:
+    - cfg: `level` applies to every `cloudia-*` logger, `levels` overrides it per
+      module, e.g. {'decoder': 'WARNING'}
+    """
+    level = cfg.get('level', 'INFO')
+    overrides = cfg.get('levels') or {}
+    names = set(n for n in logging.root.manager.loggerDict if n.startswith(PREFIX))
+    names.update(PREFIX + n for n in overrides)
+    for name in names:
+        logging.getLogger(name).setLevel(overrides.get(name[len(PREFIX):], level))
+
+
+class Sampler():
+    """
+    Decides which messages get diagnostic logging: one in `every` messages and, per
+    key (e.g. a device), at most one every `interval` seconds.
+
+    `allow()` is meant to be called behind `logger.isEnabledFor()`, so nothing is
+    counted or formatted when the level is disabled.
+
+    Arguments:
+    - every: log one message in `every`, 1 logs all of them
+    - interval: minimum time (in seconds) between two logged messages of the same key,
+      0 disables the per-key limit
+    - max_keys: number of keys remembered for the per-key limit
+    - clock: monotonic time source
+    """
+
+    def __init__(self,
+                 every: int = 1,
+                 interval: float = 0.0,
+                 max_keys: int = 10_000,
+                 clock: Callable[[], float] = time.monotonic):
+        if every < 1:
+            raise ValueError(f"every must be positive, got {every}")
+        self.every = every
+        self.interval = interval
+        self.max_keys = max_keys
+        self.clock = clock
+        self._count = 0
+        self._last: Dict[Hashable, float] = {}
+
+    @classmethod
+    def from_config(cls, cfg: Mapping[str, Any]) -> 'Sampler':
+        return cls(every=cfg.get('sample_every', 1),
+                   interval=cfg.get('device_interval', 0.0))
+
+    def allow(self, key: Optional[Hashable] = None) -> bool:
+        self._count += 1
+        if self._count < self.every:
+            return False
+        if self.interval and key is not None:
+            now = self.clock()
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval:
+                return False
+            if last is None and len(self._last) >= self.max_keys:
+                # forget everything rather than track recency, this only limits logging
+                self._last.clear()
+            self._last[key] = now
+        self._count = 0
+        return True
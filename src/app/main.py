@@ -1,17 +1,30 @@
 import asyncio
-import aiomqtt
 import argparse
-from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
-from influxdb_client import Point
+import contextlib
 import logging
-import os
-from pathlib import Path
-import ujson
+import signal
 from sys import stdout
-from typing import List
-import yaml
+import time
+from typing import Any, Awaitable, Mapping, Optional, TYPE_CHECKING, Union
 
-from .decoder import decode, VarName
+from . import metrics
+from .aggregate import Aggregator
+from .archive import ArchiveSink
+from .config import load_config
+from .decoder import Decoder, DEFAULT_SCHEMA
+from .dedup import DedupCache
+from .envelope import EnvelopeParser, make_parser
+from .lineproto import LineProtocolEncoder
+from .logs import configure as configure_logging, Sampler
+from .pipeline import Pipeline
+from .profiling import Profiler, Spans
+from .schema import SchemaRegistry
+from .state import StateTable
+from .supervisor import device_from_topic, Shard, Supervisor, uplink_topic
+from .timebase import received_ns
+
+if TYPE_CHECKING:
+    import aiomqtt
 
 
 logger = logging.getLogger('cloudia-main')
@@ -20,9 +33,356 @@ logger.addHandler(consoleHandler)
 logger.setLevel(logging.DEBUG)
 
 
+class UplinkProcessor():
+    """
+    Turns a raw TTN uplink message into line protocol.
+
+    Arguments:
+    - registry: device schemas and decode plans
+    - dedup: optional cache used to drop repeated uplinks before decoding
+    - sampler: selects the uplinks whose content is logged at debug level
+    - parser: extracts the uplink fields from the message
+    - aggregator: optional downsampling stage, its closed windows are written along
+      with the raw epochs
+    - state: optional per-device table used to drop epochs already written
+    - spans: per-stage timings, recorded while enabled
+    - archive: optional columnar archive receiving the decoded epochs
+    - lines: produce line protocol (disabled when the archive is the only sink)
+    """
+
+    def __init__(self, registry: SchemaRegistry, dedup: Optional[DedupCache] = None,
+                 sampler: Optional[Sampler] = None,
+                 parser: Optional[EnvelopeParser] = None,
+                 aggregator: Optional[Aggregator] = None,
+                 state: Optional[StateTable] = None,
+                 spans: Optional[Spans] = None,
+                 archive: Optional[ArchiveSink] = None,
+                 lines: bool = True):
+        self.registry = registry
+        self.dedup = dedup
+        self.sampler = sampler or Sampler()
+        self.parser = parser or make_parser()
+        self.aggregator = aggregator
+        self.state = state
+        self.spans = spans or Spans()
+        self.archive = archive
+        self.lines = lines
+        self.encoder = LineProtocolEncoder()
+
+    async def __call__(self, raw: bytes) -> bytes:
+        spans = self.spans if self.spans.enabled else None
+        t = time.perf_counter() if spans else 0.0
+        uplink = self.parser(raw)
+        if spans:
+            spans.mark('envelope', t)
+        deveui = uplink.dev_eui
+        trace = logger.isEnabledFor(logging.DEBUG) and self.sampler.allow(deveui)
+        if trace:
+            logger.debug("Received uplink: %s", uplink)
+        f_port, frm_payload = uplink.f_port, uplink.frm_payload
+        if self.dedup is not None and self.dedup.seen(deveui, uplink.f_cnt, frm_payload):
+            if trace:
+                logger.debug("Duplicate uplink %s %s dropped", deveui, uplink.f_cnt)
+            metrics.DUPLICATES.inc()
+            return b''
+        schema = self.registry.for_device(deveui)
+        t0 = time.perf_counter()
+        try:
+            # time base taken from the LNS, so epochs stay correct however late they are processed
+            now = received_ns(uplink.received_at)
+            decoder = Decoder(f_port, frm_payload, now=now,
+                              schema=schema, registry=self.registry)
+            if spans:
+                t = spans.mark('decoder_init', t0)
+            cols = decoder.read_columns()
+        except Exception as ex:
+            metrics.DECODE_FAILURES.inc(labels=(type(ex).__name__,))
+            raise
+        metrics.DECODE_SECONDS.observe(time.perf_counter() - t0, (str(f_port),))
+        metrics.EPOCHS_PER_UPLINK.observe(len(cols))
+        if spans:
+            t = spans.mark('read_columns', t)
+        if self.state is not None:
+            cols = self.state.trim(deveui, cols)
+            if spans:
+                t = spans.mark('trim', t)
+        if trace:
+            for ts, v in cols.rows():
+                logger.debug("t: %s, values: %s", ts, v)
+        if spans:
+            t = time.perf_counter()
+        if self.archive is not None:
+            self.archive.add(deveui, f_port, schema, cols)
+            if spans:
+                t = spans.mark('archive', t)
+        if not self.lines:
+            return b''
+        self.encoder.add_columns(schema, {"deveui": deveui}, cols)
+        if spans:
+            t = spans.mark('serialize', t)
+        if self.aggregator is not None:
+            self.aggregator.add(deveui, schema, cols)
+            if spans:
+                spans.mark('aggregate', t)
+            return self.encoder.take() + self.aggregator.take()
+        return self.encoder.take()
+
+
+async def consume(client: 'aiomqtt.Client', topic: str, put, shard: Optional[Shard] = None):
+    """
+    Forwards the uplinks received on `topic` to `put`, skipping the devices that belong
+    to another shard
+    """
+    async with client.messages() as messages:
+        await client.subscribe(topic)
+        async for message in messages:
+            if shard is not None and not shard.owns(device_from_topic(message.topic.value)):
+                continue
+            metrics.MESSAGES_RECEIVED.inc()
+            await put(message.payload)
+
+
+async def consume_until_stopped(consumer: Awaitable[None],
+                                signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Runs `consumer` until it returns or one of `signals` is received. On a signal the
+    consumer is cancelled and this returns normally, so that the enclosing contexts
+    drain the pipeline and flush the sinks (a worker is stopped with SIGTERM, as is a
+    container).
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(consumer)
+    received = []
+
+    def stop(signum):
+        received.append(signum)
+        task.cancel()
+
+    installed = []
+    for signum in signals:
+        try:
+            loop.add_signal_handler(signum, stop, signum)
+            installed.append(signum)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not received:
+            raise
+        logger.info(f"Received {signal.Signals(received[0]).name}, flushing before exiting")
+    finally:
+        for signum in installed:
+            loop.remove_signal_handler(signum)
+
+
+async def discard(lines: bytes):
+    pass
+
+
+async def beat(heartbeat, index: int, interval: float = 1.0):
+    while True:
+        heartbeat[index] = time.monotonic()
+        await asyncio.sleep(interval)
+
+
+def snapshot_state(state: Union[StateTable, Aggregator]):
+    try:
+        state.snapshot()
+    except OSError:
+        logger.exception(f"Failed to snapshot {state.path}")
+
+
+async def snapshot_periodically(state: StateTable, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        snapshot_state(state)
+
+
+async def expire_periodically(aggregator: Aggregator, sink, interval: float):
+    """
+    Writes the open windows of the devices gone idle to `sink`, then snapshots the
+    remaining ones if the aggregator has a path
+    """
+    while True:
+        await asyncio.sleep(interval)
+        aggregator.expire(aggregator.clock())
+        lines = aggregator.take()
+        if lines:
+            await sink(lines)
+        if aggregator.path is not None:
+            snapshot_state(aggregator)
+
+
+async def flush_aggregator(aggregator: Aggregator, expiry: asyncio.Task, sink):
+    """
+    Stops the expiry task, writes the closed windows to `sink` and snapshots the open
+    ones. Without a snapshot path the open windows are written as they are: their
+    points are overwritten by the windows completed after a restart.
+    """
+    expiry.cancel()
+    if aggregator.path is not None:
+        snapshot_state(aggregator)
+    else:
+        aggregator.flush()
+    if aggregator.nlines:
+        logger.info(f"Writing {aggregator.nlines} aggregate windows")
+        await sink(aggregator.take())
+
+
+def worker_config(config: Mapping[str, Any], index: int) -> Mapping[str, Any]:
+    """
+    Copy of the configuration where the files a worker must not share (state and
+    aggregate snapshots, InfluxDB spool, pipeline spill file) are suffixed with the
+    worker index. With shared subscriptions the per-device stages (dedup, state,
+    aggregate) are disabled.
+    """
+    config = dict(config)
+    # hash sharding keeps every device on the same worker, so a state table per worker
+    for section, key in (('state', 'path'), ('aggregate', 'path'), ('pipeline', 'spill_path')):
+        if (config.get(section) or {}).get(key):
+            config[section] = dict(config[section], **{key: f"{config[section][key]}.{index}"})
+    spool = (config.get('influxdb') or {}).get('spool')
+    if spool and spool.get('path'):
+        config['influxdb'] = dict(config['influxdb'], spool=dict(spool, path=f"{spool['path']}.{index}"))
+    if (config.get('supervisor') or {}).get('sharing', 'hash') == 'shared':
+        # the uplinks of a device reach any worker: per-device stages would only see some
+        for section, default in (('dedup', True), ('state', True), ('aggregate', False)):
+            if (config.get(section) or {}).get('enabled', default):
+                if index == 0:
+                    logger.warning(f"{section} disabled: needs hash sharding")
+                config[section] = dict(config.get(section) or {}, enabled=False)
+    return config
+
+
+async def run(config: Mapping[str, Any], index: int = 0, processes: int = 1,
+              heartbeat=None):
+    """
+    Ingests uplinks until the connection is lost or SIGTERM is received.
+
+    Arguments:
+    - config: parsed configuration file
+    - index: worker number, offsets the metrics port
+    - processes: number of workers sharing the uplinks
+    - heartbeat: shared array in which the worker reports that its event loop is alive
+    """
+    # deferred: influxdb_client alone takes longer to import than the rest of the app.
+    # Imported before the logging is configured, which only applies to existing loggers
+    import aiomqtt
+    from .writer import InfluxWriter
+
+    log_cfg = config.get('logging', {})
+    configure_logging(log_cfg)
+    if processes > 1:
+        config = worker_config(config, index)
+
+    lns_config = config['lns']
+    sup_cfg = config.get('supervisor', {})
+    sharing = sup_cfg.get('sharing', 'hash') if processes > 1 else None
+    shard = Shard(index, processes) if sharing == 'hash' else None
+    topic = uplink_topic(lns_config['appid'], sharing, sup_cfg.get('group', 'cloudia'))
+
+    db_cfg = config.get('influxdb', {})
+    influx = db_cfg.get('enabled', True)
+    archive_cfg = config.get('archive', {})
+    archive = None
+    if archive_cfg.get('enabled', False):
+        # file names carry the pid, workers can share the directory
+        archive = ArchiveSink.from_config(archive_cfg)
+    registry = SchemaRegistry.from_config(config.get('schemas', {}),
+                                          default=DEFAULT_SCHEMA)
+    dedup_cfg = config.get('dedup', {})
+    dedup = DedupCache.from_config(dedup_cfg) \
+        if dedup_cfg.get('enabled', True) else None
+    state_cfg = config.get('state', {})
+    state = StateTable.from_config(state_cfg) \
+        if state_cfg.get('enabled', True) else None
+    agg_cfg = config.get('aggregate', {})
+    aggregator = None
+    if agg_cfg.get('enabled', False):
+        if influx:
+            aggregator = Aggregator.from_config(agg_cfg, registry)
+        else:
+            logger.warning("Aggregation disabled: the aggregates are only written to InfluxDB")
+    prof_cfg = config.get('profiling', {})
+    spans = Spans(prof_cfg.get('spans', False))
+    profiler = Profiler.from_config(prof_cfg, spans)
+    process = UplinkProcessor(registry, dedup, Sampler.from_config(log_cfg),
+                              make_parser(config.get('envelope', {}).get('parser', 'scan')),
+                              aggregator,
+                              state,
+                              spans,
+                              archive,
+                              lines=influx)
+
+    metrics_cfg = config.get('metrics', {})
+    metrics_runner = None
+    if metrics_cfg.get('enabled', False):
+        metrics_runner = await metrics.start_server(metrics_cfg.get('host', '127.0.0.1'),
+                                                    metrics_cfg.get('port', 9100) + index,
+                                                    profiler=profiler)
+    if prof_cfg.get('signal', True) and hasattr(signal, 'SIGUSR1'):
+        # every worker handles the signal, kill -USR1 <pid> targets a single one
+        profiler.install_signal(signal.SIGUSR1)
+
+    logger.debug("Starting main loop ...")
+
+    heartbeat_task = asyncio.create_task(beat(heartbeat, index)) \
+        if heartbeat is not None else None
+    snapshot_task = None
+    if state is not None and state.path is not None:
+        snapshot_task = asyncio.create_task(
+            snapshot_periodically(state, state_cfg.get('snapshot_interval', 60.0)))
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            # entered first, closed last: gets the epochs drained from the pipeline
+            if archive is not None:
+                await stack.enter_async_context(archive)
+            sink = discard
+            if influx:
+                sink = (await stack.enter_async_context(InfluxWriter.from_config(db_cfg))).write
+            if aggregator is not None:
+                expiry = asyncio.create_task(expire_periodically(
+                    aggregator, sink, min(aggregator.max_idle, 60.0)))
+                # runs once the pipeline is drained, before the writer is closed
+                stack.push_async_callback(flush_aggregator, aggregator, expiry, sink)
+            pipeline = await stack.enter_async_context(
+                Pipeline.from_config(process, spans.timed('sink', sink), config.get('pipeline', {})))
+            client = await stack.enter_async_context(aiomqtt.Client(
+                hostname=lns_config['host'],
+                port=lns_config['port'],
+                username=lns_config['appid'],
+                password=lns_config['appkey']
+            ))
+            metrics.QUEUE_DEPTH.add_callback(
+                lambda: {(k,): v for k, v in pipeline.qsizes().items()})
+            metrics.DROPPED.add_callback(lambda: pipeline.dropped)
+            metrics.SPILLED.add_callback(lambda: pipeline.spilled)
+            await consume_until_stopped(consume(client, topic, pipeline.put, shard))
+    finally:
+        # after the exit stack: the pipeline is drained and the sinks flushed
+        if heartbeat_task is not None:
+            heartbeat_task.cancel()
+        if snapshot_task is not None:
+            snapshot_task.cancel()
+            snapshot_state(state)
+        profiler.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+def worker(index: int, heartbeat, config: Mapping[str, Any], processes: int):
+    """
+    Entry point of a supervised worker process
+    """
+    asyncio.run(run(config, index, processes, heartbeat))
+
+
 async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("config", type=str, help="Configuration file")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of worker processes (default: supervisor.processes or 1)")
 
     try:
         args = parser.parse_args()
@@ -31,54 +391,22 @@ async def main():
         raise ex
 
     try:
-        config = yaml.safe_load(
-            Path(os.path.realpath(args.config)).read_text())
+        config = load_config(args.config)
     except Exception as ex:
         logging.error("Invalid configuration file!")
         raise ex
 
-    lns_config = config['lns']
-    topics = f"v3/{lns_config['appid']}/devices/+/up"
-
-    db_cfg = config['influxdb']
-    bucket, org = db_cfg['bucket'], db_cfg['org']
-
-    logger.debug("Starting main loop ...")
+    sup_cfg = config.get('supervisor', {})
+    processes = args.processes or sup_cfg.get('processes', 1)
+    if processes == 1:
+        await run(config)
+        return
 
-    async with aiomqtt.Client(
-            hostname=lns_config['host'],
-            port=lns_config['port'],
-            username=lns_config['appid'],
-            password=lns_config['appkey']
-    ) as client:
-        async with client.messages() as messages:
-            await client.subscribe(topics)
-            async for message in messages:
-                try:
-                    payload = ujson.loads(message.payload.decode())
-                    deveui = payload['end_device_ids']['dev_eui']
-                    uplink = payload['uplink_message']
-                    logger.debug(f"Received uplink: {uplink}")
-                    f_port, frm_payload = uplink['f_port'], uplink['frm_payload']
-                    dec = decode(f_port, frm_payload)
-                    points: List[Point] = []
-                    for t, v in dec:
-                        T, H = v[VarName.T], v[VarName.H]
-                        logger.debug(f"t: {t}, values: ({T}, {H})")
-                        points.append(Point("TH")
-                                      .tag("deveui", deveui)
-                                      .field("T", T)
-                                      .field("H", H)
-                                      .time(t))
-
-                    async with InfluxDBClientAsync(url=db_cfg['url'],
-                                                   token=db_cfg['token'],
-                                                   timeout=db_cfg['timeout'],
-                                                   verify_ssl=db_cfg['verify_ssl']) as client:
-                        write_api = client.write_api()
-                        await write_api.write(bucket, org, points)
-                except Exception:
-                    logger.exception(f"Invalid uplink received {uplink}")
+    # the supervisor only forks and watches, it blocks this (otherwise idle) loop
+    Supervisor(worker, (config, processes),
+               processes=processes,
+               heartbeat_timeout=sup_cfg.get('heartbeat_timeout', 30.0),
+               stop_timeout=sup_cfg.get('stop_timeout', 30.0)).run()
 
 if __name__ == '__main__':
     asyncio.run(main())
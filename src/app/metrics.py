@@ -0,0 +1,215 @@
+from bisect import bisect_left
+import logging
+import math
+from sys import stdout
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+
+logger = logging.getLogger('cloudia-metrics')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+LabelValues = Tuple[str, ...]
+
+# seconds, from 10 us to 10 s
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000)
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, labels: LabelValues = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge set explicitly or, with `fn`, read when the metrics are scraped.
+    `fn` returns a value, or a mapping from label values to values.
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 fn: Optional[Callable[[], Union[float, Mapping[LabelValues, float]]]] = None):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+        self.fns: List[Callable] = [fn] if fn is not None else []
+
+    def set(self, value: float, labels: LabelValues = ()):
+        self.values[labels] = value
+
+    def add_callback(self, fn: Callable[[], Union[float, Mapping[LabelValues, float]]]):
+        self.fns.append(fn)
+
+    def samples(self) -> List[str]:
+        values = dict(self.values)
+        for fn in self.fns:
+            res = fn()
+            if isinstance(res, Mapping):
+                values.update(res)
+            else:
+                values[()] = res
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                for k, v in values.items()]
+
+
+class CallbackCounter(Gauge):
+    """
+    Counter whose value is maintained elsewhere (e.g. an attribute) and read on scrape
+    """
+    type = 'counter'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: [counts per bucket (last one is +Inf)], sum
+        self.values: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, labels: LabelValues = ()):
+        try:
+            entry = self.values[labels]
+        except KeyError:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> List[str]:
+        res: List[str] = []
+        for k, (counts, total) in self.values.items():
+            acc = 0
+            for le, c in zip(self.buckets + (math.inf,), counts):
+                acc += c
+                labels = _format_labels(self.labelnames, k,
+                                        'le="' + _format_value(le) + '"')
+                res.append(f"{self.name}_bucket{labels} {acc}")
+            res.append(
+                f"{self.name}_sum{_format_labels(self.labelnames, k)} {_format_value(total)}")
+            res.append(
+                f"{self.name}_count{_format_labels(self.labelnames, k)} {acc}")
+        return res
+
+
+class Registry():
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(m.render() for m in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+MESSAGES_RECEIVED = REGISTRY.register(Counter(
+    'cloudia_messages_received_total', 'Uplink messages received from the broker'))
+ENVELOPE_FALLBACKS = REGISTRY.register(Counter(
+    'cloudia_envelope_fallbacks_total', 'Uplinks re-parsed in full after the fast parser failed'))
+DUPLICATES = REGISTRY.register(Counter(
+    'cloudia_duplicate_uplinks_total', 'Uplinks dropped as duplicates'))
+DECODE_SECONDS = REGISTRY.register(Histogram(
+    'cloudia_decode_seconds', 'Time spent in decode() per uplink', ('port',)))
+DECODE_FAILURES = REGISTRY.register(Counter(
+    'cloudia_decode_failures_total', 'Uplinks that could not be processed', ('exception',)))
+OUT_OF_RANGE = REGISTRY.register(Counter(
+    'cloudia_out_of_range_total', 'Decoded values outside the variable limits', ('variable',)))
+EPOCHS_PER_UPLINK = REGISTRY.register(Histogram(
+    'cloudia_epochs_per_uplink', 'Epochs decoded per uplink', buckets=SIZE_BUCKETS))
+TRIMMED_EPOCHS = REGISTRY.register(Counter(
+    'cloudia_trimmed_epochs_total', 'Epochs dropped because a previous uplink already carried them'))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'cloudia_queue_depth', 'Items waiting in the pipeline queues', ('queue',)))
+DROPPED = REGISTRY.register(CallbackCounter(
+    'cloudia_pipeline_dropped_total', 'Messages dropped by the drop_oldest policy'))
+SPILLED = REGISTRY.register(CallbackCounter(
+    'cloudia_pipeline_spilled_total', 'Messages spilled to the overflow file'))
+WRITE_SECONDS = REGISTRY.register(Histogram(
+    'cloudia_influxdb_write_seconds', 'InfluxDB write request latency', ('result',)))
+WRITE_BATCH_LINES = REGISTRY.register(Histogram(
+    'cloudia_influxdb_batch_lines', 'Lines per InfluxDB write request', buckets=SIZE_BUCKETS))
+SPOOLED_LINES = REGISTRY.register(Counter(
+    'cloudia_spooled_lines_total', 'Lines sent to the spool'))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'cloudia_stage_seconds', 'Time spent per processing stage, while profiling', ('stage',)))
+
+
+async def start_server(host: str = '127.0.0.1', port: int = 9100,
+                       registry: Registry = REGISTRY, profiler=None):
+    """
+    Serves the registry in the Prometheus text format on http://host:port/metrics.
+    Returns the aiohttp runner, to be cleaned up on shutdown.
+    When a `profiling.Profiler` is given, its admin routes (/profile) are served too.
+    """
+    from aiohttp import web
+
+    async def handler(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(),
+                            content_type='text/plain',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handler)
+    if profiler is not None:
+        from .profiling import add_routes
+        add_routes(app, profiler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,251 @@
+import asyncio
+from enum import Enum
+import logging
+import os
+from pathlib import Path
+import struct
+from sys import stdout
+from typing import Any, Awaitable, Callable, List, Mapping, Optional
+
+
+logger = logging.getLogger('cloudia-pipeline')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+class Backpressure(Enum):
+    block = 'block'
+    drop_oldest = 'drop_oldest'
+    spill = 'spill'
+
+
+class SpillFile():
+    """
+    Append-only overflow file for raw messages that do not fit in the input queue.
+    Records are length-prefixed and read back in the order they were written.
+    The file is truncated once every record has been read back. The records left by a
+    process that did not close the file are recovered on open, a torn last record is
+    discarded.
+    """
+    HEADER = struct.Struct('<I')
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.pending = 0
+        size = self._recover()
+        self._wf = open(self.path, 'ab')
+        self._wf.truncate(size)
+        self._rf = open(self.path, 'rb')
+        if self.pending:
+            logger.info(f"Recovered {self.pending} spilled messages from {self.path}")
+
+    def _recover(self) -> int:
+        """
+        Counts the complete records of an existing file, returns their total size
+        """
+        if not self.path.exists():
+            return 0
+        size = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    break
+                (n,) = self.HEADER.unpack(header)
+                if len(f.read(n)) < n:
+                    break
+                size += self.HEADER.size + n
+                self.pending += 1
+        return size
+
+    def __len__(self) -> int:
+        return self.pending
+
+    def append(self, raw: bytes):
+        self._wf.write(self.HEADER.pack(len(raw)))
+        self._wf.write(raw)
+        self.pending += 1
+
+    def pop(self) -> Optional[bytes]:
+        if not self.pending:
+            return None
+        self._wf.flush()
+        (size,) = self.HEADER.unpack(self._rf.read(self.HEADER.size))
+        raw = self._rf.read(size)
+        self.pending -= 1
+        if not self.pending:
+            self._wf.truncate(0)
+            self._wf.seek(0)
+            self._rf.seek(0)
+        return raw
+
+    def close(self):
+        self._wf.close()
+        self._rf.close()
+        if not self.pending:
+            os.remove(self.path)
+
+
+class Pipeline():
+    """
+    Staged asyncio pipeline decoupling message reception from decoding and writing.
+
+    receiver --put()--> [input queue] --> N workers --> [output queue] --> sink
+
+    Everything runs on the event loop: the workers only interleave where `process`
+    awaits, and the sink runs while the workers process the next messages. A `process`
+    that never awaits (as the uplink decoding) gains nothing from more than one worker;
+    to decode on several cores run several processes (see `supervisor.Supervisor`).
+
+    The input queue is bounded; when it is full `put()` applies the backpressure policy:
+    - block: wait until a worker takes a message
+    - drop_oldest: discard the oldest queued message to make room for the new one
+    - spill: append the message to an overflow file, re-queued once there is room
+
+    Arguments:
+    - process: coroutine turning a raw message into a list of items for the sink
+    - sink: coroutine consuming the items produced by one message
+    - workers: number of processing tasks, interleaved at the awaits of `process`
+    - queue_size: capacity of the input and output queues
+    - backpressure: policy applied when the input queue is full
+    - spill_path: overflow file, required by the spill policy
+    """
+
+    def __init__(self,
+                 process: Callable[[bytes], Awaitable[List[Any]]],
+                 sink: Callable[[List[Any]], Awaitable[None]],
+                 workers: int = 4,
+                 queue_size: int = 10_000,
+                 backpressure: Backpressure = Backpressure.block,
+                 spill_path: Optional[str] = None):
+        if workers < 1:
+            raise ValueError(f"workers must be positive, got {workers}")
+        if backpressure == Backpressure.spill and spill_path is None:
+            raise ValueError("spill backpressure requires a spill_path")
+
+        self.process = process
+        self.sink = sink
+        self.workers = workers
+        self.queue_size = queue_size
+        self.backpressure = backpressure
+        self.spill_path = spill_path
+
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+
+        self._in: Optional[asyncio.Queue] = None
+        self._out: Optional[asyncio.Queue] = None
+        self._spill: Optional[SpillFile] = None
+        self._room: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @classmethod
+    def from_config(cls, process, sink, cfg: Mapping[str, Any]) -> 'Pipeline':
+        return cls(process, sink,
+                   workers=cfg.get('workers', 4),
+                   queue_size=cfg.get('queue_size', 10_000),
+                   backpressure=Backpressure(cfg.get('backpressure', 'block')),
+                   spill_path=cfg.get('spill_path'))
+
+    async def start(self):
+        self._in = asyncio.Queue(maxsize=self.queue_size)
+        self._out = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._work())
+                       for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._write()))
+        if self.backpressure == Backpressure.spill:
+            self._spill = SpillFile(self.spill_path)
+            self._room = asyncio.Event()
+            if len(self._spill):
+                self._room.set()
+            self._tasks.append(asyncio.create_task(self._refill()))
+
+    async def close(self):
+        """
+        Waits for every accepted message to be processed and written, then stops the stages.
+        """
+        if self._spill is not None:
+            while len(self._spill):
+                self._room.set()
+                await asyncio.sleep(0)
+                await self._in.join()
+        await self._in.join()
+        await self._out.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    async def __aenter__(self) -> 'Pipeline':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def qsize(self) -> int:
+        return self._in.qsize()
+
+    def qsizes(self) -> Mapping[str, int]:
+        """
+        Number of items waiting in each stage
+        """
+        res = {'input': self._in.qsize(), 'output': self._out.qsize()}
+        if self._spill is not None:
+            res['spill'] = len(self._spill)
+        return res
+
+    async def put(self, raw: bytes):
+        if self.backpressure == Backpressure.block:
+            await self._in.put(raw)
+        elif self.backpressure == Backpressure.drop_oldest:
+            if self._in.full():
+                self._in.get_nowait()
+                self._in.task_done()
+                self.dropped += 1
+            self._in.put_nowait(raw)
+        else:
+            # keep ordering: once something is spilled, new messages queue up behind it
+            if len(self._spill) or self._in.full():
+                self._spill.append(raw)
+                self.spilled += 1
+            else:
+                self._in.put_nowait(raw)
+
+    async def _refill(self):
+        while True:
+            await self._room.wait()
+            self._room.clear()
+            while len(self._spill) and not self._in.full():
+                self._in.put_nowait(self._spill.pop())
+
+    async def _work(self):
+        while True:
+            raw = await self._in.get()
+            try:
+                items = await self.process(raw)
+                if items:
+                    await self._out.put(items)
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Failed to process message {raw!r}")
+            finally:
+                self._in.task_done()
+                if self._room is not None:
+                    self._room.set()
+
+    async def _write(self):
+        while True:
+            items = await self._out.get()
+            try:
+                await self.sink(items)
+            except Exception:
+                logger.exception(f"Sink failed on {len(items)} items")
+            finally:
+                self._out.task_done()
@@ -0,0 +1,172 @@
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import os
+from pathlib import Path
+import pstats
+from sys import stdout
+import time
+from typing import Any, Awaitable, Callable, Mapping, Optional
+
+from . import metrics
+
+
+logger = logging.getLogger('cloudia-profiling')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+class Spans():
+    """
+    Per-stage timings of the uplink processing (envelope parse, decoding, trimming,
+    serialization, sink write), recorded in `metrics.STAGE_SECONDS`.
+    Disabled spans cost a single attribute check per uplink.
+    """
+    __slots__ = ('enabled',)
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+
+    def mark(self, stage: str, since: float) -> float:
+        """
+        Records the time elapsed since `since` for `stage`, returns the current time
+        """
+        now = time.perf_counter()
+        metrics.STAGE_SECONDS.observe(now - since, (stage,))
+        return now
+
+    def timed(self, stage: str,
+              fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        """
+        Wraps a coroutine function so that its calls are timed while enabled
+        """
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return await fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.mark(stage, t0)
+
+        return wrapper
+
+
+class Profiler():
+    """
+    Runs cProfile in the event loop thread for a limited time, on demand (signal or
+    admin route), and dumps the stats to `{directory}/cloudia-{pid}-{time}.prof`
+    (readable with pstats or snakeviz). Stage spans are enabled meanwhile.
+
+    Arguments:
+    - directory: where the stats are written
+    - duration: default profiling duration in seconds
+    - max_duration: longest duration accepted
+    - spans: stage timings enabled while profiling
+    """
+
+    def __init__(self, directory: str = '.', duration: float = 30.0,
+                 max_duration: float = 600.0, spans: Optional[Spans] = None):
+        self.directory = Path(directory)
+        self.duration = duration
+        self.max_duration = max_duration
+        self.spans = spans or Spans()
+        self.path: Optional[Path] = None
+        self._profile: Optional[cProfile.Profile] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._spans_were_enabled = False
+
+    @classmethod
+    def from_config(cls, cfg: Mapping[str, Any], spans: Optional[Spans] = None) -> 'Profiler':
+        return cls(directory=cfg.get('directory', '.'),
+                   duration=cfg.get('duration', 30.0),
+                   max_duration=cfg.get('max_duration', 600.0),
+                   spans=spans)
+
+    @property
+    def active(self) -> bool:
+        return self._profile is not None
+
+    def start(self, duration: Optional[float] = None) -> Path:
+        """
+        Starts profiling for `duration` seconds (the default duration if None), the
+        stats are dumped when it elapses or on `stop()`. Returns the stats file.
+        """
+        if self.active:
+            raise RuntimeError(f"Already profiling to {self.path}")
+        duration = self.duration if duration is None else duration
+        if not 0 < duration <= self.max_duration:
+            raise ValueError(f"Duration must be in (0, {self.max_duration}] s, got {duration}")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / f"cloudia-{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}.prof"
+        self._spans_were_enabled = self.spans.enabled
+        self.spans.enabled = True
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self._timer = asyncio.get_running_loop().call_later(duration, self.stop)
+        logger.info(f"Profiling for {duration} s to {self.path}")
+        return self.path
+
+    def stop(self) -> Optional[Path]:
+        """
+        Stops profiling and dumps the stats, returns the stats file (None if not profiling)
+        """
+        if not self.active:
+            return None
+        self._profile.disable()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.spans.enabled = self._spans_were_enabled
+        self._profile.dump_stats(self.path)
+        out = io.StringIO()
+        pstats.Stats(self._profile, stream=out).sort_stats('cumulative').print_stats(15)
+        logger.info(f"Profile written to {self.path}\n{out.getvalue()}")
+        self._profile = None
+        return self.path
+
+    def toggle(self) -> Optional[Path]:
+        """
+        Starts profiling for the default duration, or stops the current profile
+        """
+        if self.active:
+            return self.stop()
+        return self.start()
+
+    def install_signal(self, signum: int):
+        """
+        Toggles profiling when the process receives `signum` (e.g. SIGUSR1)
+        """
+        asyncio.get_running_loop().add_signal_handler(signum, self.toggle)
+
+
+def add_routes(app, profiler: Profiler):
+    """
+    Admin routes of the metrics server:
+    - POST /profile?duration=s: starts profiling
+    - DELETE /profile: stops profiling and dumps the stats
+    """
+    from aiohttp import web
+
+    async def start(request: web.Request) -> web.Response:
+        try:
+            duration = request.query.get('duration')
+            path = profiler.start(float(duration) if duration else None)
+        except ValueError as ex:
+            return web.json_response({'error': str(ex)}, status=400)
+        except RuntimeError as ex:
+            return web.json_response({'error': str(ex)}, status=409)
+        return web.json_response({'path': str(path)}, status=202)
+
+    async def stop(request: web.Request) -> web.Response:
+        path = profiler.stop()
+        if path is None:
+            return web.json_response({'error': "Not profiling"}, status=409)
+        return web.json_response({'path': str(path)})
+
+    app.router.add_post('/profile', start)
+    app.router.add_delete('/profile', stop)
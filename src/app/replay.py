@@ -0,0 +1,287 @@
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import gzip
+import json
+import logging
+import os
+from pathlib import Path
+from sys import stdout
+import time
+from typing import Any, Deque, Iterator, List, Mapping, Optional, Tuple
+
+from .config import load_config
+from .decoder import decode_columnar, DEFAULT_SCHEMA
+from .envelope import make_parser
+from .lineproto import LineProtocolEncoder
+from .schema import SchemaRegistry
+from .timebase import parse_received_at_ns
+
+
+logger = logging.getLogger('cloudia-replay')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+@dataclass
+class ChunkResult():
+    lines: bytes
+    messages: int
+    epochs: int
+    failed: int
+
+
+_registry: Optional[SchemaRegistry] = None
+_parse = make_parser()
+
+
+def _init_worker(schemas_cfg: Mapping[str, Any]):
+    global _registry
+    _registry = SchemaRegistry.from_config(schemas_cfg, default=DEFAULT_SCHEMA)
+    logging.getLogger('cloudia-decoder').setLevel(logging.WARNING)
+
+
+def decode_chunk(lines: List[bytes]) -> ChunkResult:
+    """
+    Decodes a chunk of archived uplinks (one TTN uplink document per line) into
+    line protocol. Epochs are timed from the uplink reception time.
+    """
+    enc = LineProtocolEncoder()
+    epochs, failed = 0, 0
+    for line in lines:
+        try:
+            uplink = _parse(line)
+            deveui = uplink.dev_eui
+            schema = _registry.for_device(deveui)
+            cols = decode_columnar(uplink.f_port, uplink.frm_payload,
+                                   now=parse_received_at_ns(uplink.received_at),
+                                   schema=schema, registry=_registry)
+            enc.add_columns(schema, {"deveui": deveui}, cols)
+            epochs += len(cols)
+        except Exception:
+            failed += 1
+    return ChunkResult(lines=enc.take(), messages=len(lines), epochs=epochs, failed=failed)
+
+
+def list_sources(path: Path) -> List[Path]:
+    """
+    JSONL archives to replay: the file itself, or every .jsonl / .jsonl.gz file
+    below a directory, in name order
+    """
+    if path.is_dir():
+        return sorted(p for p in path.rglob('*')
+                      if p.is_file() and (p.name.endswith('.jsonl') or p.name.endswith('.jsonl.gz')))
+    return [path]
+
+
+def iter_chunks(sources: List[Path],
+                chunk_size: int,
+                checkpoint: Optional[Mapping[str, Any]] = None) -> Iterator[Tuple[str, int, List[bytes]]]:
+    """
+    Streams the archives in chunks of at most `chunk_size` non-empty lines.
+    Yields (source, number of the last line of the chunk, lines). Everything up to the
+    checkpoint is skipped.
+    """
+    start, skip = 0, 0
+    if checkpoint is not None:
+        names = [str(s) for s in sources]
+        if checkpoint['source'] in names:
+            start = names.index(checkpoint['source'])
+            skip = checkpoint['line']
+
+    for i, src in enumerate(sources[start:]):
+        skip_lines = skip if i == 0 else 0
+        opener = gzip.open if src.name.endswith('.gz') else open
+        with opener(src, 'rb') as f:
+            chunk: List[bytes] = []
+            line_no = 0
+            for line in f:
+                line_no += 1
+                if line_no <= skip_lines:
+                    continue
+                line = line.strip()
+                if line:
+                    chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    yield str(src), line_no, chunk
+                    chunk = []
+            if chunk:
+                yield str(src), line_no, chunk
+
+
+class FileSink():
+    """
+    Writes line protocol to files in a directory, starting a new file every `max_bytes`
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._index = len(list(self.directory.glob('replay-*.lp')))
+        self._file = None
+        self._size = 0
+
+    def _roll(self):
+        if self._file is not None:
+            self._file.close()
+        self._index += 1
+        self._file = open(self.directory / f"replay-{self._index:06d}.lp", 'ab')
+        self._size = 0
+
+    async def write(self, lines: bytes):
+        if self._file is None or self._size >= self.max_bytes:
+            self._roll()
+        self._file.write(lines)
+        self._size += len(lines)
+
+    async def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    async def close(self):
+        await self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_checkpoint(path: Optional[str]) -> Optional[Mapping[str, Any]]:
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, source: str, line: int):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump({'source': source, 'line': line}, f)
+    os.replace(tmp, path)
+
+
+async def replay(sources: List[Path],
+                 sink,
+                 schemas_cfg: Mapping[str, Any],
+                 workers: Optional[int] = None,
+                 chunk_size: int = 5000,
+                 checkpoint_path: Optional[str] = None,
+                 checkpoint_every: int = 20,
+                 progress_interval: float = 5.0):
+    """
+    Decodes the archives on a process pool and writes the result to `sink`.
+    Chunks are written in input order; the checkpoint is only advanced once the sink
+    has persisted everything before it. A failing `sink.sync()` stops the replay with
+    the checkpoint left before the lines that could not be written.
+    """
+    loop = asyncio.get_running_loop()
+    workers = workers or os.cpu_count() or 1
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is not None:
+        logger.info(
+            f"Resuming after line {checkpoint['line']} of {checkpoint['source']}")
+
+    messages, epochs, failed, done = 0, 0, 0, 0
+    started = last_report = time.monotonic()
+    pending: Deque[Tuple[str, int, asyncio.Future]] = deque()
+
+    async def consume():
+        nonlocal messages, epochs, failed, done, last_report
+        src, line_no, fut = pending.popleft()
+        res: ChunkResult = await fut
+        await sink.write(res.lines)
+        messages += res.messages
+        epochs += res.epochs
+        failed += res.failed
+        done += 1
+        if checkpoint_path is not None and done % checkpoint_every == 0:
+            await sink.sync()
+            save_checkpoint(checkpoint_path, src, line_no)
+        now = time.monotonic()
+        if now - last_report >= progress_interval:
+            last_report = now
+            elapsed = now - started
+            logger.info(f"{src}:{line_no} - {messages} uplinks ({messages / elapsed:,.0f}/s), "
+                        f"{epochs} epochs ({epochs / elapsed:,.0f}/s), {failed} failed")
+        return src, line_no
+
+    last: Optional[Tuple[str, int]] = None
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(schemas_cfg,)) as pool:
+        for src, line_no, lines in iter_chunks(sources, chunk_size, checkpoint):
+            pending.append((src, line_no,
+                            loop.run_in_executor(pool, decode_chunk, lines)))
+            if len(pending) >= 2 * workers:
+                last = await consume()
+        while pending:
+            last = await consume()
+
+    await sink.sync()
+    if checkpoint_path is not None and last is not None:
+        save_checkpoint(checkpoint_path, *last)
+
+    elapsed = time.monotonic() - started
+    logger.info(f"Replayed {messages} uplinks, {epochs} epochs in {elapsed:.1f} s "
+                f"({messages / max(elapsed, 1e-9):,.0f} uplinks/s), {failed} failed")
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Re-ingest archived TTN uplinks (JSONL)")
+    parser.add_argument("config", type=str, help="Configuration file")
+    parser.add_argument("path", type=str,
+                        help="JSONL archive or directory of archives")
+    out = parser.add_mutually_exclusive_group(required=True)
+    out.add_argument("--influx", action="store_true",
+                     help="Write to the configured InfluxDB")
+    out.add_argument("--out", type=str,
+                     help="Write line-protocol files to this directory")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Decoding processes (default: number of cores)")
+    parser.add_argument("--chunk-size", type=int, default=5000,
+                        help="Uplinks per decoding task")
+    parser.add_argument("--batch-size", type=int, default=50_000,
+                        help="Lines per InfluxDB write request")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="Checkpoint file, replay resumes from it if it exists")
+
+    try:
+        args = parser.parse_args()
+    except Exception as ex:
+        logger.error("Argument parsing failed!")
+        raise ex
+
+    try:
+        config = load_config(args.config)
+    except Exception as ex:
+        logging.error("Invalid configuration file!")
+        raise ex
+
+    if args.influx:
+        from .writer import InfluxWriter
+
+        # without the spool of the ingest service: failed writes stop the replay, which
+        # resumes from its checkpoint
+        db_cfg = dict(config['influxdb'], batch_size=args.batch_size, spool=None)
+        sink = InfluxWriter.from_config(db_cfg)
+        await sink.start()
+    else:
+        sink = FileSink(args.out)
+
+    try:
+        await replay(list_sources(Path(args.path)),
+                     sink,
+                     config.get('schemas', {}),
+                     workers=args.workers,
+                     chunk_size=args.chunk_size,
+                     checkpoint_path=args.checkpoint)
+    finally:
+        await sink.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
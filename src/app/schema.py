@@ -0,0 +1,220 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+from typing import Any, Callable, Generic, Hashable, List, Mapping, Optional, Tuple, TypeVar
+
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+@dataclass(frozen=True)
+class VarSpec():
+    """
+    A variable of a device profile.
+    `key` is the key of the variable in the decoded epochs.
+    """
+    key: int
+    name: str
+    nbits_v0: int
+    signed: bool
+    scale: float
+    limits: Tuple[float, float]
+
+
+@dataclass(frozen=True)
+class Schema():
+    """
+    Ordered list of the variables sent, bit-squeezed, in each epoch by a device profile
+    """
+    name: str
+    vars: Tuple[VarSpec, ...]
+
+    @classmethod
+    def from_config(cls, name: str, cfg: List[Mapping[str, Any]]) -> 'Schema':
+        return cls(name=name,
+                   vars=tuple(VarSpec(key=i,
+                                      name=v['name'],
+                                      nbits_v0=v['nbits'],
+                                      signed=v.get('signed', False),
+                                      scale=v.get('scale', 1.0),
+                                      limits=tuple(v.get('limits', (float('-inf'), float('inf')))))
+                              for i, v in enumerate(cfg)))
+
+
+@dataclass(frozen=True)
+class Field():
+    """
+    Position of a variable within an epoch
+    """
+    offset: int
+    nbits: int
+    signed: bool
+
+
+@dataclass(frozen=True)
+class DecodePlan():
+    """
+    Compiled bit layout of a payload: everything that only depends on the schema,
+    the port and the diff widths, computed once.
+
+    - fields_v0: fields of the first epoch
+    - fields_vi: fields of the following epochs (zero-width fields take no bits)
+    - width_v0, width_vi: width in bits of the first and following epochs
+    """
+    schema: Schema
+    port: int
+    use_diffs: bool
+    nbits_vi: Tuple[int, ...]
+    fields_v0: Tuple[Field, ...]
+    fields_vi: Tuple[Field, ...]
+    width_v0: int
+    width_vi: int
+    scales: Tuple[float, ...]
+    limits: Tuple[Tuple[float, float], ...]
+    keys: Tuple[int, ...]
+
+    def nepochs(self, nbits: int) -> int:
+        """
+        Number of epochs held in a buffer of `nbits` bits
+        """
+        if self.width_v0 > nbits:
+            return 0
+        if self.width_vi < 1:
+            return 1
+        return 1 + (nbits - self.width_v0) // self.width_vi
+
+
+def _fields(widths: List[Tuple[int, bool]]) -> Tuple[Tuple[Field, ...], int]:
+    fields: List[Field] = []
+    pos = 0
+    for nbits, signed in widths:
+        fields.append(Field(offset=pos, nbits=nbits, signed=signed))
+        if nbits > 0:
+            pos += nbits + (1 if signed else 0)
+    return tuple(fields), pos
+
+
+def compile_plan(schema: Schema, port: int, use_diffs: bool,
+                 nbits_vi: Tuple[int, ...]) -> DecodePlan:
+    if len(nbits_vi) != len(schema.vars):
+        raise ValueError(
+            f"Schema {schema.name} has {len(schema.vars)} variables, got {len(nbits_vi)} widths")
+    fields_v0, width_v0 = _fields([(v.nbits_v0, v.signed)
+                                   for v in schema.vars])
+    fields_vi, width_vi = _fields([(n, v.signed or use_diffs)
+                                   for n, v in zip(nbits_vi, schema.vars)])
+    return DecodePlan(schema=schema,
+                      port=port,
+                      use_diffs=use_diffs,
+                      nbits_vi=nbits_vi,
+                      fields_v0=fields_v0,
+                      fields_vi=fields_vi,
+                      width_v0=width_v0,
+                      width_vi=width_vi,
+                      scales=tuple(v.scale for v in schema.vars),
+                      limits=tuple(v.limits for v in schema.vars),
+                      keys=tuple(v.key for v in schema.vars))
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Thread-safe LRU cache computing missing entries with `factory`.
+    """
+
+    def __init__(self, factory: Callable[..., V], maxsize: int = 256):
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be positive, got {maxsize}")
+        self.factory = factory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: 'OrderedDict[K, V]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, *key) -> V:
+        with self._lock:
+            try:
+                value = self._data[key]
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+
+        value = self.factory(*key)
+        with self._lock:
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+
+class SchemaRegistry():
+    """
+    Maps devices to schemas and hands out cached decode plans.
+    Devices are matched by the longest configured dev_eui prefix (a full dev_eui
+    being the longest prefix); unmatched devices use the default schema.
+
+    Arguments:
+    - schemas: schemas by name
+    - devices: schema name by dev_eui prefix
+    - default: name of the default schema
+    - cache_size: maximum number of cached decode plans (and device lookups)
+    """
+
+    def __init__(self,
+                 schemas: Mapping[str, Schema],
+                 devices: Optional[Mapping[str, str]] = None,
+                 default: Optional[str] = None,
+                 cache_size: int = 256):
+        self.schemas = dict(schemas)
+        devices = devices or {}
+        for prefix, name in devices.items():
+            if name not in self.schemas:
+                raise ValueError(
+                    f"Device prefix {prefix} uses unknown schema {name}")
+        if default not in self.schemas:
+            raise ValueError(f"Unknown default schema {default}")
+        self.default = self.schemas[default]
+        # longest prefixes first
+        self.prefixes: List[Tuple[str, Schema]] = sorted(
+            ((p.upper(), self.schemas[n]) for p, n in devices.items()),
+            key=lambda x: -len(x[0]))
+        self.plans: LRUCache[Tuple, DecodePlan] = LRUCache(
+            compile_plan, maxsize=cache_size)
+        self._devices: LRUCache[Tuple, Schema] = LRUCache(
+            self._lookup, maxsize=cache_size)
+
+    @classmethod
+    def from_config(cls, cfg: Mapping[str, Any], default: Schema) -> 'SchemaRegistry':
+        """
+        Builds the registry from the `schemas` configuration section.
+        `default` is used when the section does not define a default schema.
+        """
+        schemas = {default.name: default}
+        for name, vars in cfg.get('profiles', {}).items():
+            schemas[name] = Schema.from_config(name, vars)
+        return cls(schemas,
+                   devices=cfg.get('devices', {}),
+                   default=cfg.get('default', default.name),
+                   cache_size=cfg.get('plan_cache_size', 256))
+
+    def _lookup(self, dev_eui: str) -> Schema:
+        dev_eui = dev_eui.upper()
+        for prefix, schema in self.prefixes:
+            if dev_eui.startswith(prefix):
+                return schema
+        return self.default
+
+    def for_device(self, dev_eui: Optional[str]) -> Schema:
+        if dev_eui is None or not self.prefixes:
+            return self.default
+        return self._devices.get(dev_eui)
+
+    def plan(self, schema: Schema, port: int, use_diffs: bool,
+             nbits_vi: Tuple[int, ...]) -> DecodePlan:
+        return self.plans.get(schema, port, use_diffs, nbits_vi)
@@ -0,0 +1,120 @@
+from collections import deque
+import logging
+import os
+from pathlib import Path
+import struct
+from sys import stdout
+from typing import Deque, Iterator, Optional
+import zlib
+
+
+logger = logging.getLogger('cloudia-spool')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+class Spool():
+    """
+    Durable, append-only queue of records (batches of line protocol) split in segment files.
+
+    Records are appended sequentially to the active segment, which is closed once it
+    reaches `segment_bytes`. Segments are consumed oldest first and deleted once
+    acknowledged. Segments left over by a previous process are picked up on start;
+    new records always go to a new segment.
+
+    Each record is stored as (length, crc32, data); a torn or corrupt tail, e.g. after a
+    crash, ends the segment.
+
+    Arguments:
+    - directory: where the segments are stored
+    - segment_bytes: size at which the active segment is closed
+    """
+    HEADER = struct.Struct('<II')
+    SUFFIX = '.seg'
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+
+        existing = sorted(self.directory.glob(f"*{self.SUFFIX}"))
+        self._closed: Deque[Path] = deque(existing)
+        self._next = int(existing[-1].stem) + 1 if existing else 0
+        self._active = None
+        self._active_path: Optional[Path] = None
+        self._active_size = 0
+        if existing:
+            logger.info(f"Found {len(existing)} undrained spool segments")
+
+    def __len__(self) -> int:
+        """
+        Number of segments waiting to be drained
+        """
+        return len(self._closed) + (1 if self._active_size else 0)
+
+    def _close_active(self):
+        if self._active is None:
+            return
+        self._active.close()
+        if self._active_size:
+            self._closed.append(self._active_path)
+        else:
+            os.remove(self._active_path)
+        self._active = None
+        self._active_path = None
+        self._active_size = 0
+
+    def append(self, data: bytes):
+        if self._active is not None and self._active_size >= self.segment_bytes:
+            self._close_active()
+        if self._active is None:
+            self._active_path = self.directory / \
+                f"{self._next:012d}{self.SUFFIX}"
+            self._next += 1
+            self._active = open(self._active_path, 'ab')
+        self._active.write(self.HEADER.pack(len(data), zlib.crc32(data)))
+        self._active.write(data)
+        self._active.flush()
+        self._active_size += self.HEADER.size + len(data)
+
+    def next_segment(self) -> Optional[Path]:
+        """
+        Oldest segment to drain, closing the active segment if nothing else is pending
+        """
+        if not self._closed:
+            if not self._active_size:
+                return None
+            self._close_active()
+        return self._closed[0]
+
+    def ack(self, path: Path):
+        """
+        Deletes a fully drained segment
+        """
+        if self._closed and self._closed[0] == path:
+            self._closed.popleft()
+        os.remove(path)
+
+    @classmethod
+    def read(cls, path: Path) -> Iterator[bytes]:
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(cls.HEADER.size)
+                if not header:
+                    return
+                if len(header) < cls.HEADER.size:
+                    logger.warning(f"Truncated record header in {path}")
+                    return
+                size, crc = cls.HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size or zlib.crc32(data) != crc:
+                    logger.warning(f"Corrupt or truncated record in {path}")
+                    return
+                yield data
+
+    def close(self):
+        """
+        Closes the active segment, undrained segments stay on disk
+        """
+        self._close_active()
@@ -0,0 +1,135 @@
+from array import array
+from collections import OrderedDict
+import json
+import logging
+import os
+from pathlib import Path
+from sys import stdout
+from typing import Any, Mapping, Optional
+
+from . import metrics
+from .decoder import Columns
+
+
+logger = logging.getLogger('cloudia-state')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+class DeviceState():
+    """
+    Last known state of a device
+
+    - last_t: timestamp (ns) of the newest epoch written
+    - values: values of that epoch, in schema order
+    - vbat: last reported battery voltage
+    - period: last reported sampling period (ns)
+    """
+    __slots__ = ('last_t', 'values', 'vbat', 'period')
+
+    def __init__(self, last_t: int, values: array, vbat: Optional[float], period: int):
+        self.last_t = last_t
+        self.values = values
+        self.vbat = vbat
+        self.period = period
+
+
+class StateTable():
+    """
+    Per-device state used to drop the epochs already written by a previous uplink:
+    multi-measurement uplinks often overlap (retransmissions, period changes).
+
+    At most `max_devices` devices are kept, the least recently updated one is
+    forgotten first. The table can be snapshotted to `path` and is reloaded from
+    it on start, so a restart does not rewrite the last buffers of every device.
+
+    A device advances when its epochs are handed to the sinks, not when they are
+    written: if a write then fails without an InfluxDB spool, a later overlapping
+    uplink does not bring those epochs back. Enable the spool to close that window.
+
+    Arguments:
+    - max_devices: maximum number of devices kept in memory
+    - path: snapshot file, None to keep the table in memory only
+    """
+
+    def __init__(self, max_devices: int = 100_000, path: Optional[str] = None):
+        if max_devices < 1:
+            raise ValueError(f"max_devices must be positive, got {max_devices}")
+        self.max_devices = max_devices
+        self.path = path
+        self._devices: 'OrderedDict[str, DeviceState]' = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    @classmethod
+    def from_config(cls, cfg: Mapping[str, Any]) -> 'StateTable':
+        return cls(max_devices=cfg.get('max_devices', 100_000),
+                   path=cfg.get('path'))
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def get(self, dev_eui: str) -> Optional[DeviceState]:
+        return self._devices.get(dev_eui)
+
+    def trim(self, dev_eui: str, columns: Columns) -> Columns:
+        """
+        Returns the epochs newer than the last one written for the device (by more than
+        half a sampling period) and records the newest of them
+        """
+        n = len(columns)
+        state = self._devices.get(dev_eui)
+        if state is not None:
+            self._devices.move_to_end(dev_eui)
+            t = columns.t
+            # epoch times follow the reception time, which jitters from uplink to uplink:
+            # an epoch within half a period of the last one written is that same sample
+            limit = state.last_t + columns.period // 2
+            # epochs come newest first
+            keep = 0
+            while keep < n and t[keep] > limit:
+                keep += 1
+            if keep < n:
+                metrics.TRIMMED_EPOCHS.inc(n - keep)
+                columns = columns.head(keep)
+                n = keep
+            state.vbat = columns.vbat
+            state.period = columns.period
+            if n:
+                state.last_t = columns.t[0]
+                state.values = array('d', (col[0] for col in columns.values))
+        elif n:
+            self._devices[dev_eui] = DeviceState(columns.t[0],
+                                                 array('d', (col[0] for col in columns.values)),
+                                                 columns.vbat, columns.period)
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        return columns
+
+    def snapshot(self, path: Optional[str] = None):
+        """
+        Atomically writes the table to `path` (defaults to the configured path)
+        """
+        path = path or self.path
+        if path is None:
+            return
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({dev: [s.last_t, list(s.values), s.vbat, s.period]
+                       for dev, s in self._devices.items()}, f)
+        os.replace(tmp, path)
+
+    def load(self, path: str):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as ex:
+            logger.warning(f"Ignoring unreadable state snapshot {path}: {ex!r}")
+            return
+        for dev, (last_t, values, vbat, period) in data.items():
+            self._devices[dev] = DeviceState(last_t, array('d', values), vbat, period)
+        while len(self._devices) > self.max_devices:
+            self._devices.popitem(last=False)
+        logger.info(f"Loaded the state of {len(self._devices)} devices from {path}")
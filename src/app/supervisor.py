@@ -0,0 +1,178 @@
+from dataclasses import dataclass
+import logging
+import multiprocessing
+import signal
+from sys import stdout
+import time
+from typing import Any, Callable, List, Optional, Sequence
+import zlib
+
+
+logger = logging.getLogger('cloudia-supervisor')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+@dataclass(frozen=True)
+class Shard():
+    """
+    Slice of the fleet handled by one worker process: devices are assigned by a stable
+    hash of their id, so every uplink of a device goes to the same worker, in order.
+    """
+    index: int
+    count: int
+
+    def owns(self, device_id: str) -> bool:
+        return self.count == 1 or zlib.crc32(device_id.encode()) % self.count == self.index
+
+
+def device_from_topic(topic: str) -> str:
+    """
+    Device id of an uplink topic: v3/{appid}/devices/{device_id}/up
+    """
+    return topic.split('/', 4)[3]
+
+
+def uplink_topic(appid: str, sharing: Optional[str] = None, group: str = 'cloudia') -> str:
+    """
+    Topic to subscribe to, with `sharing` == 'shared' the broker spreads the uplinks
+    over the members of `group` (MQTT 5 / mosquitto shared subscription)
+    """
+    topic = f"v3/{appid}/devices/+/up"
+    if sharing == 'shared':
+        return f"$share/{group}/{topic}"
+    return topic
+
+
+class Supervisor():
+    """
+    Runs `target(index, heartbeat, *args)` in `processes` worker processes and keeps
+    them alive.
+
+    Workers must store `time.monotonic()` in `heartbeat[index]` regularly. A worker that
+    exits, or whose heartbeat is older than `heartbeat_timeout`, is terminated and
+    restarted. Workers dying shortly after they started are restarted with an
+    exponential backoff.
+
+    Arguments:
+    - target: worker entry point, a module level function
+    - args: extra arguments passed to `target`
+    - processes: number of workers
+    - heartbeat_timeout: time (in seconds) without heartbeat after which a worker is restarted
+    - restart_delay: initial delay before restarting a crashed worker
+    - max_restart_delay: upper bound of the restart backoff
+    - min_uptime: workers running at least this long reset their backoff
+    - stop_timeout: time (in seconds) a terminated worker is given to flush its buffers
+      before it is killed
+    """
+
+    def __init__(self,
+                 target: Callable[..., None],
+                 args: Sequence[Any] = (),
+                 processes: int = 2,
+                 heartbeat_timeout: float = 30.0,
+                 restart_delay: float = 1.0,
+                 max_restart_delay: float = 60.0,
+                 min_uptime: float = 10.0,
+                 stop_timeout: float = 30.0):
+        if processes < 1:
+            raise ValueError(f"processes must be positive, got {processes}")
+        self.target = target
+        self.args = tuple(args)
+        self.processes = processes
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.stop_timeout = stop_timeout
+        self.restarts = 0
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self.heartbeat = self._ctx.Array('d', processes, lock=False)
+        self._workers: List[Optional[multiprocessing.process.BaseProcess]] = [None] * processes
+        self._started = [0.0] * processes
+        self._delay = [restart_delay] * processes
+        self._restart_at: List[Optional[float]] = [None] * processes
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        now = time.monotonic()
+        self.heartbeat[index] = now
+        p = self._ctx.Process(target=self.target,
+                              args=(index, self.heartbeat) + self.args,
+                              name=f"cloudia-worker-{index}",
+                              daemon=True)
+        p.start()
+        self._workers[index] = p
+        self._started[index] = now
+        self._restart_at[index] = None
+        logger.info(f"Started worker {index} (pid {p.pid})")
+
+    def _kill(self, index: int):
+        p = self._workers[index]
+        if p is None:
+            return
+        if p.is_alive():
+            # SIGTERM: the worker drains its pipeline and flushes its sinks
+            p.terminate()
+            p.join(self.stop_timeout)
+            if p.is_alive():
+                p.kill()
+                p.join()
+        self._workers[index] = None
+
+    def start(self):
+        for i in range(self.processes):
+            self._spawn(i)
+
+    def check(self):
+        """
+        Restarts dead or stalled workers, called periodically by `run()`
+        """
+        now = time.monotonic()
+        for i, p in enumerate(self._workers):
+            if p is None:
+                if self._restart_at[i] is not None and now >= self._restart_at[i]:
+                    self.restarts += 1
+                    self._spawn(i)
+                continue
+
+            if not p.is_alive():
+                logger.warning(f"Worker {i} (pid {p.pid}) exited with code {p.exitcode}")
+            elif now - self.heartbeat[i] > self.heartbeat_timeout:
+                logger.warning(f"Worker {i} (pid {p.pid}) missed its heartbeat, restarting")
+            else:
+                continue
+
+            self._kill(i)
+            if now - self._started[i] >= self.min_uptime:
+                self._delay[i] = self.restart_delay
+            self._restart_at[i] = now + self._delay[i]
+            self._delay[i] = min(self._delay[i] * 2, self.max_restart_delay)
+
+    def alive(self) -> int:
+        return sum(1 for p in self._workers if p is not None and p.is_alive())
+
+    def stop(self):
+        self._stopping = True
+        for i in range(self.processes):
+            self._kill(i)
+
+    def run(self, check_interval: float = 1.0):
+        """
+        Starts the workers and supervises them until SIGINT or SIGTERM
+        """
+        def on_signal(signum, frame):
+            self._stopping = True
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+        self.start()
+        try:
+            while not self._stopping:
+                time.sleep(check_interval)
+                self.check()
+        finally:
+            logger.info("Stopping workers")
+            self.stop()
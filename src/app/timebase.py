@@ -0,0 +1,76 @@
+import datetime
+import re
+import time
+from typing import Optional, Union
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+NS_PER_S = 1_000_000_000
+
+_SECOND = datetime.timedelta(seconds=1)
+_RFC3339 = re.compile(
+    r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)$")
+
+# naive UTC datetime or integer nanoseconds since the epoch
+TimeBase = Union[datetime.datetime, int]
+
+
+def parse_received_at_ns(value: str) -> int:
+    """
+    Parses an LNS RFC 3339 timestamp into integer nanoseconds since the epoch,
+    keeping its full (nanosecond) precision
+    """
+    m = _RFC3339.match(value)
+    if not m:
+        raise ValueError(f"Invalid timestamp {value}")
+    base, frac, tz = m.groups()
+    t = datetime.datetime.fromisoformat(base + ('+00:00' if tz == 'Z' else tz))
+    secs = (t - EPOCH.replace(tzinfo=datetime.timezone.utc)) // _SECOND
+    return secs * NS_PER_S + int((frac or '0')[:9].ljust(9, '0'))
+
+
+def parse_received_at(value: str) -> datetime.datetime:
+    """
+    Parses an LNS RFC 3339 timestamp (nanosecond precision) into a naive UTC datetime
+    """
+    return to_datetime(parse_received_at_ns(value))
+
+
+def to_ns(t: datetime.datetime) -> int:
+    """
+    Integer nanoseconds since the epoch of a naive UTC (or aware) datetime
+    """
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return ((t - EPOCH) // datetime.timedelta(microseconds=1)) * 1000
+
+
+def to_datetime(ns: int) -> datetime.datetime:
+    """
+    Naive UTC datetime (microsecond precision) of integer nanoseconds since the epoch
+    """
+    return EPOCH + datetime.timedelta(microseconds=ns // 1000)
+
+
+def base_ns(now: Optional[TimeBase] = None) -> int:
+    """
+    Time base of an uplink in nanoseconds, the current time if not given
+    """
+    if now is None:
+        return time.time_ns()
+    if isinstance(now, datetime.datetime):
+        return to_ns(now)
+    return now
+
+
+def received_ns(value: Optional[str]) -> int:
+    """
+    Reception time of an uplink, falling back to the current time when the LNS
+    timestamp is missing or invalid
+    """
+    if value:
+        try:
+            return parse_received_at_ns(value)
+        except ValueError:
+            pass
+    return time.time_ns()
@@ -0,0 +1,251 @@
+import asyncio
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+import logging
+from sys import stdout
+import time
+from typing import Any, Mapping, Optional, Set
+
+from . import metrics
+from .spool import Spool
+
+
+logger = logging.getLogger('cloudia-writer')
+consoleHandler = logging.StreamHandler(stdout)
+logger.addHandler(consoleHandler)
+logger.setLevel(logging.DEBUG)
+
+
+class InfluxWriter():
+    """
+    Long-lived, batching InfluxDB writer.
+    A single client is opened for the lifetime of the writer. Line-protocol lines coming
+    from many uplinks are collected and flushed either when `batch_size` lines are
+    buffered or every `flush_interval` seconds, whichever comes first. At most
+    `max_inflight` writes are pending at any time; further flushes wait for a slot.
+    Remaining lines are flushed when the writer is closed.
+
+    With a spool, batches that fail, or that find every write slot busy, are appended to
+    the spool instead of being dropped or waited for. While the database is failing new
+    batches go straight to the spool. A background task drains the spool, oldest
+    segment first, retrying with exponential backoff. Records may be written twice if
+    the process stops in the middle of a segment, which InfluxDB treats as an overwrite.
+    Without a spool, failed batches are logged and counted in `lost`; the next `sync()`
+    raises, so that callers tracking their progress do not move past them.
+
+    Arguments:
+    - url, token, org, bucket: InfluxDB connection parameters
+    - timeout: HTTP timeout in milliseconds
+    - batch_size: number of buffered lines triggering a write request
+    - flush_interval: maximum time (in seconds) a line stays in the buffer
+    - max_inflight: maximum number of concurrent write requests
+    - spool: optional durable overflow for failed or saturated writes
+    - retry_interval: initial delay (in seconds) between drain attempts
+    """
+
+    def __init__(self,
+                 url: str,
+                 token: str,
+                 org: str,
+                 bucket: str,
+                 timeout: int = 10_000,
+                 verify_ssl: bool = True,
+                 batch_size: int = 5000,
+                 flush_interval: float = 1.0,
+                 max_inflight: int = 4,
+                 spool: Optional[Spool] = None,
+                 retry_interval: float = 1.0):
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
+        if max_inflight < 1:
+            raise ValueError(
+                f"max_inflight must be positive, got {max_inflight}")
+
+        self.url = url
+        self.token = token
+        self.org = org
+        self.bucket = bucket
+        self.timeout = timeout
+        self.verify_ssl = verify_ssl
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_inflight = max_inflight
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.spooled = 0
+        self.lost = 0
+        self._synced_lost = 0
+
+        self._buffer = bytearray()
+        self._nlines = 0
+        self._client: Optional[InfluxDBClientAsync] = None
+        self._write_api = None
+        self._inflight: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._timer: Optional[asyncio.Task] = None
+        self._drainer: Optional[asyncio.Task] = None
+        self._failing = False
+
+    @classmethod
+    def from_config(cls, db_cfg: Mapping[str, Any]) -> 'InfluxWriter':
+        spool_cfg = db_cfg.get('spool')
+        spool = Spool(spool_cfg['path'],
+                      segment_bytes=spool_cfg.get('segment_bytes', 64 * 1024 * 1024)) \
+            if spool_cfg else None
+        return cls(url=db_cfg['url'],
+                   token=db_cfg['token'],
+                   org=db_cfg['org'],
+                   bucket=db_cfg['bucket'],
+                   timeout=db_cfg['timeout'],
+                   verify_ssl=db_cfg['verify_ssl'],
+                   batch_size=db_cfg.get('batch_size', 5000),
+                   flush_interval=db_cfg.get('flush_interval', 1.0),
+                   max_inflight=db_cfg.get('max_inflight', 4),
+                   spool=spool,
+                   retry_interval=spool_cfg.get('retry_interval', 1.0) if spool_cfg else 1.0)
+
+    async def start(self):
+        self._client = InfluxDBClientAsync(url=self.url,
+                                           token=self.token,
+                                           org=self.org,
+                                           timeout=self.timeout,
+                                           verify_ssl=self.verify_ssl)
+        self._write_api = self._client.write_api()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._timer = asyncio.create_task(self._flush_periodically())
+        if self.spool is not None:
+            self._drainer = asyncio.create_task(self._drain())
+            self._drainer.add_done_callback(self._drainer_done)
+
+    def _drainer_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Spool drainer stopped", exc_info=task.exception())
+
+    async def close(self):
+        for task in (self._timer, self._drainer):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._timer = self._drainer = None
+
+        try:
+            await self.sync(drain=False)
+        except RuntimeError:
+            # already logged by _send
+            pass
+        if self.spool is not None:
+            self.spool.close()
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def __aenter__(self) -> 'InfluxWriter':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def write(self, lines: bytes):
+        """
+        Adds newline-terminated line-protocol lines to the buffer, flushing full batches
+        right away. Waits only if `max_inflight` writes are already pending.
+        """
+        self._buffer += lines
+        self._nlines += lines.count(b'\n')
+        if self._nlines >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, nlines = bytes(self._buffer), self._nlines
+        self._buffer.clear()
+        self._nlines = 0
+        if self.spool is not None and (self._failing or self._inflight.locked()):
+            self._spool(batch, nlines)
+            return
+        await self._inflight.acquire()
+        task = asyncio.create_task(self._send(batch, nlines))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def sync(self, drain: bool = True):
+        """
+        Flushes the buffer and waits until every pending write has completed and, with
+        a spool and `drain`, until the spool is empty: only then are all the lines in
+        the database. Raises RuntimeError if lines were lost since the previous call.
+        """
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        while drain and self._drainer is not None and len(self.spool):
+            if self._drainer.done():
+                raise RuntimeError(f"{len(self.spool)} spool segments left, the drainer stopped")
+            await asyncio.sleep(self.retry_interval)
+        if self.lost > self._synced_lost:
+            lost, self._synced_lost = self.lost - self._synced_lost, self.lost
+            raise RuntimeError(f"{lost} lines could not be written")
+
+    def _spool(self, batch: bytes, nlines: int):
+        self.spool.append(batch)
+        self.spooled += nlines
+        metrics.SPOOLED_LINES.inc(nlines)
+
+    async def _timed_write(self, batch: bytes):
+        t0 = time.perf_counter()
+        try:
+            await self._write_api.write(self.bucket, self.org, batch)
+        except Exception:
+            metrics.WRITE_SECONDS.observe(
+                time.perf_counter() - t0, ('error',))
+            raise
+        metrics.WRITE_SECONDS.observe(time.perf_counter() - t0, ('ok',))
+
+    async def _send(self, batch: bytes, nlines: int):
+        metrics.WRITE_BATCH_LINES.observe(nlines)
+        try:
+            await self._timed_write(batch)
+            logger.debug("Wrote batch of %d lines", nlines)
+        except Exception:
+            if self.spool is None:
+                logger.exception(f"Failed to write batch of {nlines} lines")
+                self.lost += nlines
+            else:
+                logger.warning(
+                    f"Failed to write batch of {nlines} lines, spooled", exc_info=True)
+                self._failing = True
+                self._spool(batch, nlines)
+        finally:
+            self._inflight.release()
+
+    async def _drain(self):
+        delay = self.retry_interval
+        while True:
+            segment = self.spool.next_segment()
+            if segment is None:
+                await asyncio.sleep(self.retry_interval)
+                continue
+            for record in Spool.read(segment):
+                while True:
+                    async with self._inflight:
+                        try:
+                            await self._timed_write(record)
+                            break
+                        except Exception as ex:
+                            self._failing = True
+                            logger.warning(
+                                f"Spool drain failed ({ex!r}), retrying in {delay:.0f} s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60.0)
+                self._failing = False
+                delay = self.retry_interval
+            self.spool.ack(segment)
+            logger.info(f"Drained spool segment {segment.name}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -0,0 +1,84 @@
+import datetime
+import random
+
+import pytest
+
+from app.advisor import format_period, load_history, recommend, simulate, write_requests
+from app.decoder import DEFAULT_SCHEMA
+from app.downlink import load_requests, make_configuration
+from app.loadgen import device_id, SimulatedDevice
+from app.schema import SchemaRegistry
+
+
+T0 = datetime.datetime(2024, 1, 1)
+
+
+def history(nuplinks=50, nsamples=10, overlap=0):
+    device = SimulatedDevice(1, nsamples, datetime.timedelta(seconds=60), random.Random(0))
+    lines = []
+    for i in range(nuplinks):
+        received = T0 + datetime.timedelta(seconds=60 * (nsamples - overlap) * i, milliseconds=i * 7)
+        lines.append(device.uplink(received.isoformat() + "Z"))
+    registry = SchemaRegistry.from_config({}, default=DEFAULT_SCHEMA)
+    return load_history(lines, registry)
+
+
+class TestAdvisor:
+    def test_format_period(self):
+        assert format_period(60) == "60s"
+        assert format_period(600) == "10m"
+        assert format_period(7200) == "2h"
+        with pytest.raises(ValueError):
+            format_period(601)
+        assert make_configuration(format_period(600), 10).period == 0x4A
+
+    def test_load_history(self):
+        histories = history(nuplinks=20, nsamples=10)
+        (dev_eui, hist), = histories.items()
+        assert hist.device_id == "dev-70b3d57ed0000001"
+        # ids stay unique beyond 65536 simulated devices
+        rng = random.Random(0)
+        assert len({device_id(SimulatedDevice(i, 1, datetime.timedelta(seconds=60), rng).dev_eui)
+                    for i in (1, 0x10001)}) == 2
+        assert hist.current() == (60, 10)
+        assert len(hist.epochs) == 200
+        assert hist.samples == 200
+
+    def test_overlapping_uplinks(self):
+        (hist,) = history(nuplinks=20, nsamples=10, overlap=5).values()
+        # epochs sent twice are kept once, despite the reception jitter
+        assert len(hist.epochs) == 20 * 5 + 5
+
+    def test_simulate(self):
+        (hist,) = history().values()
+        raw = [hist.epochs[t] for t in sorted(hist.epochs)]
+        single = simulate(raw, DEFAULT_SCHEMA, 60, 1)
+        assert single.ports == {70: len(raw)}
+        many = simulate(raw, DEFAULT_SCHEMA, 60, 20)
+        assert many.uplinks == len(raw) // 20
+        assert many.bytes_per_sample < single.bytes_per_sample
+        assert simulate(raw[:5], DEFAULT_SCHEMA, 60, 10) is None
+
+    def test_recommend(self):
+        ((dev_eui, hist),) = history().items()
+        r = recommend(dev_eui, hist, max_nsamples=128)
+        assert r.best.max_payload <= 51
+        assert r.best.nsamples > 10
+        assert 0 < r.gain < 1
+
+        small = recommend(dev_eui, hist, max_nsamples=128, max_payload=11)
+        assert small.best.max_payload <= 11
+        assert small.best.nsamples < r.best.nsamples
+
+        prompt = recommend(dev_eui, hist, max_nsamples=128, max_latency=15 * 60)
+        assert prompt.best.nsamples <= 16
+
+        slower = recommend(dev_eui, hist, factors=(2,))
+        assert slower.best.period == 120
+
+    def test_write_requests(self, tmp_path):
+        ((dev_eui, hist),) = history().items()
+        r = recommend(dev_eui, hist, max_nsamples=32)
+        path = tmp_path / "recommended.csv"
+        write_requests(path, [r])
+        assert load_requests(path) == {"dev-70b3d57ed0000001": r.configuration()}
@@ -0,0 +1,123 @@
+import asyncio
+from array import array
+from typing import List
+
+from app.aggregate import Aggregator
+from app.decoder import Columns, DEFAULT_SCHEMA
+from app.main import expire_periodically, flush_aggregator
+from app.schema import SchemaRegistry
+from app.timebase import NS_PER_S
+
+
+class Clock:
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self) -> float:
+        return self.t
+
+
+def columns(times, T, H) -> Columns:
+    # newest first, as decoded
+    return Columns(DEFAULT_SCHEMA,
+                   array('q', [t * NS_PER_S for t in reversed(times)]),
+                   [array('d', reversed(T)), array('d', reversed(H))])
+
+
+class TestAggregator:
+    def test_windows_close(self):
+        agg = Aggregator(windows=(60,), clock=Clock())
+        agg.add("A", DEFAULT_SCHEMA, columns([0, 15, 30, 45], [20.0, 21.0, 22.0, 25.0],
+                                             [50.0, 52.0, 54.0, 56.0]))
+        assert agg.take() == b''
+        agg.add("A", DEFAULT_SCHEMA, columns([60, 75], [19.0, 19.5], [40.0, 41.0]))
+        assert agg.take() == (b"TH_agg,deveui=A,window=60s "
+                              b"T_count=4i,T_max=25,T_mean=22,T_min=20,"
+                              b"H_count=4i,H_max=56,H_mean=53,H_min=50 0\n")
+
+    def test_late_epochs(self):
+        agg = Aggregator(windows=(60,), clock=Clock())
+        agg.add("A", DEFAULT_SCHEMA, columns([120], [20.0], [50.0]))
+        agg.add("A", DEFAULT_SCHEMA, columns([30], [20.0], [50.0]))
+        assert agg.late == 1 and agg.take() == b''
+
+    def test_evict_idle(self):
+        clock = Clock()
+        agg = Aggregator(windows=(60, 3600), max_idle=100, clock=clock)
+        agg.add("A", DEFAULT_SCHEMA, columns([0], [20.0], [50.0]))
+        clock.t = 50
+        agg.add("B", DEFAULT_SCHEMA, columns([0], [20.0], [50.0]))
+        clock.t = 120
+        agg.add("B", DEFAULT_SCHEMA, columns([10], [20.0], [50.0]))
+        lines = agg.take().splitlines()
+        assert len(agg) == 1 and agg.evictions == 1
+        assert [line.split(b' ')[0] for line in lines] == [
+            b"TH_agg,deveui=A,window=60s", b"TH_agg,deveui=A,window=3600s"]
+
+    def test_max_devices(self):
+        agg = Aggregator(windows=(60,), max_devices=2, clock=Clock())
+        for dev in "ABC":
+            agg.add(dev, DEFAULT_SCHEMA, columns([0], [20.0], [50.0]))
+        assert len(agg) == 2
+        assert agg.take().startswith(b"TH_agg,deveui=A,")
+        agg.flush()
+        assert len(agg.take().splitlines()) == 2
+
+    def test_expire_timer_and_flush(self):
+        clock = Clock()
+        agg = Aggregator(windows=(60,), max_idle=100, clock=clock)
+        agg.add("A", DEFAULT_SCHEMA, columns([0], [20.0], [50.0]))
+        clock.t = 50
+        agg.add("B", DEFAULT_SCHEMA, columns([0], [20.0], [50.0]))
+        written: List[bytes] = []
+
+        async def sink(lines: bytes):
+            written.extend(lines.splitlines())
+
+        async def run():
+            expiry = asyncio.create_task(expire_periodically(agg, sink, 0.01))
+            await asyncio.sleep(0.03)
+            assert written == []
+            # no uplink arrives, the timer evicts the idle devices
+            clock.t = 120
+            await asyncio.sleep(0.03)
+            assert [line.split(b' ')[0] for line in written] == [b"TH_agg,deveui=A,window=60s"]
+            await flush_aggregator(agg, expiry, sink)
+            await asyncio.sleep(0)
+            assert expiry.cancelled()
+
+        asyncio.run(run())
+        assert [line.split(b' ')[0] for line in written] == [
+            b"TH_agg,deveui=A,window=60s", b"TH_agg,deveui=B,window=60s"]
+        assert len(agg) == 0
+
+    def test_evicted_device_returns(self):
+        agg = Aggregator(windows=(60,), max_devices=1, clock=Clock())
+        agg.add("A", DEFAULT_SCHEMA, columns([0, 15], [20.0, 21.0], [50.0, 52.0]))
+        agg.add("B", DEFAULT_SCHEMA, columns([0], [20.0], [50.0]))
+        assert agg.take().startswith(b"TH_agg,deveui=A,window=60s T_count=2i")
+        # A's first window was written early, its late epochs must not overwrite it
+        agg.add("A", DEFAULT_SCHEMA, columns([30, 45, 60], [22.0, 23.0, 24.0], [54.0, 55.0, 56.0]))
+        assert agg.late == 2
+        agg.flush()
+        lines = agg.take().splitlines()
+        assert sum(line.split(b' ')[2] == b"0" for line in lines) == 1
+        assert any(line.startswith(b"TH_agg,deveui=A,") and line.endswith(b" 60000000000")
+                   for line in lines)
+
+    def test_snapshot(self, tmp_path):
+        path = str(tmp_path / "lib" / "aggregate.json")
+        agg = Aggregator(windows=(60,), clock=Clock(), path=path)
+        agg.add("A", DEFAULT_SCHEMA, columns([0, 15], [20.0, 21.0], [50.0, 52.0]))
+        agg.snapshot()
+
+        registry = SchemaRegistry.from_config({}, default=DEFAULT_SCHEMA)
+        restored = Aggregator.from_config({'windows': [60], 'path': path}, registry)
+        assert len(restored) == 1
+        restored.add("A", DEFAULT_SCHEMA, columns([30, 60], [25.0, 19.0], [56.0, 40.0]))
+        # the window holds the epochs from before and after the restart
+        assert restored.take() == (b"TH_agg,deveui=A,window=60s "
+                                   b"T_count=3i,T_max=25,T_mean=22,T_min=20,"
+                                   b"H_count=3i,H_max=56,H_mean=52.666666666666664,H_min=50 0\n")
+        # other window lengths: the snapshot is ignored
+        assert len(Aggregator.from_config({'windows': [3600], 'path': path}, registry)) == 0
@@ -0,0 +1,84 @@
+import asyncio
+import datetime
+
+import pytest
+
+from app.archive import archive_files, ArchiveSink, read_archive
+from app.decoder import decode_columnar, DEFAULT_SCHEMA
+from app.encoder import encode
+
+pa = pytest.importorskip('pyarrow')
+
+# just after midnight: the older epochs of the uplink fall on the previous day
+NOW = datetime.datetime(2024, 5, 2, 0, 0, 30)
+
+
+def columns(now=NOW, n=6):
+    port, payload = encode([[20.0 + i / 10 for i in range(n)], [50.0 + i for i in range(n)]],
+                           period=datetime.timedelta(seconds=15))
+    return port, decode_columnar(port, payload, now=now)
+
+
+class TestArchive:
+    @pytest.mark.parametrize('format', ['parquet', 'ipc'])
+    def test_roundtrip(self, tmp_path, format):
+        port, cols = columns()
+
+        async def run():
+            async with ArchiveSink(str(tmp_path), format=format) as sink:
+                sink.add("A", port, DEFAULT_SCHEMA, cols)
+                sink.add("B", port, DEFAULT_SCHEMA, cols)
+                assert sink.rows == 12
+            return sink
+
+        sink = asyncio.run(run())
+        assert sink.files == 2
+        days = sorted(p.parent.name for p in archive_files(str(tmp_path), 'TH'))
+        assert days == ['date=2024-05-01', 'date=2024-05-02']
+
+        table = read_archive(str(tmp_path), 'TH')
+        assert table.column_names == ['dev_eui', 'time', 'port', 'vbat', 'T', 'H']
+        assert table.num_rows == 12
+        rows = sorted(zip(table['dev_eui'].to_pylist(), table['time'].cast(pa.int64()).to_pylist(),
+                          table['T'].to_pylist(), table['H'].to_pylist()))
+        expected = sorted((dev, t, T, H) for dev in "AB"
+                          for t, T, H in zip(cols.t, *cols.values))
+        assert rows == expected
+        assert set(table['port'].to_pylist()) == {port}
+
+        one_day = read_archive(str(tmp_path), start=datetime.date(2024, 5, 2))
+        assert one_day.num_rows == 6
+
+    def test_max_rows(self, tmp_path):
+        port, cols = columns(now=datetime.datetime(2024, 5, 2, 12))
+
+        async def run():
+            async with ArchiveSink(str(tmp_path), max_rows=10) as sink:
+                sink.add("A", port, DEFAULT_SCHEMA, cols)
+                assert sink._flushing is None
+                sink.add("B", port, DEFAULT_SCHEMA, cols)
+                await sink._flushing
+                assert sink.files == 1 and sink.rows == 0
+                sink.add("C", port, DEFAULT_SCHEMA, cols)
+            return sink
+
+        assert asyncio.run(run()).files == 2
+        assert read_archive(str(tmp_path)).num_rows == 18
+
+    def test_format(self, tmp_path):
+        with pytest.raises(ValueError):
+            ArchiveSink(str(tmp_path), format='csv')
+        assert read_archive(str(tmp_path)) is None
+        assert ArchiveSink(str(tmp_path)).compression == 'zstd'
+        # compressed IPC buffers could not be used from the mapping
+        assert ArchiveSink(str(tmp_path), format='ipc').compression == 'none'
+
+    def test_compressed_ipc(self, tmp_path):
+        port, cols = columns()
+
+        async def run():
+            async with ArchiveSink(str(tmp_path), format='ipc', compression='zstd') as sink:
+                sink.add("A", port, DEFAULT_SCHEMA, cols)
+
+        asyncio.run(run())
+        assert read_archive(str(tmp_path)).num_rows == 6
@@ -0,0 +1,71 @@
+import os
+from pathlib import Path
+import pickle
+import subprocess
+import sys
+
+from app.config import load_config
+
+SRC = str(Path(__file__).parent.parent / 'src')
+
+
+class TestConfig:
+    def test_cache(self, tmp_path):
+        path = tmp_path / "config.yaml"
+        path.write_text("lns:\n  appid: a\n")
+        cache = tmp_path / "cache"
+        assert load_config(str(path), cache) == {'lns': {'appid': 'a'}}
+        (cached,) = cache.iterdir()
+        assert load_config(str(path), cache) == {'lns': {'appid': 'a'}}
+
+        path.write_text("lns:\n  appid: bb\n")
+        assert load_config(str(path), cache) == {'lns': {'appid': 'bb'}}
+
+        # same size and modification time: the cached copy is trusted
+        st = path.stat()
+        path.write_text("lns:\n  appid: cc\n")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert load_config(str(path), cache) == {'lns': {'appid': 'bb'}}
+
+        cached.write_bytes(b'garbage')
+        assert load_config(str(path), cache) == {'lns': {'appid': 'cc'}}
+
+    def test_deferred_imports(self):
+        code = ("import sys, app.downlink, app.main; "
+                "print(','.join(m for m in ('aiomqtt', 'yaml', 'influxdb_client') if m in sys.modules))")
+        out = subprocess.run([sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=SRC),
+                             capture_output=True, text=True, check=True).stdout
+        assert out.strip() == ''
+
+    def test_dry_run(self, tmp_path):
+        path = tmp_path / "config.yaml"
+        path.write_text("lns:\n  appid: cloudia\n")
+        env = dict(os.environ, PYTHONPATH=SRC, CLOUDIA_CACHE_DIR=str(tmp_path / "cache"))
+        out = subprocess.run([sys.executable, '-m', 'app.downlink', str(path), 'dev-1',
+                              '--period', '10s', '--nsamples', '5', '--dry-run'],
+                             env=env, capture_output=True, text=True, check=True).stdout
+        topic, message = out.strip().split(' ', 1)
+        assert topic == "v3/cloudia/devices/dev-1/down/push"
+        assert '"f_port":144' in message
+
+    def test_cache_permissions(self, tmp_path):
+        path = tmp_path / "config.yaml"
+        path.write_text("lns:\n  appkey: secret\n")
+        path.chmod(0o600)
+        cache = tmp_path / "cache"
+        load_config(str(path), cache)
+        (cached,) = cache.iterdir()
+        assert cache.stat().st_mode & 0o777 == 0o700
+        assert cached.stat().st_mode & 0o777 == 0o600
+
+        # a copy others could have written is not unpickled
+        st = path.stat()
+        cached.write_bytes(pickle.dumps(((st.st_mtime_ns, st.st_size), {'forged': True})))
+        cached.chmod(0o666)
+        assert load_config(str(path), cache) == {'lns': {'appkey': 'secret'}}
+        assert cached.stat().st_mode & 0o777 == 0o600
+
+        # an open directory is tightened
+        cache.chmod(0o755)
+        assert load_config(str(path), cache) == {'lns': {'appkey': 'secret'}}
+        assert cache.stat().st_mode & 0o777 == 0o700
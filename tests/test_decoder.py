@@ -1,8 +1,13 @@
-from app.decoder import decode, Ports, VarName, CONF, CURRENT_VERSION
+from app.batch import decode_batch
+from app.decoder import (decode, decode_columnar, decode_many, Decoder, Ports, VarName, CONF, CURRENT_VERSION,
+                         ByteBitReader, IntBitReader)
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+import datetime
 from compress import Compress
 import numpy as np
+import sys
 from typing import List, Mapping, Tuple
 
 
@@ -143,3 +148,96 @@ class TestDecoder:
     def test_all(self):
         # self.run_test(use_diffs=False)
         self.run_test(use_diffs=True)
+
+
+class TestDecodeBatch:
+    def payloads(self) -> Tuple[List[int], List[str]]:
+        ports, payloads = [], []
+        for use_diffs in (False, True):
+            for tv in test_cases:
+                vars = {t: Var(tv.data[t], CONF[t].nbits_v0,
+                               CONF[t].signed) for t in VarName}
+                b, port = create_buffer(vars, use_diffs=use_diffs)
+                ports.append(port)
+                payloads.append(b)
+        ports.append(90)
+        payloads.append("AHeUINLp7QI=")
+        return ports, payloads
+
+    def test_matches_decode(self):
+        now = datetime.datetime(2024, 1, 1, 12, 0, 0, 123456)
+        ports, payloads = self.payloads()
+        # interleave ports so that every layout group holds several payloads
+        ports, payloads = ports * 3, payloads * 3
+        res = decode_batch(ports, payloads, now=now)
+        assert res.failed == []
+        assert res.to_list(len(payloads)) == [
+            decode(p, b, now=now) for p, b in zip(ports, payloads)]
+
+    def test_failed_payloads(self):
+        res = decode_batch([90, 42, 70], ["AHeUINLp7QI=", "AHeUINLp7QI=", "AA=="])
+        assert res.failed == [1, 2]
+        assert set(res.index.tolist()) == {0}
+
+
+class TestBitReader:
+    def test_readers_agree(self):
+        rng = np.random.RandomState(1)
+        buf = bytes(rng.randint(0, 256, 64).tolist())
+        widths = rng.randint(1, 12, 40).tolist()
+        signs = rng.randint(0, 2, 40).astype(bool).tolist()
+        a, b = ByteBitReader(buf), IntBitReader(buf)
+        for nbits, signed in zip(widths, signs):
+            assert a.read(nbits, signed) == b.read(nbits, signed)
+            assert a.remaining() == b.remaining()
+
+    def test_decoder_readers_agree(self):
+        now = datetime.datetime(2024, 1, 1)
+        for tv in test_cases:
+            vars = {t: Var(tv.data[t], CONF[t].nbits_v0,
+                           CONF[t].signed) for t in VarName}
+            b, port = create_buffer(vars)
+            assert (Decoder(port, b, now=now, reader=ByteBitReader).read_epochs()
+                    == Decoder(port, b, now=now, reader=IntBitReader).read_epochs())
+
+
+class TestConcurrency:
+    def test_concurrent_decode(self):
+        now = datetime.datetime(2024, 1, 1)
+        ports, payloads = TestDecodeBatch().payloads()
+        ports, payloads = ports * 40, payloads * 40
+        expected = [decode(p, b, now=now) for p, b in zip(ports, payloads)]
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                # reversed order so that threads decode different ports at the same time
+                futures = [pool.submit(decode, p, b, now)
+                           for p, b in zip(ports[::-1], payloads[::-1])]
+                res = [f.result() for f in futures][::-1]
+        finally:
+            sys.setswitchinterval(interval)
+        assert res == expected
+
+    def test_decode_many(self):
+        now = datetime.datetime(2024, 1, 1)
+        ports, payloads = TestDecodeBatch().payloads()
+        expected = [decode(p, b, now=now) for p, b in zip(ports, payloads)]
+        assert decode_many(ports, payloads, now=now, max_workers=4) == expected
+        assert decode_many(ports, payloads, now=now, max_workers=2,
+                           processes=True, chunksize=4) == expected
+
+
+class TestColumnar:
+    def test_matches_decode(self):
+        now = datetime.datetime(2024, 1, 1)
+        for tv in test_cases:
+            vars = {t: Var(tv.data[t], CONF[t].nbits_v0, CONF[t].signed) for t in VarName}
+            for use_diffs in (True, False):
+                b, port = create_buffer(vars, use_diffs=use_diffs)
+                cols = decode_columnar(port, b, now=now)
+                assert cols.rows() == Decoder(port, b, now=now).read_epochs()
+                assert list(cols.column('T')) == [r[1][VarName.T] for r in cols.rows()]
+                assert cols.values[0].typecode == 'd'
+
@@ -0,0 +1,44 @@
+from app.dedup import DedupCache
+
+
+class Clock:
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self) -> float:
+        return self.t
+
+
+class TestDedupCache:
+    def test_duplicates(self):
+        cache = DedupCache(max_entries=10, ttl=60, clock=Clock())
+        assert not cache.seen("A", 1, "AHeU")
+        assert cache.seen("A", 1, "AHeU")
+        assert not cache.seen("A", 2, "AHeU")
+        assert not cache.seen("B", 1, "AHeU")
+        assert not cache.seen("A", 1, "AHeV")
+        assert (cache.hits, cache.misses) == (1, 4)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = DedupCache(max_entries=10, ttl=60, clock=clock)
+        cache.seen("A", 1, "x")
+        clock.t = 30
+        cache.seen("B", 1, "x")
+        clock.t = 61
+        assert len(cache) == 2
+        assert not cache.seen("A", 1, "x")
+        # expired entries are dropped on access
+        assert len(cache) == 2
+        assert cache.seen("B", 1, "x")
+
+    def test_capacity(self):
+        cache = DedupCache(max_entries=3, ttl=60, clock=Clock())
+        for i in range(3):
+            cache.seen("A", i, "x")
+        # refresh 0, so 1 is the least recently seen
+        assert cache.seen("A", 0, "x")
+        cache.seen("A", 3, "x")
+        assert len(cache) == 3 and cache.evictions == 1
+        assert not cache.seen("A", 1, "x")
+        assert cache.seen("A", 0, "x")
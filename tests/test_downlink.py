@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+import ujson
+
+from app.downlink import Configuration, load_requests, make_configuration, publish_many
+
+
+class FakeClient:
+    def __init__(self, fail=()):
+        self.published = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.fail = fail
+
+    async def publish(self, topic, payload, qos=0):
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        await asyncio.sleep(0.001)
+        self.inflight -= 1
+        if topic.split('/')[3] in self.fail:
+            raise ConnectionError("boom")
+        self.published.append((topic, ujson.loads(payload)))
+
+
+class TestDownlink:
+    def test_configuration(self):
+        assert make_configuration("10s", 5) == Configuration(period=0x8A, nsamples=5)
+        assert make_configuration("2m", 5).period == 0x42
+        with pytest.raises(ValueError):
+            make_configuration("10d", 5)
+        with pytest.raises(ValueError):
+            make_configuration("10s", 300)
+
+    def test_load_csv(self, tmp_path):
+        path = tmp_path / "fleet.csv"
+        path.write_text("device_id,period,nsamples\n"
+                        "a,10s,5\nb,1h,10\na,20s,6\n")
+        requests = load_requests(path)
+        assert list(requests) == ["b", "a"]
+        assert requests["a"] == make_configuration("20s", 6)
+
+    def test_load_yaml(self, tmp_path):
+        path = tmp_path / "fleet.yaml"
+        path.write_text("- {device_id: a, period: 10s, nsamples: 5}\n"
+                        "- {device_id: b, period: 5m}\n")
+        requests = load_requests(path)
+        assert requests["b"] == make_configuration("5m", 10)
+
+    def test_load_invalid(self, tmp_path):
+        path = tmp_path / "fleet.csv"
+        path.write_text("device_id,period,nsamples\na,10x,5\n")
+        with pytest.raises(ValueError, match="entry 1"):
+            load_requests(path)
+
+    def test_publish_many(self):
+        requests = {f"dev-{i}": make_configuration("10s", 5) for i in range(100)}
+        client = FakeClient(fail=("dev-7",))
+        published, failed = asyncio.run(
+            publish_many(client, "app", requests, concurrency=8))
+        assert (published, failed) == (99, ["dev-7"])
+        assert client.max_inflight == 8
+        topic, msg = client.published[0]
+        assert topic == "v3/app/devices/dev-0/down/push"
+        assert msg["downlinks"][0]["f_port"] == 144
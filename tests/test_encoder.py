@@ -0,0 +1,104 @@
+from base64 import b64encode
+import datetime
+
+import asyncio
+import numpy as np
+import pytest
+
+from app.batch import decode_batch
+from app.decoder import decode, decode_period, DEFAULT_SCHEMA, Ports
+from app.encoder import encode, encode_period, encode_raw
+from app.envelope import parse_scan
+from app.loadgen import generate, SimulatedDevice
+import random
+from test_decoder import test_cases
+
+
+NOW = datetime.datetime(2024, 1, 1)
+
+
+def roundtrip(raw, **kwargs):
+    port, payload = encode_raw(raw, **kwargs)
+    b = b64encode(payload).decode()
+    d = decode(port, b, now=NOW)
+    decoded = [[round(e[1][spec.key] / spec.scale) for e in d] for spec in DEFAULT_SCHEMA.vars]
+    return port, b, decoded
+
+
+class TestEncoder:
+    def test_roundtrip_ports(self):
+        rng = np.random.default_rng(0)
+        for tv in test_cases:
+            raw = [tv.data[k].tolist() for k in sorted(tv.data)]
+            for use_diffs in (True, False):
+                for offset in (0, 7):
+                    if len(raw[0]) == 1 and offset:
+                        continue
+                    port, b, decoded = roundtrip(raw, use_diffs=use_diffs, offset=offset)
+                    assert decoded == raw, (len(raw[0]), port)
+        # signed values and large jumps
+        T = rng.integers(-500, 500, 40).tolist()
+        H = rng.integers(0, 100, 40).tolist()
+        assert roundtrip([T, H])[2] == [T, H]
+
+    def test_port_selection(self):
+        assert roundtrip([[1], [2]])[0] == Ports.SINGLE_MEAS
+        smooth = [list(range(200, 210)), [50] * 10]
+        assert roundtrip(smooth)[0] == Ports.MULT_MEAS_OFFSET_0_DIFFS
+        assert roundtrip(smooth, offset=3)[0] == Ports.MULT_MEAS_DIFFS
+        jumpy = [[0, 500, -500, 500], [0, 99, 0, 99]]
+        assert roundtrip(jumpy)[0] == Ports.MULT_MEAS_OFFSET_0
+        assert roundtrip(jumpy, offset=3)[0] == Ports.MULT_MEAS
+
+    def test_padding_never_decodes_as_epoch(self):
+        rng = np.random.default_rng(1)
+        for n in range(2, 60):
+            T = np.cumsum(rng.integers(-3, 4, n)).tolist()
+            H = (50 + np.cumsum(rng.integers(-1, 2, n))).tolist()
+            assert roundtrip([T, H])[2] == [T, H]
+
+    def test_scaled_and_batch(self):
+        T = [23.4, 23.3, 23.1, 23.0]
+        H = [55.0, 56.0, 56.0, 57.0]
+        port, b = encode([T, H], period=datetime.timedelta(minutes=5), offset=30)
+        d = decode(port, b, now=NOW)
+        assert [round(e[1][0], 1) for e in d] == T
+        assert d[0][0] == NOW - datetime.timedelta(seconds=30)
+        assert d[1][0] - d[0][0] == -datetime.timedelta(minutes=5)
+        assert decode_batch([port], [b], now=NOW).to_list(1) == [d]
+
+    def test_period(self):
+        for secs in (0, 15, 127, 180, 3600, 7200):
+            td = datetime.timedelta(seconds=secs)
+            assert decode_period(encode_period(td)) == td
+        with pytest.raises(ValueError):
+            encode_period(datetime.timedelta(minutes=90))
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            encode_raw([[2000], [1]])
+        with pytest.raises(ValueError):
+            encode_raw([[1, 2], [1]])
+        with pytest.raises(ValueError):
+            encode_raw([[1], [-1]])
+
+
+class FakeClient:
+    def __init__(self):
+        self.messages = []
+
+    async def publish(self, topic, payload):
+        self.messages.append((topic, payload))
+
+
+class TestLoadgen:
+    def test_generate(self):
+        rng = random.Random(0)
+        devices = [SimulatedDevice(i, 10, datetime.timedelta(seconds=60), rng) for i in range(5)]
+        client = FakeClient()
+        sent = asyncio.run(generate(client, "app", devices, rate=200, duration=0.5))
+        assert sent == len(client.messages) >= 50
+        topic, raw = client.messages[0]
+        assert topic.startswith("v3/app/devices/dev-") and topic.endswith("/up")
+        uplink = parse_scan(raw)
+        assert len(decode(uplink.f_port, uplink.frm_payload)) == 10
@@ -0,0 +1,43 @@
+import ujson
+
+from app.envelope import make_parser, parse_full, parse_orjson, parse_scan, Uplink
+from app import metrics
+from app.loadgen import make_envelope
+import pytest
+
+
+class TestEnvelope:
+    def test_parsers_agree(self):
+        raw = make_envelope(f_cnt=42, ngateways=5)
+        ref = parse_full(raw)
+        assert ref == Uplink(dev_eui="70B3D57ED0050001", f_port=90, frm_payload="AHeUINLp7QI=",
+                             f_cnt=42, received_at="2024-05-01T10:00:01.123456789Z")
+        assert parse_scan(raw) == ref
+        pytest.importorskip('orjson')
+        assert parse_orjson(raw) == ref
+
+    def test_scan_whitespace(self):
+        raw = ujson.dumps(ujson.loads(make_envelope()), indent=2).encode()
+        assert parse_scan(raw) == parse_full(raw)
+
+    def test_nested_keys(self):
+        doc = ujson.loads(make_envelope(f_cnt=0))
+        del doc['uplink_message']['f_cnt']
+        doc['uplink_message']['decoded_payload'] = {'f_port': 1, 'f_cnt': 3, 'dev_eui': 'FF'}
+        raw = ujson.dumps(doc).encode()
+        assert parse_scan(raw) == parse_full(raw)
+        assert parse_scan(raw).f_cnt == 0
+
+    def test_fallback(self):
+        # an escaped character in a value defeats the scanner
+        raw = make_envelope(frm_payload="AHeU/NLp7QI=")
+        assert b'\\/' in raw
+        with pytest.raises(ValueError):
+            parse_scan(raw)
+        before = metrics.ENVELOPE_FALLBACKS.values.get((), 0)
+        assert make_parser('scan')(raw).frm_payload == "AHeU/NLp7QI="
+        assert metrics.ENVELOPE_FALLBACKS.values[()] == before + 1
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            make_parser('simdjson')
@@ -0,0 +1,57 @@
+from app.decoder import decode, decode_columnar, DEFAULT_SCHEMA
+from app.lineproto import LineProtocolEncoder, escape_tag_value, to_ns
+from app.schema import Schema, VarSpec
+import datetime
+from influxdb_client import Point
+
+
+PAYLOAD = (90, "AHeUINLp7QI=")
+
+
+def point_lines(schema, deveui, epochs) -> bytes:
+    lines = []
+    for t, v in epochs:
+        point = Point(schema.name).tag("deveui", deveui)
+        for var in schema.vars:
+            point.field(var.name, v[var.key])
+        lines.append(point.time(t).to_line_protocol())
+    return ("\n".join(lines) + "\n").encode()
+
+
+class TestLineProtocol:
+    def test_matches_point(self):
+        now = datetime.datetime(2024, 5, 17, 10, 11, 12, 345678)
+        epochs = decode(*PAYLOAD, now=now)
+        enc = LineProtocolEncoder()
+        enc.add(DEFAULT_SCHEMA, {"deveui": "70B3D57ED0050001"}, epochs)
+        assert len(enc) == len(epochs)
+        assert enc.take() == point_lines(
+            DEFAULT_SCHEMA, "70B3D57ED0050001", epochs)
+        # the buffer is reused
+        assert len(enc) == 0 and enc.take() == b''
+
+    def test_columns(self):
+        now = datetime.datetime(2024, 5, 17, 10, 11, 12, 345678)
+        enc = LineProtocolEncoder()
+        enc.add(DEFAULT_SCHEMA, {"deveui": "A"}, decode(*PAYLOAD, now=now))
+        ref = enc.take()
+        enc.add_columns(DEFAULT_SCHEMA, {"deveui": "A"},
+                        decode_columnar(*PAYLOAD, now=now))
+        assert enc.take() == ref
+
+    def test_escaping(self):
+        schema = Schema(name="my meas,1",
+                        vars=(VarSpec(0, "a b", 7, False, 1.0, (0, 1)),
+                              VarSpec(1, "c=d", 7, False, 1.0, (0, 1))))
+        t = datetime.datetime(2024, 1, 1)
+        epochs = [(t, {0: 1.5, 1: 2.0}), (t, {0: float('nan'), 1: float('inf')})]
+        enc = LineProtocolEncoder()
+        enc.add(schema, {"dev eui": "a,b=c\\"}, epochs)
+        assert enc.take() == point_lines(schema, "a,b=c\\", epochs[:1]).replace(
+            b"deveui", b"dev\\ eui")
+        assert escape_tag_value("x\\") == "x\\ "
+
+    def test_to_ns(self):
+        t = datetime.datetime(2024, 1, 1, 0, 0, 0, 1)
+        assert to_ns(t) == 1704067200000001000
+        assert to_ns(t.replace(tzinfo=datetime.timezone.utc)) == to_ns(t)
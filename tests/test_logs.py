@@ -0,0 +1,78 @@
+import logging
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+from app.decoder import DecVar, DEFAULT_SCHEMA
+from app.logs import configure, Sampler
+from app import metrics
+
+SRC = str(Path(__file__).parent.parent / 'src')
+
+
+class Clock:
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self) -> float:
+        return self.t
+
+
+class TestSampler:
+    def test_one_in_n(self):
+        s = Sampler(every=3)
+        assert [s.allow() for _ in range(7)] == [
+            False, False, True, False, False, True, False]
+
+    def test_per_device(self):
+        clock = Clock()
+        s = Sampler(interval=10, clock=clock)
+        assert s.allow("A")
+        assert not s.allow("A")
+        assert s.allow("B")
+        clock.t = 10
+        assert s.allow("A")
+
+    def test_max_keys(self):
+        s = Sampler(interval=10, max_keys=2, clock=Clock())
+        assert s.allow("A") and s.allow("B") and s.allow("C")
+        assert len(s._last) == 1
+
+
+class TestConfigure:
+    def test_levels(self):
+        decoder = logging.getLogger('cloudia-decoder')
+        main = logging.getLogger('cloudia-main')
+        old = decoder.level, main.level
+        try:
+            configure({'level': 'INFO', 'levels': {'decoder': 'ERROR'}})
+            assert decoder.level == logging.ERROR
+            assert main.level == logging.INFO
+        finally:
+            decoder.setLevel(old[0])
+            main.setLevel(old[1])
+
+
+class TestOutOfRange:
+    def test_counted(self, caplog):
+        spec = DEFAULT_SCHEMA.vars[1]
+        before = metrics.OUT_OF_RANGE.values.get((spec.name,), 0)
+        with caplog.at_level(logging.WARNING, logger='cloudia-decoder'):
+            DecVar(spec, 120, validate=True)
+            DecVar(spec, 50, validate=True)
+        assert metrics.OUT_OF_RANGE.values[(spec.name,)] == before + 1
+        assert not caplog.records
+
+    def test_deferred_loggers(self):
+        # the writer is imported by run() itself, its loggers must still be configured
+        code = ("import asyncio, logging\n"
+                "from app.main import run\n"
+                "try:\n"
+                "    asyncio.run(run({'logging': {'level': 'WARNING'}}))\n"
+                "except KeyError:\n"
+                "    pass\n"
+                "print(logging.getLogger('cloudia-writer').level, logging.getLogger('cloudia-spool').level)")
+        out = subprocess.run([sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=SRC),
+                             capture_output=True, text=True, check=True).stdout
+        assert out.split() == [str(logging.WARNING)] * 2
@@ -0,0 +1,63 @@
+import asyncio
+
+import aiohttp
+
+from app.metrics import Counter, Gauge, Histogram, Registry, start_server
+
+
+class TestMetrics:
+    def test_counter(self):
+        c = Counter('c_total', 'help', ('port',))
+        c.inc(labels=('70',))
+        c.inc(2, labels=('70',))
+        c.inc(labels=('80',))
+        assert c.render().split('\n') == [
+            '# HELP c_total help',
+            '# TYPE c_total counter',
+            'c_total{port="70"} 3',
+            'c_total{port="80"} 1',
+        ]
+
+    def test_histogram(self):
+        h = Histogram('h_seconds', 'help', buckets=(0.1, 1.0))
+        for v in (0.05, 0.1, 0.5, 2.0):
+            h.observe(v)
+        samples = h.samples()
+        assert samples == [
+            'h_seconds_bucket{le="0.1"} 2',
+            'h_seconds_bucket{le="1.0"} 3',
+            'h_seconds_bucket{le="+Inf"} 4',
+            'h_seconds_sum 2.65',
+            'h_seconds_count 4',
+        ]
+
+    def test_callback_gauge(self):
+        depth = {'input': 3, 'output': 0}
+        g = Gauge('q', 'help', ('queue',))
+        g.add_callback(lambda: {(k,): v for k, v in depth.items()})
+        assert g.samples() == ['q{queue="input"} 3', 'q{queue="output"} 0']
+        depth['input'] = 7
+        assert g.samples()[0] == 'q{queue="input"} 7'
+
+    def test_label_escaping(self):
+        c = Counter('c_total', 'help', ('exception',))
+        c.inc(labels=('a"b\\c',))
+        assert c.samples() == ['c_total{exception="a\\"b\\\\c"} 1']
+
+    def test_server(self):
+        reg = Registry()
+        reg.register(Counter('c_total', 'help')).inc()
+
+        async def run():
+            runner = await start_server('127.0.0.1', 0, registry=reg)
+            try:
+                port = next(iter(runner.sites))._server.sockets[0].getsockname()[1]
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+                        assert resp.status == 200
+                        return await resp.text()
+            finally:
+                await runner.cleanup()
+
+        text = asyncio.run(run())
+        assert 'c_total 1\n' in text
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import signal
+from app.main import consume_until_stopped
+from app.pipeline import Backpressure, Pipeline, SpillFile
+from typing import List, Tuple
+
+
+def run_pipeline(backpressure: Backpressure, n: int, tmp_path=None) -> Tuple[List[int], Pipeline]:
+    written: List[int] = []
+    release = asyncio.Event()
+
+    async def process(raw: bytes) -> List[int]:
+        await release.wait()
+        return [int(raw)]
+
+    async def sink(items: List[int]):
+        written.extend(items)
+
+    async def run():
+        spill_path = str(tmp_path / 'spill.bin') if tmp_path else None
+        async with Pipeline(process, sink, workers=1, queue_size=4,
+                            backpressure=backpressure,
+                            spill_path=spill_path) as pipeline:
+            for i in range(n):
+                await pipeline.put(str(i).encode())
+            release.set()
+        return pipeline
+
+    pipeline = asyncio.run(run())
+    return written, pipeline
+
+
+class TestPipeline:
+    def test_drop_oldest(self):
+        written, pipeline = run_pipeline(Backpressure.drop_oldest, 20)
+        # the worker does not run between puts, the queue keeps the 4 newest
+        assert pipeline.dropped == 16
+        assert written == [16, 17, 18, 19]
+
+    def test_spill(self, tmp_path):
+        written, pipeline = run_pipeline(Backpressure.spill, 20, tmp_path)
+        assert pipeline.spilled == 16
+        assert written == list(range(20))
+        assert not (tmp_path / 'spill.bin').exists()
+
+    def test_spill_recovery(self, tmp_path):
+        path = str(tmp_path / 'spill.bin')
+        spill = SpillFile(path)
+        spill.append(b'old-1')
+        spill.append(b'old-2')
+        # crash: the file is left behind, the last record torn
+        spill._wf.write(SpillFile.HEADER.pack(10) + b'abc')
+        spill._wf.flush()
+
+        spill = SpillFile(path)
+        assert len(spill) == 2
+        spill.append(b'new')
+        assert [spill.pop() for _ in range(3)] == [b'old-1', b'old-2', b'new']
+        assert len(spill) == 0
+        spill.append(b'7')
+        spill._wf.flush()
+
+        # the pipeline processes the recovered messages first
+        written, _ = run_pipeline(Backpressure.spill, 2, tmp_path)
+        assert written == [7, 0, 1]
+
+    def test_block(self):
+        written: List[int] = []
+
+        async def process(raw: bytes) -> List[int]:
+            await asyncio.sleep(0)
+            return [int(raw)]
+
+        async def sink(items: List[int]):
+            written.extend(items)
+
+        async def run():
+            async with Pipeline(process, sink, workers=3, queue_size=2) as pipeline:
+                for i in range(50):
+                    await pipeline.put(str(i).encode())
+
+        asyncio.run(run())
+        assert sorted(written) == list(range(50))
+
+    def test_sigterm_drains(self):
+        written: List[int] = []
+
+        async def process(raw: bytes) -> List[int]:
+            await asyncio.sleep(0)
+            return [int(raw)]
+
+        async def sink(items: List[int]):
+            written.extend(items)
+
+        async def consume(pipeline: Pipeline):
+            for i in range(1000):
+                await pipeline.put(str(i).encode())
+                if i == 10:
+                    os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.Event().wait()
+
+        async def run():
+            async with Pipeline(process, sink, workers=2, queue_size=100) as pipeline:
+                await consume_until_stopped(consume(pipeline))
+            return pipeline
+
+        asyncio.run(run())
+        # the consumer stops at the signal, everything it queued reaches the sink
+        assert sorted(written) == list(range(len(written)))
+        assert 10 < len(written) < 1000
+        assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
@@ -0,0 +1,97 @@
+import asyncio
+import pstats
+
+import aiohttp
+import pytest
+
+from app import metrics
+from app.decoder import DEFAULT_SCHEMA
+from app.loadgen import make_envelope
+from app.main import UplinkProcessor
+from app.profiling import Profiler, Spans
+from app.schema import SchemaRegistry
+from app.state import StateTable
+
+
+def stage_counts():
+    return {k[0]: sum(v[0]) for k, v in metrics.STAGE_SECONDS.values.items()}
+
+
+class TestProfiling:
+    def test_spans(self):
+        registry = SchemaRegistry.from_config({}, default=DEFAULT_SCHEMA)
+        spans = Spans()
+        process = UplinkProcessor(registry, state=StateTable(), spans=spans)
+
+        before = stage_counts()
+        asyncio.run(process(make_envelope(f_cnt=1)))
+        assert stage_counts() == before
+
+        spans.enabled = True
+        asyncio.run(process(make_envelope(f_cnt=2, received_at="2024-05-01T10:10:01Z")))
+        after = stage_counts()
+        for stage in ('envelope', 'decoder_init', 'read_columns', 'trim', 'serialize'):
+            assert after[stage] == before.get(stage, 0) + 1
+
+    def test_timed(self):
+        spans = Spans()
+        calls = []
+
+        async def sink(lines):
+            calls.append(lines)
+
+        timed = spans.timed('test_sink', sink)
+        asyncio.run(timed(b'a'))
+        assert 'test_sink' not in stage_counts()
+        spans.enabled = True
+        asyncio.run(timed(b'b'))
+        assert stage_counts()['test_sink'] == 1
+        assert calls == [b'a', b'b']
+
+    def test_profiler(self, tmp_path):
+        profiler = Profiler(directory=str(tmp_path), max_duration=10)
+
+        async def run():
+            with pytest.raises(ValueError):
+                profiler.start(20)
+            path = profiler.start(0.2)
+            assert profiler.active and profiler.spans.enabled
+            with pytest.raises(RuntimeError):
+                profiler.start()
+            sum(i * i for i in range(10000))
+            await asyncio.sleep(0.4)
+            return path
+
+        path = asyncio.run(run())
+        assert not profiler.active and not profiler.spans.enabled
+        assert path.exists()
+        assert pstats.Stats(str(path)).total_calls > 0
+        assert profiler.stop() is None
+
+    def test_admin_route(self, tmp_path):
+        profiler = Profiler(directory=str(tmp_path))
+
+        async def run():
+            runner = await metrics.start_server('127.0.0.1', 0, profiler=profiler)
+            try:
+                port = next(iter(runner.sites))._server.sockets[0].getsockname()[1]
+                url = f"http://127.0.0.1:{port}/profile"
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(url, params={'duration': 'x'}) as resp:
+                        assert resp.status == 400
+                    async with session.post(url, params={'duration': '60'}) as resp:
+                        assert resp.status == 202
+                        started = (await resp.json())['path']
+                    async with session.post(url) as resp:
+                        assert resp.status == 409
+                    async with session.delete(url) as resp:
+                        assert resp.status == 200
+                        assert (await resp.json())['path'] == started
+                    async with session.delete(url) as resp:
+                        assert resp.status == 409
+                return started
+            finally:
+                await runner.cleanup()
+
+        path = asyncio.run(run())
+        assert (tmp_path / path.split('/')[-1]).exists()
@@ -0,0 +1,94 @@
+import asyncio
+import datetime
+import json
+from typing import List
+
+import pytest
+
+from app.loadgen import make_envelope
+from app.replay import _init_worker, decode_chunk, iter_chunks, list_sources, replay
+from app.timebase import parse_received_at
+
+
+class StubSink:
+    """
+    Records the writes, its sync() fails from the `fail_at`-th call on
+    """
+
+    def __init__(self, fail_at=None):
+        self.lines: List[bytes] = []
+        self.syncs = 0
+        self.fail_at = fail_at
+
+    async def write(self, lines: bytes):
+        self.lines.extend(lines.splitlines())
+
+    async def sync(self):
+        self.syncs += 1
+        if self.fail_at is not None and self.syncs >= self.fail_at:
+            raise RuntimeError("lines could not be written")
+
+
+def archive(path, n=6):
+    lines = [make_envelope(f_cnt=i, received_at=f"2024-05-01T10:{i:02d}:00Z") for i in range(n)]
+    lines.insert(2, b'{"not": "an uplink"}')
+    path.write_bytes(b'\n'.join(lines) + b'\n')
+    return path
+
+
+class TestReplay:
+    def test_parse_received_at(self):
+        assert parse_received_at("2024-05-01T10:00:01.123456789Z") == \
+            datetime.datetime(2024, 5, 1, 10, 0, 1, 123456)
+        assert parse_received_at("2024-05-01T12:00:01+02:00") == \
+            datetime.datetime(2024, 5, 1, 10, 0, 1)
+
+    def test_iter_chunks_resume(self, tmp_path):
+        (tmp_path / 'a.jsonl').write_text("1\n2\n\n3\n4\n5\n")
+        (tmp_path / 'b.jsonl').write_text("6\n7\n")
+        sources = list_sources(tmp_path)
+        chunks = list(iter_chunks(sources, 2))
+        assert [c[2] for c in chunks] == [[b'1', b'2'], [b'3', b'4'], [b'5'], [b'6', b'7']]
+        assert chunks[1][:2] == (str(tmp_path / 'a.jsonl'), 5)
+
+        checkpoint = {'source': chunks[1][0], 'line': chunks[1][1]}
+        assert [c[2] for c in iter_chunks(sources, 2, checkpoint)] == [[b'5'], [b'6', b'7']]
+
+    def test_decode_chunk(self):
+        _init_worker({})
+        res = decode_chunk([make_envelope(), b'garbage'])
+        assert (res.messages, res.failed) == (2, 1)
+        assert res.epochs > 0
+        assert res.lines.count(b'\n') == res.epochs
+        assert b'deveui=70B3D57ED0050001' in res.lines
+
+    def test_replay(self, tmp_path):
+        _init_worker({})
+        expected = decode_chunk(archive(tmp_path / 'a.jsonl').read_bytes().splitlines()).lines
+        sink = StubSink()
+        checkpoint = tmp_path / 'checkpoint.json'
+        asyncio.run(replay([tmp_path / 'a.jsonl'], sink, {}, workers=1, chunk_size=2,
+                           checkpoint_path=str(checkpoint), checkpoint_every=1))
+        assert sink.lines == expected.splitlines()
+        assert json.loads(checkpoint.read_text()) == {'source': str(tmp_path / 'a.jsonl'), 'line': 7}
+
+    def test_resume(self, tmp_path):
+        src = archive(tmp_path / 'a.jsonl')
+        _init_worker({})
+        expected = decode_chunk(src.read_bytes().splitlines()[4:]).lines
+        checkpoint = tmp_path / 'checkpoint.json'
+        checkpoint.write_text(json.dumps({'source': str(src), 'line': 4}))
+        sink = StubSink()
+        asyncio.run(replay([src], sink, {}, workers=1, chunk_size=2,
+                           checkpoint_path=str(checkpoint)))
+        assert sink.lines == expected.splitlines()
+
+    def test_failed_sync_keeps_checkpoint(self, tmp_path):
+        src = archive(tmp_path / 'a.jsonl')
+        checkpoint = tmp_path / 'checkpoint.json'
+        sink = StubSink(fail_at=2)
+        with pytest.raises(RuntimeError):
+            asyncio.run(replay([src], sink, {}, workers=1, chunk_size=2,
+                               checkpoint_path=str(checkpoint), checkpoint_every=1))
+        # the second chunk was not persisted, the replay resumes after the first
+        assert json.loads(checkpoint.read_text()) == {'source': str(src), 'line': 2}
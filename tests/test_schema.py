@@ -0,0 +1,78 @@
+from app.decoder import decode, DEFAULT_SCHEMA, Ports, CURRENT_VERSION
+from app.schema import Schema, SchemaRegistry
+from base64 import b64encode
+from compress import Compress
+import datetime
+import pytest
+
+
+CFG = {
+    'profiles': {
+        'THP': [
+            {'name': 'T', 'nbits': 10, 'signed': True, 'scale': 0.1},
+            {'name': 'H', 'nbits': 7},
+            {'name': 'P', 'nbits': 11, 'limits': [300, 1100]},
+        ],
+    },
+    'devices': {
+        '70B3D57ED0': 'TH',
+        '70B3D57ED005': 'THP',
+    },
+    'plan_cache_size': 2,
+}
+
+
+class TestSchemaRegistry:
+    def test_device_lookup(self):
+        registry = SchemaRegistry.from_config(CFG, default=DEFAULT_SCHEMA)
+        assert registry.for_device('70b3d57ed0050001').name == 'THP'
+        assert registry.for_device('70B3D57ED0010001').name == 'TH'
+        assert registry.for_device('0000000000000000') is DEFAULT_SCHEMA
+        assert registry.for_device(None) is DEFAULT_SCHEMA
+
+    def test_unknown_schema(self):
+        with pytest.raises(ValueError):
+            SchemaRegistry.from_config({'devices': {'AB': 'XYZ'}},
+                                       default=DEFAULT_SCHEMA)
+
+    def test_plan_cache(self):
+        registry = SchemaRegistry.from_config(CFG, default=DEFAULT_SCHEMA)
+        thp = registry.schemas['THP']
+        p1 = registry.plan(DEFAULT_SCHEMA, 90, True, (3, 2))
+        assert registry.plan(DEFAULT_SCHEMA, 90, True, (3, 2)) is p1
+        assert registry.plans.hits == 1 and registry.plans.misses == 1
+        registry.plan(thp, 80, False, (10, 7, 11))
+        registry.plan(DEFAULT_SCHEMA, 80, False, (10, 7))
+        # LRU eviction: the first plan was the least recently used
+        assert len(registry.plans) == 2
+        assert registry.plan(DEFAULT_SCHEMA, 90, True, (3, 2)) is not p1
+
+    def test_plan_layout(self):
+        registry = SchemaRegistry.from_config({}, default=DEFAULT_SCHEMA)
+        plan = registry.plan(DEFAULT_SCHEMA, 90, True, (3, 0))
+        assert [f.offset for f in plan.fields_v0] == [0, 11]
+        assert plan.width_v0 == 18
+        # zero-width differences take no bits, not even the sign
+        assert plan.width_vi == 4
+        assert plan.nepochs(18) == 1 and plan.nepochs(26) == 3
+
+    def test_decode_custom_schema(self):
+        registry = SchemaRegistry.from_config(CFG, default=DEFAULT_SCHEMA)
+        thp: Schema = registry.schemas['THP']
+        samples = [(-52, 40, 1013), (-50, 41, 1012), (-49, 43, 1011)]
+
+        B = Compress(32)
+        for T, H, P in samples:
+            B.add_with_sign(T, 10)
+            B.add(H, 7)
+            B.add(P, 11)
+        SR1 = (CURRENT_VERSION >> 2) & 0xFF
+        SR2 = ((CURRENT_VERSION & 0x3) << 6) | (13 << 2) | 0x3
+        payload = bytes([SR1, SR2, 0x8F]) + B.array()
+
+        now = datetime.datetime(2024, 1, 1)
+        d = decode(Ports.MULT_MEAS_OFFSET_0, b64encode(payload).decode(),
+                   now=now, schema=thp, registry=registry)
+        assert [t for t, _ in d] == [now - i * datetime.timedelta(seconds=15)
+                                     for i in range(3)]
+        assert [(round(v[0] * 10), v[1], v[2]) for _, v in d] == samples
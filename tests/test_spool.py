@@ -0,0 +1,81 @@
+import asyncio
+from aiohttp import web
+from app.spool import Spool
+from app.writer import InfluxWriter
+from typing import List
+
+
+class TestSpool:
+    def test_segments(self, tmp_path):
+        spool = Spool(str(tmp_path), segment_bytes=20)
+        for i in range(5):
+            spool.append(b"record %d" % i)
+        # 16 bytes per record: a new segment every 2 records
+        assert len(spool) == 3
+        drained: List[bytes] = []
+        while (segment := spool.next_segment()) is not None:
+            drained.extend(Spool.read(segment))
+            spool.ack(segment)
+        assert drained == [b"record %d" % i for i in range(5)]
+        assert len(spool) == 0 and list(tmp_path.iterdir()) == []
+
+    def test_restart(self, tmp_path):
+        spool = Spool(str(tmp_path))
+        spool.append(b"a")
+        spool.append(b"b")
+        spool.close()
+        # torn record at the end of the segment
+        segment = next(tmp_path.iterdir())
+        with open(segment, 'ab') as f:
+            f.write(Spool.HEADER.pack(10, 0) + b"abc")
+
+        spool = Spool(str(tmp_path))
+        spool.append(b"c")
+        assert len(spool) == 2
+        first = spool.next_segment()
+        assert first == segment and list(Spool.read(first)) == [b"a", b"b"]
+        spool.ack(first)
+        assert list(Spool.read(spool.next_segment())) == [b"c"]
+
+
+class TestSpooledWriter:
+    def test_outage(self, tmp_path):
+        received: List[bytes] = []
+        state = {'up': False}
+
+        async def handler(request):
+            if not state['up']:
+                return web.Response(status=503)
+            received.append(await request.read())
+            return web.Response(status=204)
+
+        async def run():
+            app = web.Application()
+            app.router.add_post('/api/v2/write', handler)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            writer = InfluxWriter(f"http://127.0.0.1:{port}", "t", "o", "b",
+                                  batch_size=2, flush_interval=0.05,
+                                  spool=Spool(str(tmp_path)), retry_interval=0.05)
+            await writer.start()
+            try:
+                for i in range(10):
+                    await writer.write(b"m v=%d %d\n" % (i, i))
+                await asyncio.sleep(0.2)
+                assert received == [] and writer.spooled == 10
+                state['up'] = True
+                for _ in range(100):
+                    if len(writer.spool) == 0 and not writer._failing:
+                        break
+                    await asyncio.sleep(0.05)
+                await writer.write(b"m v=10 10\n")
+            finally:
+                await writer.close()
+                await runner.cleanup()
+
+        asyncio.run(run())
+        lines = b''.join(received).splitlines()
+        assert sorted(lines) == sorted(b"m v=%d %d" % (i, i) for i in range(11))
@@ -0,0 +1,81 @@
+import asyncio
+from array import array
+
+from app.decoder import Columns, DEFAULT_SCHEMA
+from app.main import snapshot_periodically
+from app.state import StateTable
+
+
+def columns(times, vbat=3.6) -> Columns:
+    # newest first, as decoded
+    times = sorted(times, reverse=True)
+    return Columns(DEFAULT_SCHEMA, array('q', times),
+                   [array('d', [float(t) for t in times]), array('d', [50.0] * len(times))],
+                   vbat=vbat, period=15)
+
+
+class TestStateTable:
+    def test_trim_overlap(self):
+        table = StateTable()
+        assert list(table.trim("A", columns([0, 15, 30])).t) == [30, 15, 0]
+        cols = table.trim("A", columns([15, 30, 45, 60], vbat=3.5))
+        assert list(cols.t) == [60, 45]
+        assert list(cols.values[0]) == [60.0, 45.0]
+        state = table.get("A")
+        assert (state.last_t, state.vbat, list(state.values)) == (60, 3.5, [60.0, 50.0])
+        assert len(table.trim("A", columns([30, 45]))) == 0
+        assert table.get("A").last_t == 60
+
+    def test_trim_jitter(self):
+        table = StateTable()
+        period = 60 * 10**9
+        first = [i * period for i in range(10)]
+        table.trim("A", Columns(DEFAULT_SCHEMA, array('q', first[::-1]),
+                                [array('d', [20.0] * 10), array('d', [50.0] * 10)], period=period))
+        # received 5 periods and 40 ms later: 5 of its 10 epochs are new
+        second = [t + 5 * period + 40_000_000 for t in first]
+        cols = table.trim("A", Columns(DEFAULT_SCHEMA, array('q', second[::-1]),
+                                       [array('d', [20.0] * 10), array('d', [50.0] * 10)],
+                                       period=period))
+        assert len(cols) == 5
+        # and 40 ms earlier
+        third = [t + 10 * period - 40_000_000 for t in first]
+        cols = table.trim("A", Columns(DEFAULT_SCHEMA, array('q', third[::-1]),
+                                       [array('d', [20.0] * 10), array('d', [50.0] * 10)],
+                                       period=period))
+        assert len(cols) == 5
+
+    def test_max_devices(self):
+        table = StateTable(max_devices=2)
+        for dev in "ABC":
+            table.trim(dev, columns([0]))
+        assert len(table) == 2 and table.get("A") is None
+
+    def test_snapshot(self, tmp_path):
+        # the directory is created on the first snapshot
+        path = str(tmp_path / "lib" / "state.json")
+        table = StateTable(path=path)
+        table.trim("A", columns([0, 15]))
+        table.snapshot()
+        restored = StateTable(path=path)
+        assert restored.get("A").last_t == 15
+        assert len(restored.trim("A", columns([0, 15, 30]))) == 1
+
+    def test_bad_snapshot(self, tmp_path):
+        path = tmp_path / "state.json"
+        path.write_text("{")
+        assert len(StateTable(path=str(path))) == 0
+
+    def test_failed_snapshot(self, tmp_path):
+        (tmp_path / "file").write_text("")
+        table = StateTable(path=str(tmp_path / "file" / "state.json"))
+        table.trim("A", columns([0, 15]))
+
+        async def run():
+            task = asyncio.create_task(snapshot_periodically(table, 0.01))
+            await asyncio.sleep(0.05)
+            # the error is logged, the task keeps running
+            assert not task.done()
+            task.cancel()
+
+        asyncio.run(run())
@@ -0,0 +1,157 @@
+import asyncio
+import shutil
+import socket
+import subprocess
+import time
+
+import pytest
+
+from app.supervisor import device_from_topic, Shard, Supervisor, uplink_topic
+
+
+def crashing_worker(index, heartbeat):
+    time.sleep(0.1)
+    raise SystemExit(1)
+
+
+def stalled_worker(index, heartbeat):
+    time.sleep(60)
+
+
+def healthy_worker(index, heartbeat):
+    while True:
+        heartbeat[index] = time.monotonic()
+        time.sleep(0.05)
+
+
+def wait_for(cond, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class TestShard:
+    def test_partition(self):
+        devices = [f"device-{i}" for i in range(1000)]
+        shards = [Shard(i, 4) for i in range(4)]
+        owners = [[s.index for s in shards if s.owns(d)] for d in devices]
+        assert all(len(o) == 1 for o in owners)
+        counts = [sum(1 for o in owners if o == [i]) for i in range(4)]
+        assert min(counts) > 150
+
+    def test_worker_config(self):
+        from app.main import worker_config
+
+        config = {'state': {'path': '/s/state.json'},
+                  'pipeline': {'spill_path': '/s/spill.bin', 'workers': 2},
+                  'influxdb': {'url': 'u', 'spool': {'path': '/s/spool', 'segment_bytes': 10}},
+                  'dedup': {'enabled': True}}
+        cfg = worker_config(config, 3)
+        assert cfg['state']['path'] == '/s/state.json.3'
+        assert cfg['pipeline'] == {'spill_path': '/s/spill.bin.3', 'workers': 2}
+        assert cfg['influxdb'] == {'url': 'u', 'spool': {'path': '/s/spool.3', 'segment_bytes': 10}}
+        assert cfg['dedup'] is config['dedup']
+        # the shared configuration is left untouched
+        assert config['state']['path'] == '/s/state.json'
+        assert config['influxdb']['spool']['path'] == '/s/spool'
+        assert worker_config({'influxdb': {'url': 'u'}}, 1) == {'influxdb': {'url': 'u'}}
+
+        shared = worker_config(dict(config, supervisor={'sharing': 'shared'}), 1)
+        assert shared['dedup'] == {'enabled': False}
+        assert shared['state'] == {'path': '/s/state.json.1', 'enabled': False}
+        assert 'aggregate' not in shared
+
+    def test_topics(self):
+        assert device_from_topic("v3/app@ttn/devices/dev-1/up") == "dev-1"
+        assert uplink_topic("app") == "v3/app/devices/+/up"
+        assert uplink_topic("app", "shared", "g") == "$share/g/v3/app/devices/+/up"
+
+
+class TestSupervisor:
+    def test_restart_crashed(self):
+        sup = Supervisor(crashing_worker, processes=2, restart_delay=0.1)
+        sup.start()
+        try:
+            assert wait_for(lambda: (sup.check(), sup.restarts >= 2)[1])
+        finally:
+            sup.stop()
+        # crashes right after start: backoff grows
+        assert max(sup._delay) > 0.1
+
+    def test_restart_stalled(self):
+        sup = Supervisor(stalled_worker, processes=1, heartbeat_timeout=0.5,
+                         restart_delay=0.1)
+        sup.start()
+        try:
+            assert wait_for(lambda: (sup.check(), sup.restarts >= 1)[1])
+        finally:
+            sup.stop()
+        assert sup.alive() == 0
+
+    def test_healthy(self):
+        sup = Supervisor(healthy_worker, processes=2, heartbeat_timeout=5.0)
+        sup.start()
+        try:
+            assert wait_for(lambda: sup.alive() == 2)
+            time.sleep(1.0)
+            sup.check()
+            assert sup.restarts == 0 and sup.alive() == 2
+        finally:
+            sup.stop()
+
+
+@pytest.mark.skipif(shutil.which('mosquitto') is None, reason="mosquitto not installed")
+class TestMosquitto:
+    def test_hash_sharding(self, tmp_path):
+        aiomqtt = pytest.importorskip('aiomqtt')
+        from app.main import consume
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        conf = tmp_path / 'mosquitto.conf'
+        conf.write_text(f"listener {port} 127.0.0.1\nallow_anonymous true\n")
+        broker = subprocess.Popen(['mosquitto', '-c', str(conf)])
+        time.sleep(0.5)
+
+        async def run():
+            received = [[], []]
+            tasks = []
+            for i in range(2):
+                client = aiomqtt.Client('127.0.0.1', port)
+                await client.__aenter__()
+
+                async def put(raw, i=i):
+                    received[i].append(raw)
+                tasks.append((client, asyncio.create_task(
+                    consume(client, uplink_topic('app'), put, Shard(i, 2)))))
+            await asyncio.sleep(0.5)
+            async with aiomqtt.Client('127.0.0.1', port) as pub:
+                for n in range(20):
+                    for d in range(10):
+                        await pub.publish(f"v3/app/devices/dev-{d}/up",
+                                          f"dev-{d} {n}".encode(), qos=1)
+            await asyncio.sleep(1.0)
+            for client, task in tasks:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await client.__aexit__(None, None, None)
+            return received
+
+        try:
+            received = asyncio.run(run())
+        finally:
+            broker.terminate()
+            broker.wait()
+
+        assert sum(len(r) for r in received) == 200
+        for i, msgs in enumerate(received):
+            for d in range(10):
+                mine = [m for m in msgs if m.split()[0] == f"dev-{d}".encode()]
+                if Shard(i, 2).owns(f"dev-{d}"):
+                    assert mine == [f"dev-{d} {n}".encode() for n in range(20)]
+                else:
+                    assert not mine
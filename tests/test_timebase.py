@@ -0,0 +1,52 @@
+from base64 import b64encode
+import datetime
+
+from app.batch import decode_batch
+from app.decoder import decode, decode_columnar, CURRENT_VERSION, Ports
+from app.timebase import (parse_received_at, parse_received_at_ns, received_ns, to_datetime,
+                          to_ns)
+from compress import Compress
+
+
+def mult_meas_payload(offset: int) -> str:
+    B = Compress(32)
+    for T, H in [(230, 50), (231, 51), (232, 52)]:
+        B.add_with_sign(T, 10)
+        B.add(H, 7)
+    SR1 = (CURRENT_VERSION >> 2) & 0xFF
+    SR2 = ((CURRENT_VERSION & 0x3) << 6) | (13 << 2) | 0x3
+    return b64encode(bytes([SR1, SR2, 0x8F, offset]) + B.array()).decode()
+
+
+class TestTimebase:
+    def test_parse(self):
+        ns = parse_received_at_ns("2024-05-01T10:00:01.123456789Z")
+        assert ns == to_ns(datetime.datetime(2024, 5, 1, 10, 0, 1)) + 123456789
+        assert parse_received_at_ns("2024-05-01T12:00:01+02:00") == \
+            to_ns(datetime.datetime(2024, 5, 1, 10, 0, 1))
+        assert parse_received_at("2024-05-01T10:00:01.5Z") == \
+            datetime.datetime(2024, 5, 1, 10, 0, 1, 500000)
+        assert to_datetime(ns) == datetime.datetime(2024, 5, 1, 10, 0, 1, 123456)
+
+    def test_received_fallback(self):
+        before = to_ns(datetime.datetime.utcnow())
+        assert received_ns(None) >= before
+        assert received_ns("yesterday") >= before
+
+    def test_epoch_times(self):
+        received = "2024-05-01T10:00:00.000000001Z"
+        now = parse_received_at_ns(received)
+        cols = decode_columnar(Ports.MULT_MEAS, mult_meas_payload(4), now=now)
+        period = 15 * 10**9
+        newest = now - 4 * 10**9
+        assert list(cols.t) == [newest, newest - period, newest - 2 * period]
+        # datetime and integer time bases agree
+        assert decode(Ports.MULT_MEAS, mult_meas_payload(4), now=to_datetime(now)) == \
+            decode(Ports.MULT_MEAS, mult_meas_payload(4), now=now - 1)
+
+    def test_batch_offset(self):
+        now = datetime.datetime(2024, 1, 1)
+        payloads = [mult_meas_payload(0), mult_meas_payload(30)]
+        res = decode_batch([Ports.MULT_MEAS] * 2, payloads, now=now)
+        assert res.to_list(2) == [decode(Ports.MULT_MEAS, p, now=now) for p in payloads]
+        assert res.to_list(2)[1][0][0] == now - datetime.timedelta(seconds=30)
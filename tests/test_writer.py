@@ -0,0 +1,153 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from app.spool import Spool
+from app.writer import InfluxWriter
+
+
+class StubWriteApi:
+    """
+    Records the batches written, fails while `up` is False
+    """
+
+    def __init__(self):
+        self.batches: List[bytes] = []
+        self.up = True
+
+    async def write(self, bucket, org, batch):
+        if not self.up:
+            raise ConnectionError("database down")
+        self.batches.append(batch)
+
+
+def stub_writer(**kwargs) -> InfluxWriter:
+    return InfluxWriter("http://127.0.0.1:1", "t", "o", "b", **kwargs)
+
+
+async def started(writer: InfluxWriter) -> StubWriteApi:
+    await writer.start()
+    writer._write_api = StubWriteApi()
+    return writer._write_api
+
+
+class TestInfluxWriter:
+    def test_lost_batches(self):
+        async def run():
+            writer = stub_writer(batch_size=2)
+            api = await started(writer)
+            try:
+                api.up = False
+                await writer.write(b"m v=1 1\nm v=2 2\n")
+                with pytest.raises(RuntimeError, match="2 lines"):
+                    await writer.sync()
+                assert writer.lost == 2
+                # reported once
+                api.up = True
+                await writer.write(b"m v=3 3\n")
+                await writer.sync()
+            finally:
+                await writer.close()
+            return api
+
+        api = asyncio.run(run())
+        assert api.batches == [b"m v=3 3\n"]
+
+    def test_size_flush(self):
+        async def run():
+            writer = stub_writer(batch_size=3, flush_interval=60)
+            api = await started(writer)
+            try:
+                await writer.write(b"m v=1 1\nm v=2 2\n")
+                await asyncio.sleep(0)
+                assert api.batches == []
+                await writer.write(b"m v=3 3\n")
+                await asyncio.sleep(0)
+                assert api.batches == [b"m v=1 1\nm v=2 2\nm v=3 3\n"]
+            finally:
+                await writer.close()
+
+        asyncio.run(run())
+
+    def test_time_flush(self):
+        async def run():
+            writer = stub_writer(batch_size=1000, flush_interval=0.02)
+            api = await started(writer)
+            try:
+                await writer.write(b"m v=1 1\n")
+                assert api.batches == []
+                await asyncio.sleep(0.1)
+                assert api.batches == [b"m v=1 1\n"]
+            finally:
+                await writer.close()
+
+        asyncio.run(run())
+
+    def test_max_inflight(self):
+        async def run():
+            writer = stub_writer(batch_size=1, flush_interval=60, max_inflight=2)
+            api = await started(writer)
+            release = asyncio.Event()
+            active, peak = 0, 0
+
+            async def slow_write(bucket, org, batch):
+                nonlocal active, peak
+                active += 1
+                peak = max(peak, active)
+                await release.wait()
+                api.batches.append(batch)
+                active -= 1
+
+            api.write = slow_write
+            try:
+                await writer.write(b"m v=1 1\n")
+                await writer.write(b"m v=2 2\n")
+                # both slots are busy, the third batch waits for one
+                third = asyncio.create_task(writer.write(b"m v=3 3\n"))
+                await asyncio.sleep(0.02)
+                assert not third.done() and active == 2
+                release.set()
+                await third
+                await writer.sync()
+            finally:
+                await writer.close()
+            return api, peak
+
+        api, peak = asyncio.run(run())
+        assert peak == 2
+        assert sorted(api.batches) == [b"m v=1 1\n", b"m v=2 2\n", b"m v=3 3\n"]
+
+    def test_close_flushes(self):
+        async def run():
+            writer = stub_writer(batch_size=1000, flush_interval=60)
+            api = await started(writer)
+            await writer.write(b"m v=1 1\n")
+            await writer.write(b"m v=2 2\n")
+            await writer.close()
+            return api
+
+        api = asyncio.run(run())
+        assert api.batches == [b"m v=1 1\nm v=2 2\n"]
+
+    def test_sync_drains_spool(self, tmp_path):
+        async def run():
+            writer = stub_writer(batch_size=1, flush_interval=60,
+                                 spool=Spool(str(tmp_path)), retry_interval=0.01)
+            api = await started(writer)
+            try:
+                api.up = False
+                await writer.write(b"m v=1 1\n")
+                sync = asyncio.create_task(writer.sync())
+                await asyncio.sleep(0.05)
+                # spooled, not in the database yet
+                assert not sync.done() and writer.spooled == 1
+                api.up = True
+                await asyncio.wait_for(sync, 5)
+                assert len(writer.spool) == 0
+            finally:
+                await writer.close()
+            return api
+
+        api = asyncio.run(run())
+        assert api.batches == [b"m v=1 1\n"]